@@ -0,0 +1,383 @@
+""" Streaming tar archives of a tree
+write_archive walks src like copy and streams its files straight into a
+tar (pax format) with owner, mode, times, xattrs (as SCHILY.xattr
+headers like GNU tar), symlinks and hardlinks. output can be compressed
+with zstd (requires python package zstandard) in independent frames,
+a frame ends at a member boundary after about framesize bytes of tar.
+
+a sidecar index (json lines) records offset of each member in the tar
+and of the frame it starts in, so extract_member restores a file by
+seeking to its frame instead of reading the archive from start.
+holes of sparse files are archived as zeros.
+"""
+import os
+import pwd
+import grp
+import json
+import stat
+import logging
+import tarfile
+from pathlib import Path
+from functools import lru_cache
+from .walk import scantree, DIR, POST
+from .utils import open_noatime
+from .core import symlink_target, handle_exception, log_or_print
+from . import throttle
+from . import instrument
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# bytes of tar after which a new zstd frame is started
+FRAMESIZE = 4 * 1024 * 1024
+INDEX_VERSION = 1
+XATTR_PREFIX = "SCHILY.xattr."
+
+
+def index_path(path):
+    """ default path of index of archive at path """
+    return os.fspath(path) + ".idx"
+
+
+def _compressor(level):
+    if zstandard is None:
+        raise ValueError("compression zstd requires python package zstandard")
+    return zstandard.ZstdCompressor(level=level)
+
+
+@lru_cache(maxsize=None)
+def _uname(uid):
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return ""
+
+
+@lru_cache(maxsize=None)
+def _gname(gid):
+    try:
+        return grp.getgrgid(gid).gr_name
+    except KeyError:
+        return ""
+
+
+class FrameWriter:
+    """ Write only file object for tar writing to fileobj, compressed in
+    independent zstd frames if level is given. tell() is offset in tar
+    (uncompressed) and boundary() offsets of frame of next write.
+    """
+    def __init__(self, fileobj, level=None, framesize=FRAMESIZE):
+        self.fileobj = fileobj
+        self.cctx = _compressor(level) if level is not None else None
+        self.framesize = framesize
+        # of tar and of output
+        self.offset = 0
+        self.written = 0
+        # (written, offset) at start of current frame
+        self.frame = (0, 0)
+        self.cobj = None
+
+    def _out(self, data):
+        if data:
+            self.fileobj.write(data)
+            self.written += len(data)
+
+    def write(self, data):
+        n = len(data)
+        if self.cctx is None:
+            self._out(data)
+        else:
+            if self.cobj is None:
+                self.frame = (self.written, self.offset)
+                self.cobj = self.cctx.compressobj()
+            self._out(self.cobj.compress(data))
+        self.offset += n
+        throttle.consume(n)
+        return n
+
+    def tell(self):
+        return self.offset
+
+    def boundary(self):
+        """ Returns (offset in output, offset in tar) of frame that next
+        write goes to, current frame is ended if it has framesize bytes.
+        """
+        if self.cobj is not None and \
+                self.offset - self.frame[1] >= self.framesize:
+            self.end_frame()
+        if self.cobj is None:
+            return self.written, self.offset
+        return self.frame
+
+    def end_frame(self):
+        if self.cobj is not None:
+            self._out(self.cobj.flush())
+            self.cobj = None
+
+    def close(self):
+        """ ends last frame, fileobj is not closed """
+        self.end_frame()
+        self.fileobj.flush()
+
+
+class _SizedReader:
+    """ reads exactly size bytes of file fd, a file that shrunk while
+    archived is padded with zeros (tar header has the size already)
+    """
+    def __init__(self, fd, size):
+        self.file = open(fd, "rb", buffering=0)
+        self.remaining = size
+        self.short = False
+
+    def read(self, n=-1):
+        if n < 0 or n > self.remaining:
+            n = self.remaining
+        data = self.file.read(n) if n else b""
+        if len(data) < n:
+            self.short = True
+            data += bytes(n - len(data))
+        self.remaining -= n
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def _tarinfo(fi, name, st):
+    ti = tarfile.TarInfo(name)
+    ti.mode = stat.S_IMODE(st.st_mode)
+    ti.uid, ti.gid = st.st_uid, st.st_gid
+    ti.uname, ti.gname = _uname(st.st_uid), _gname(st.st_gid)
+    # fractions of seconds are kept in pax headers
+    ti.mtime = st.st_mtime_ns // 10**9 if not st.st_mtime_ns % 10**9 \
+        else st.st_mtime_ns / 10**9
+    try:
+        names = os.listxattr(fi.path, follow_symlinks=False)
+    except OSError:
+        names = []
+    for xattr in names:
+        try:
+            value = os.getxattr(fi.path, xattr, follow_symlinks=False)
+        except OSError:
+            continue
+        ti.pax_headers[XATTR_PREFIX + xattr] = \
+            value.decode("utf-8", "surrogateescape")
+    return ti
+
+
+def write_archive(src, out, ignore=None, index=None, level=None,
+                  framesize=FRAMESIZE, logger=None):
+    """ Streams src as a tar to out (a path or binary file object)
+    ignore filters files as in core.copy, directories left without
+    entries that are ignored are not archived.
+    level compresses with zstd at that level in frames of framesize.
+    index is path of index of members (see index_path).
+    Returns dict of numbers of members, bytes of files and bytes written
+    """
+    if logger:
+        logger.__setattr__("name", "archive")
+    src = Path(src)
+    if not os.access(src, os.R_OK):
+        raise OSError(f"Skipping: directory {src} "
+                      "cannot be read by current user.")
+    if not src.is_dir():
+        raise NotADirectoryError(f"src {str(src)} is not a directory, "
+                                 "pass a directory.")
+    scope = str(os.path.realpath(src))
+    fileobj = open(out, "wb") if isinstance(out, (str, os.PathLike)) \
+        else out
+    writer = FrameWriter(fileobj, level=level, framesize=framesize)
+    tar = tarfile.open(fileobj=writer, mode="w", format=tarfile.PAX_FORMAT)
+    idx = open(index, "w") if index else None
+    if idx:
+        idx.write(json.dumps({"index": INDEX_VERSION,
+                              "compression": "zstd" if level is not None
+                              else None}) + "\n")
+    totals = {"members": 0, "bytes": 0}
+    # first member of inodes with several links
+    inodes = {}
+    # of directories being walked [entry, name, archived]
+    frames = []
+
+    def add(fi, name, st, kind, linkname=None):
+        ti = _tarinfo(fi, name, st)
+        data = None
+        if kind == "dir":
+            ti.type = tarfile.DIRTYPE
+        elif kind == "symlink":
+            ti.type = tarfile.SYMTYPE
+            ti.linkname = linkname
+        elif kind == "link":
+            ti.type = tarfile.LNKTYPE
+            ti.linkname = linkname
+        else:
+            ti.size = st.st_size
+            data = _SizedReader(open_noatime(fi.path), st.st_size)
+        throttle.start_file()
+        frame, frame_offset = writer.boundary()
+        offset = writer.tell()
+        try:
+            tar.addfile(ti, data)
+        finally:
+            if data is not None:
+                data.close()
+        if data is not None and data.short:
+            log_or_print(f"Mismatch: {fi.path} shrunk while archived, "
+                         "padded with zeros.", logger=logger,
+                         level=logging.WARNING)
+        if idx:
+            record = {"name": name, "type": kind, "size": ti.size,
+                      "offset": offset, "frame": frame,
+                      "frame_offset": frame_offset}
+            if kind == "link":
+                record["link"] = linkname
+            idx.write(json.dumps(record) + "\n")
+        totals["members"] += 1
+        totals["bytes"] += ti.size
+        instrument.count("files_archived")
+        instrument.count("bytes_archived", ti.size)
+
+    def add_parents():
+        # directories are archived before their first entry
+        for frame in frames:
+            if not frame[2]:
+                add(frame[0], frame[1],
+                    frame[0].stat(follow_symlinks=False), "dir")
+                frame[2] = True
+
+    def enter(di):
+        if not di.readable():
+            if not ignore:
+                handle_exception(OSError(f"Skipping: {di.path} file "
+                                         "cannot be read."), di, None, logger)
+            return False
+        frames.append([di, os.path.relpath(di.path, src), False])
+        return True
+
+    def onerror(di, ex):
+        handle_exception(ex, di, None, logger)
+
+    try:
+        for event, fi in scantree(src, enter=enter, onerror=onerror):
+            if event == DIR:
+                continue
+            try:
+                if event == POST:
+                    di, name, archived = frames.pop()
+                    if not archived and not (ignore and ignore(di)):
+                        add_parents()
+                        add(di, name, di.stat(follow_symlinks=False), "dir")
+                    continue
+                if ignore:
+                    if not fi.readable():
+                        continue
+                    if fi.is_file() and ignore(fi):
+                        continue
+                if not fi.readable():
+                    raise OSError(f"Skipping: {fi.path} file cannot be read.")
+                name = os.path.relpath(fi.path, src)
+                st = fi.stat(follow_symlinks=False)
+                if fi.is_symlink():
+                    add_parents()
+                    add(fi, name, st, "symlink",
+                        symlink_target(fi, scope) or os.readlink(fi.path))
+                elif fi.is_file():
+                    add_parents()
+                    key = (st.st_dev, st.st_ino)
+                    if st.st_nlink > 1 and key in inodes:
+                        add(fi, name, st, "link", inodes[key])
+                    else:
+                        if st.st_nlink > 1:
+                            inodes[key] = name
+                        add(fi, name, st, "file")
+                else:
+                    msg = f"Skipping: {str(fi.path)} is a unsupported file."
+                    log_or_print(msg, logger=logger, level=logging.WARNING)
+            except Exception as ex:
+                handle_exception(ex, fi, None, logger)
+        tar.close()
+        writer.close()
+    finally:
+        if idx:
+            idx.close()
+        if fileobj is not out:
+            fileobj.close()
+    totals["written"] = writer.written
+    return totals
+
+
+def load_index(path):
+    """ Returns header of index at path and its records by member name """
+    with open(path) as f:
+        header = json.loads(f.readline())
+        if header.get("index") != INDEX_VERSION:
+            raise ValueError(f"{path} is not an index of version "
+                             f"{INDEX_VERSION}")
+        records = {}
+        for line in f:
+            record = json.loads(line)
+            records[record["name"]] = record
+    return header, records
+
+
+def _skip(stream, n):
+    while n > 0:
+        data = stream.read(min(n, 1024 * 1024))
+        if not data:
+            raise ValueError("archive is shorter than its index")
+        n -= len(data)
+
+
+# archives of gar are trusted, owners and modes are restored as they are
+_extract_kwargs = {"filter": "fully_trusted"} \
+    if hasattr(tarfile, "fully_trusted_filter") else {}
+
+
+def extract_member(archive, name, dst, index=None, logger=None):
+    """ Restores member name of archive into directory dst reading only
+    its frame (see write_archive), index defaults to index_path(archive).
+    a hardlink is restored with data of the member it links to, xattrs
+    that cannot be set (eg.. security.* by other users than root) are
+    skipped with a warning.
+    Returns path of restored file
+    """
+    if logger:
+        logger.__setattr__("name", "extract")
+    header, records = load_index(index or index_path(archive))
+    name = os.path.normpath(name)
+    if name not in records:
+        raise KeyError(f"{name} is not a member of {archive}")
+    record = records[name]
+    if record["type"] == "link":
+        record = records[record["link"]]
+    with open(archive, "rb") as f:
+        f.seek(record["frame"])
+        stream = f
+        if header.get("compression") == "zstd":
+            if zstandard is None:
+                raise ValueError("compression zstd requires python package "
+                                 "zstandard")
+            stream = zstandard.ZstdDecompressor().stream_reader(
+                f, read_across_frames=True)
+        _skip(stream, record["offset"] - record["frame_offset"])
+        with tarfile.open(fileobj=stream, mode="r|") as tar:
+            member = tar.next()
+            if member is None or member.name != record["name"]:
+                raise ValueError(f"index of {archive} doesn't match it")
+            member.name = name
+            tar.extract(member, dst, numeric_owner=True, **_extract_kwargs)
+    path = os.path.join(dst, name)
+    for key, value in member.pax_headers.items():
+        if not key.startswith(XATTR_PREFIX):
+            continue
+        xattr = key[len(XATTR_PREFIX):]
+        try:
+            os.setxattr(path, xattr, value.encode("utf-8", "surrogateescape"),
+                        follow_symlinks=False)
+        except OSError as ex:
+            log_or_print(f"Skipping: xattr {xattr} of {path} not restored, "
+                         f"{ex.strerror}.", logger=logger,
+                         level=logging.WARNING)
+    return path
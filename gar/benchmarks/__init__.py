@@ -0,0 +1,5 @@
+""" Benchmarks of gar operations on synthetic trees
+run with: python -m gar.benchmarks --help
+"""
+from .tree import make_tree
+from .run import run_benchmarks, compare_results
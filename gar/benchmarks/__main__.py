@@ -0,0 +1,74 @@
+import pwd
+import click
+from .run import run_benchmarks, compare_results, save, load, OPERATIONS
+
+
+@click.group()
+def cli():
+    "Benchmarks of gar operations on synthetic trees"
+
+
+def parse_owners(ctx, param, value):
+    owners = []
+    for user in value.split(",") if value else []:
+        try:
+            pw = pwd.getpwnam(user)
+        except KeyError:
+            raise click.BadParameter(f"user {user} doesn't exist")
+        owners.append((pw.pw_uid, pw.pw_gid))
+    return owners or None
+
+
+@cli.command(name="run")
+@click.argument("output", type=click.Path())
+@click.option("--files", default=1000, show_default=True)
+@click.option("--depth", default=3, show_default=True)
+@click.option("--fanout", default=4, show_default=True)
+@click.option("--size-median", default=16 * 1024, show_default=True,
+              help="Median size of files in bytes.")
+@click.option("--size-sigma", default=1.5, show_default=True,
+              help="Sigma of log normal distribution of sizes.")
+@click.option("--max-size", default=64 * 1024 * 1024, show_default=True)
+@click.option("--symlinks", default=0.05, show_default=True,
+              help="Fraction of files with a symlink.")
+@click.option("--owners", callback=parse_owners, default=None,
+              help="Comma separated users owning files (needs root).")
+@click.option("--seed", default=0, show_default=True)
+@click.option("--operation", "-o", "operations", multiple=True,
+              type=click.Choice(OPERATIONS), help="Default all.")
+@click.option("--jobs", "-j", type=int, default=None)
+@click.option("--workdir", type=click.Path(exists=True), default=None,
+              help="Directory on filesystem to benchmark.")
+@click.option("--cold-caches", is_flag=True, default=False,
+              help="Drop caches before cold runs (needs root).")
+def cli_run(output, operations, jobs, workdir, cold_caches, **tree):
+    """ Runs benchmarks and saves results as json to OUTPUT """
+    results = run_benchmarks(tree, operations=operations or OPERATIONS,
+                             workers=jobs, workdir=workdir,
+                             cold_caches=cold_caches)
+    for r in results["results"]:
+        syscalls = r["rw_syscalls_per_file"]
+        syscalls = f"{syscalls:.1f}" if syscalls is not None else "-"
+        click.echo(f"{r['operation']:>10} {r['run']:>5} "
+                   f"{r['seconds']:8.3f} s {r['files_per_s']:10.1f} files/s "
+                   f"{r['mb_per_s']:8.1f} MB/s {syscalls:>6} rw syscalls/file")
+    save(results, output)
+
+
+@cli.command(name="compare")
+@click.argument("old", type=click.Path(exists=True))
+@click.argument("new", type=click.Path(exists=True))
+@click.option("--threshold", default=0.1, show_default=True,
+              help="Fraction of slow down reported as regression.")
+def cli_compare(old, new, threshold):
+    """ Reports regressions of NEW results compared to OLD """
+    regressions = compare_results(load(old), load(new), threshold)
+    for op, run, ofps, nfps, change in regressions:
+        click.echo(f"{op} {run}: {ofps:.1f} -> {nfps:.1f} files/s "
+                   f"({change:+.0%})")
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    cli()
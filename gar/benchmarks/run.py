@@ -0,0 +1,146 @@
+import os
+import grp
+import json
+import time
+import shutil
+import platform
+import tempfile
+import contextlib
+from pathlib import Path
+from .tree import make_tree
+from ..core import copy, gcopy, verify, move
+from ..utils import hash_walk
+
+OPERATIONS = ("copy", "gcopy", "verify", "move", "hash_walk")
+
+
+def rw_syscalls():
+    """ Returns number of read and write syscalls of the process
+    (syscr + syscw of /proc/self/io, linux) or None if unavailable.
+    other calls (stat, metadata, copy_file_range ..) are not counted.
+    """
+    try:
+        with open("/proc/self/io") as f:
+            io = dict(line.split(": ") for line in f.read().splitlines())
+        return int(io["syscr"]) + int(io["syscw"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def drop_caches():
+    """ Drops page, dentry and inode caches (requires root) """
+    os.sync()
+    try:
+        with open("/proc/sys/vm/drop_caches", "w") as f:
+            f.write("3\n")
+        return True
+    except OSError:
+        return False
+
+
+def timed(fn, files, nbytes):
+    """ Returns timings of calling fn on a tree of files and nbytes """
+    sys0 = rw_syscalls()
+    start = time.perf_counter()
+    # copy and move print skipped files
+    with open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(devnull):
+        fn()
+    seconds = time.perf_counter() - start
+    sys1 = rw_syscalls()
+    result = {"seconds": seconds,
+              "files": files,
+              "bytes": nbytes,
+              "files_per_s": files / seconds if seconds else None,
+              "mb_per_s": nbytes / 1e6 / seconds if seconds else None,
+              "rw_syscalls_per_file": None}
+    if sys0 is not None and sys1 is not None and files:
+        result["rw_syscalls_per_file"] = (sys1 - sys0) / files
+    return result
+
+
+def run_benchmarks(tree=None, operations=OPERATIONS, workers=None,
+                   workdir=None, cold_caches=False):
+    """ Times operations of gar on a tree created with make_tree(**tree)
+    each operation is run twice: a cold run (empty destination, caches
+    dropped if cold_caches and permitted) and a warm re-run on the result
+    of the first. move has only a cold run.
+
+    Returns dict of meta data and list of results.
+    """
+    tree = dict(tree or {})
+    group = grp.getgrgid(os.getegid()).gr_name
+    workdir = Path(tempfile.mkdtemp(prefix="garbench", dir=workdir))
+    src = workdir / "src"
+    results = []
+    try:
+        stats = make_tree(src, **tree)
+        nfiles = stats["files"] + stats["symlinks"]
+
+        for op in operations:
+            dst = workdir / f"dst_{op}"
+            dst.mkdir()
+            if op == "copy":
+                fn = lambda: copy(src, dst, workers=workers)
+            elif op == "gcopy":
+                fn = lambda: gcopy(group, src, dst, workers=workers)
+            elif op == "verify":
+                copy(src, dst, workers=workers)
+                fn = lambda: verify(src, dst, workers=workers)
+            elif op == "hash_walk":
+                fn = lambda: hash_walk(src)
+            elif op == "move":
+                msrc = workdir / "src_move"
+                shutil.copytree(src, msrc, symlinks=True)
+                fn = lambda: move(msrc, dst, workers=workers)
+            else:
+                raise ValueError(f"unknown operation {op}")
+
+            runs = ["cold"] if op == "move" else ["cold", "warm"]
+            for run in runs:
+                dropped = drop_caches() if run == "cold" and cold_caches \
+                    else False
+                result = timed(fn, nfiles, stats["bytes"])
+                result.update({"operation": op, "run": run,
+                               "caches_dropped": dropped})
+                results.append(result)
+            shutil.rmtree(dst)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    meta = {"date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "workers": workers,
+            "tree": tree,
+            "tree_stats": stats}
+    return {"meta": meta, "results": results}
+
+
+def compare_results(old, new, threshold=0.1):
+    """ Compares results of two runs of run_benchmarks
+    returns list of (operation, run, old files/s, new files/s, change)
+    for operations slower by more than threshold (fraction).
+    """
+    key = lambda r: (r["operation"], r["run"])
+    old = {key(r): r for r in old["results"]}
+    regressions = []
+    for r in new["results"]:
+        o = old.get(key(r))
+        if not (o and o["files_per_s"] and r["files_per_s"]):
+            continue
+        change = r["files_per_s"] / o["files_per_s"] - 1
+        if change < -threshold:
+            regressions.append((*key(r), o["files_per_s"],
+                                r["files_per_s"], change))
+    return regressions
+
+
+def save(results, path):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,71 @@
+import os
+import math
+import random
+import hashlib
+from pathlib import Path
+
+# reproducible data blocks are sliced from a pattern of this size
+PATTERN_SIZE = 1024 * 1024
+
+
+def _pattern(seed):
+    return hashlib.shake_256(f"gar-{seed}".encode()).digest(PATTERN_SIZE)
+
+
+def _write(path, size, pattern, offset):
+    with open(path, "wb") as f:
+        while size > 0:
+            chunk = pattern[offset:offset + size]
+            f.write(chunk)
+            size -= len(chunk)
+            offset = 0
+
+
+def make_tree(root, files=1000, depth=3, fanout=4, size_median=16 * 1024,
+              size_sigma=1.5, max_size=64 * 1024 * 1024, symlinks=0.05,
+              owners=None, seed=0):
+    """ Creates a reproducible tree of directories and files in root
+    files: number of regular files spread over all directories
+    depth, fanout: levels and subdirectories per directory
+    size_median, size_sigma: log normal distribution of file sizes in bytes
+    max_size: limit on size of a file
+    symlinks: fraction of files for which a relative symlink is added
+    owners: list of (uid, gid) assigned to files at random (requires
+            permissions to chown) default owner is the running user
+    seed: same seed creates same tree
+
+    Returns dict with number of files, dirs, symlinks and bytes of tree.
+    """
+    rng = random.Random(seed)
+    pattern = _pattern(seed)
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+
+    dirs = [root]
+    level = [root]
+    for d in range(depth):
+        nextlevel = []
+        for parent in level:
+            for i in range(fanout):
+                di = parent / f"d{d}_{i}"
+                di.mkdir(exist_ok=True)
+                nextlevel.append(di)
+        dirs.extend(nextlevel)
+        level = nextlevel
+
+    stats = {"files": 0, "dirs": len(dirs) - 1, "symlinks": 0, "bytes": 0}
+    mu = math.log(max(size_median, 1))
+    for n in range(files):
+        di = dirs[rng.randrange(len(dirs))]
+        size = min(int(rng.lognormvariate(mu, size_sigma)), max_size)
+        fi = di / f"f{n}"
+        _write(fi, size, pattern, rng.randrange(PATTERN_SIZE))
+        if owners:
+            uid, gid = owners[rng.randrange(len(owners))]
+            os.chown(fi, uid, gid)
+        stats["files"] += 1
+        stats["bytes"] += size
+        if rng.random() < symlinks:
+            os.symlink(fi.name, di / f"l{n}")
+            stats["symlinks"] += 1
+    return stats
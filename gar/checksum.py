@@ -0,0 +1,132 @@
+import os
+import mmap
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from .utils import open_noatime
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+ALGORITHMS = ("sha256", "blake2b", "xxh")
+# size of reads (or slices of memory map) fed to hash function
+BUFSIZE = 16 * 1024 * 1024
+# default bytes of files being hashed at a time
+MAX_INFLIGHT = 1024 * 1024 * 1024
+
+
+def new_hash(algorithm="sha256"):
+    """ Returns a new hash object for one of ALGORITHMS """
+    if algorithm == "xxh":
+        if xxhash is None:
+            raise ValueError("checksum xxh requires python package xxhash")
+        return xxhash.xxh3_128()
+    if algorithm not in ALGORITHMS:
+        raise ValueError(f"checksum {algorithm} is not one of {ALGORITHMS}")
+    return hashlib.new(algorithm)
+
+
+def file_digest(path, algorithm="sha256", bufsize=BUFSIZE):
+    """ Returns hex digest of contents of file at path
+    file is read with a memory map and falls back to reads
+    for files that can't be mapped.
+    """
+    fh = new_hash(algorithm)
+    fd = open_noatime(path)
+    try:
+        size = os.fstat(fd).st_size
+        try:
+            mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ) if size else None
+        except (OSError, ValueError):
+            mm = None
+        if mm is not None:
+            with mm:
+                if hasattr(mm, "madvise"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                view = memoryview(mm)
+                for offset in range(0, len(mm), bufsize):
+                    fh.update(view[offset:offset + bufsize])
+                view.release()
+        else:
+            with open(fd, "rb", buffering=0, closefd=False) as f:
+                for chunk in iter(lambda: f.read(bufsize), b""):
+                    fh.update(chunk)
+    finally:
+        os.close(fd)
+    return fh.hexdigest()
+
+
+def compare_content(src, dst, algorithm="sha256"):
+    """ Returns (src, dst, True) if contents of files src and dst are same
+    and (src, dst, None) if any of them can't be read.
+    """
+    try:
+        same = file_digest(src, algorithm) == file_digest(dst, algorithm)
+    except OSError:
+        same = None
+    return (src, dst, same)
+
+
+class ChecksumPool:
+    """ Pool of processes comparing contents of (src, dst) file pairs
+    at most max_inflight bytes (size of src and dst) of files are hashed at
+    a time, a file larger than max_inflight is hashed alone.
+    submit() and finish() yield (src, dst, same) of completed pairs.
+    """
+    def __init__(self, algorithm="sha256", workers=None,
+                 max_inflight=MAX_INFLIGHT):
+        # fail early for unavailable algorithm
+        new_hash(algorithm)
+        self.algorithm = algorithm
+        self.max_inflight = max_inflight
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.inflight = 0
+        self.futures = {}
+
+    def _completed(self, block=True):
+        if not self.futures:
+            return
+        done, _ = wait(self.futures, timeout=None if block else 0,
+                       return_when=FIRST_COMPLETED)
+        for future in done:
+            self.inflight -= self.futures.pop(future)
+            yield future.result()
+
+    def submit(self, src, dst):
+        try:
+            size = os.stat(src).st_size + os.stat(dst).st_size
+        except OSError:
+            size = 0
+        while self.futures and self.inflight + size > self.max_inflight:
+            yield from self._completed()
+        future = self.executor.submit(compare_content, src, dst,
+                                      self.algorithm)
+        self.futures[future] = size
+        self.inflight += size
+        # pairs already completed
+        yield from self._completed(block=False)
+
+    def finish(self):
+        while self.futures:
+            yield from self._completed()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.executor.shutdown(wait=True)
+
+
+def compare_pairs(pairs, algorithm="sha256", workers=None,
+                  max_inflight=MAX_INFLIGHT):
+    """ Compares contents of (src, dst) file pairs in a pool of processes
+    see ChecksumPool.
+
+    Yields (src, dst, same) in order the files are completed.
+    """
+    with ChecksumPool(algorithm, workers, max_inflight) as pool:
+        for src, dst in pairs:
+            yield from pool.submit(src, dst)
+        yield from pool.finish()
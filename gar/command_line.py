@@ -1,12 +1,26 @@
 import sys
 import os
+import time
+import signal
 import logging
 from pathlib import Path
+from functools import partial, wraps
+from contextlib import ExitStack, contextmanager
 import click
-from .core import copy, gcopy, verify
+from .core import copy, gcopy, mgcopy, gmove, iverify, ignore_not_group
 from .logger import setup_logger, logfilepath
 from .lock import SimpleFileLock
-from .utils import getgid
+from .manifest import Manifest
+from .journal import Journal
+from .plan import plan, apply, read_plan
+from .archive import write_archive, extract_member, index_path
+from .dedup import ObjectStore, LINKS
+from .utils import getgid, group_index, hr_size
+from .progress import Progress
+from .checksum import ALGORITHMS
+from . import instrument
+from . import throttle
+from . import transfer
 
 
 class Cli(object):
@@ -15,10 +29,17 @@ class Cli(object):
         self.logger = logging.getLogger("gar")
         # set default debug
         self.debug = debug
-        if debug:
-            self.logger.setLevel(logging.DEBUG)
+        self.logger.setLevel(logging.DEBUG if debug else logging.INFO)
+        # records are written to log file by a background thread
         fh = setup_logger()
         self.logger.addHandler(fh)
+        # errors are also shown on console
+        if not any(getattr(h, "console", False)
+                   for h in self.logger.handlers):
+            ch = logging.StreamHandler()
+            ch.setLevel(logging.WARNING)
+            ch.console = True
+            self.logger.addHandler(ch)
 
     def setDegug(self, debug):
         if debug:
@@ -30,10 +51,159 @@ pass_cli = click.make_pass_decorator(Cli, ensure=True)
 
 @click.group()
 @click.option("--debug/-d", is_flag=True, show_default=True, default=False)
+@click.option("--profile", is_flag=True, default=False,
+              help="Print time spent in phases of the command.")
+@click.option("--profile-output", type=click.Path(), default=None,
+              help="Also save cProfile stats of the command to file.")
 @click.pass_context
-def cli(ctx, debug):
+def cli(ctx, debug, profile, profile_output):
     "Write description here"
     ctx.obj = Cli(debug=debug)
+    if profile or profile_output:
+        start_profile(ctx, profile_output)
+
+
+def start_profile(ctx, profile_output=None):
+    """ enables instrumentation and reports when command is done """
+    instrument.reset()
+    instrument.enable()
+    profiler = None
+    if profile_output:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.perf_counter()
+
+    def report():
+        wall = time.perf_counter() - start
+        instrument.disable()
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_output)
+        click.echo(instrument.format_report(wall=wall), err=True)
+    ctx.call_on_close(report)
+
+
+def _parser(parse):
+    """ click callback of an option parsed by parse, None is kept """
+    def callback(ctx, param, value):
+        if value is None:
+            return None
+        try:
+            return parse(value)
+        except ValueError as ex:
+            raise click.BadParameter(str(ex))
+    return callback
+
+
+def _size(spec):
+    """ size of parse_rate that has to be more than 0 """
+    size = throttle.parse_rate(spec)
+    if size is None:
+        raise ValueError(f"size {spec} is not more than 0")
+    return int(size)
+
+
+def throttle_options(f):
+    """ options limiting io of a command, a throttle (gar.throttle) is
+    installed while the command runs
+    """
+    @wraps(f)
+    def wrapper(*args, bwlimit, files_limit, schedule, control_file,
+                ionice, **kwargs):
+        if ionice:
+            ioclass, _, level = ionice.partition(":")
+            try:
+                throttle.set_ioprio(ioclass, int(level or 4))
+            except (OSError, ValueError) as ex:
+                raise click.ClickException(f"ionice {ionice}: {ex}")
+        if not (bwlimit or files_limit or schedule or control_file):
+            return f(*args, **kwargs)
+        limits = throttle.Throttle(bandwidth=bwlimit, files=files_limit,
+                                   schedule=schedule,
+                                   control_file=control_file)
+        previous = throttle.install(limits)
+        handler = limits.handle_signal()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            signal.signal(signal.SIGHUP, handler)
+            throttle.install(previous)
+
+    options = [
+        click.option("--bwlimit", callback=_parser(throttle.parse_rate),
+                     help="Limit bytes copied per second, eg.. 50M."),
+        click.option("--files-limit", type=click.FloatRange(min=0),
+                     default=None, help="Limit files copied per second."),
+        click.option("--schedule", callback=_parser(throttle.parse_schedule),
+                     help="Other limits by time of day, eg.. "
+                          "08:00-18:00=20M/100,18:00-20:00=50M "
+                          "(RATE[/FILES] in each window)."),
+        click.option("--control-file", type=click.Path(dir_okay=False),
+                     help="File with limits RATE[/FILES] overriding others "
+                          "while it exists, read again when changed or "
+                          "on SIGHUP."),
+        click.option("--ionice", default=None,
+                     help="IO scheduling class[:level] of the process, "
+                          "eg.. idle or best-effort:7."),
+    ]
+    for option in reversed(options):
+        wrapper = option(wrapper)
+    return wrapper
+
+
+@contextmanager
+def delta_size(size):
+    """ files of at least size in dst are updated with delta transfer
+    (see transfer.delta_copyfile) in the block
+    """
+    previous, transfer.DELTA_SIZE = transfer.DELTA_SIZE, size
+    try:
+        yield
+    finally:
+        transfer.DELTA_SIZE = previous
+
+
+def delta_options(f):
+    """ --delta options of a command, passed as delta (size or None) """
+    @wraps(f)
+    def wrapper(*args, delta, delta_size, **kwargs):
+        return f(*args, delta=delta_size if delta else None, **kwargs)
+    wrapper = click.option(
+        "--delta-size", callback=_parser(throttle.parse_rate), default="64M",
+        show_default=True, help="Smallest file updated with --delta.")(wrapper)
+    return click.option(
+        "--delta", is_flag=True, default=False,
+        help="Update changed large files already in dst by writing only "
+             "blocks that differ.")(wrapper)
+
+
+def store_options(f):
+    """ options of a deduplicating store (gar.dedup) of a command
+    passed as store_dir and store_link
+    """
+    f = click.option("--store-link", type=click.Choice(LINKS),
+                     default="hardlink", show_default=True,
+                     help="Link files to objects of store with hardlinks "
+                          "(objects of files with same attributes) or "
+                          "reflinks (filesystem has to support them).")(f)
+    return click.option("--store", "store_dir",
+                        type=click.Path(file_okay=False), default=None,
+                        help="Store contents of files once in this "
+                             "directory (on filesystem of dst) and link "
+                             "them into dst.")(f)
+
+
+def open_store(stack, store_dir, store_link, dsts):
+    """ enters ObjectStore at store_dir into stack, None without store """
+    if store_dir is None:
+        return None
+    store = stack.enter_context(ObjectStore(store_dir, link=store_link))
+    for dst in dsts:
+        if os.stat(dst).st_dev != os.stat(store_dir).st_dev:
+            raise click.ClickException(f"store: {store_dir} is not on "
+                                       f"filesystem of dst: {dst}")
+    return store
 
 
 def isvalidgroup(group):
@@ -55,8 +225,27 @@ __shorthelp = "Copy files and directories for a group"
 @click.argument("src", type=click.Path(exists=True))
 @click.argument("dst", type=click.Path(exists=True))
 @click.option("--debug/-d", is_flag=True, show_default=True, default=False)
+@click.option("--jobs", "-j", type=click.IntRange(min=1), default=1,
+              show_default=True, help="Number of files copied in parallel.")
+@click.option("--manifest", is_flag=True, default=False,
+              help="Record copied files in a manifest to speed up recopy.")
+@click.option("--trust-manifest/--rescan-dst", default=True,
+              show_default=True,
+              help="Skip files unchanged in manifest without checking "
+                   "dst or check dst anyway.")
+@click.option("--progress", "show_progress", is_flag=True, default=False,
+              help="Show files, bytes, throughput and ETA of copy.")
+@click.option("--status-file", type=click.Path(), default=None,
+              help="Write progress of copy as json to file.")
+@click.option("--resume", is_flag=True, default=False,
+              help="Skip directories completed by an interrupted copy.")
+@store_options
+@delta_options
+@throttle_options
 @pass_cli
-def cli_copy(cli_class, group, src, dst, debug):
+def cli_copy(cli_class, group, src, dst, debug, jobs, manifest,
+             trust_manifest, show_progress, status_file, resume, delta,
+             store_dir, store_link):
     """Archive copy
     Copies files and directories for a group from src to dst
     retaining owner, permissions, and attributes of files and
@@ -70,23 +259,279 @@ def cli_copy(cli_class, group, src, dst, debug):
     #if (lockpath / lockfile).exists():
     #    raise click.ClickException("Another process for group: {group} running?")
     # ensure lock file doesn't exist.
-    with SimpleFileLock(lockfile):
-        gcopy(group, src, dst, logger=cli_class.logger)
+    with SimpleFileLock(lockfile), ExitStack() as stack:
+        stack.enter_context(delta_size(delta))
+        kwargs = {}
+        if manifest:
+            kwargs['manifest'] = stack.enter_context(Manifest(src, dst))
+            kwargs['rescan_dst'] = not trust_manifest
+        journal = stack.enter_context(Journal(src, dst, group=group,
+                                              resume=resume))
+        kwargs['journal'] = journal
+        kwargs['store'] = open_store(stack, store_dir, store_link, [dst])
+        if show_progress or status_file:
+            progress = Progress(stream=sys.stderr if show_progress else None,
+                                status_file=status_file,
+                                group=group, src=src, dst=dst)
+            # totals are counted alongside the copy
+            progress.prescan(src, ignore=partial(ignore_not_group,
+                                                 group_index(group)),
+                             skip=journal.finished)
+            kwargs['progress'] = stack.enter_context(progress)
+        gcopy(group, src, dst, logger=cli_class.logger, workers=jobs,
+              **kwargs)
+    click.echo(f"See log file for errors {logfilepath/'gar.log'}")
+
+def group_dst(ctx, param, value):
+    group_dsts = {}
+    for gd in value:
+        group, sep, dst = gd.partition(":")
+        if not sep or not dst:
+            raise click.BadParameter(f"{gd} is not GROUP:DST")
+        isvalidgroup(group)
+        if not Path(dst).is_dir():
+            raise click.BadParameter(f"dst: {dst} is not a directory")
+        if group in group_dsts:
+            raise click.BadParameter(f"group {group} is repeated")
+        group_dsts[group] = dst
+    return group_dsts
+
+
+@cli.command(name='mcopy', short_help="Copy files for several groups",
+             epilog="Examples:\n\n"
+                    "gar mcopy /path/to/src group1:/path/to/dst1 "
+                    "group2:/path/to/dst2")
+@click.argument("src", type=click.Path(exists=True))
+@click.argument("group_dsts", metavar="GROUP:DST...", nargs=-1,
+                required=True, callback=group_dst)
+@click.option("--jobs", "-j", type=click.IntRange(min=1), default=1,
+              show_default=True, help="Number of files copied in parallel.")
+@click.option("--manifest", is_flag=True, default=False,
+              help="Record copied files in a manifest to speed up recopy.")
+@click.option("--trust-manifest/--rescan-dst", default=True,
+              show_default=True,
+              help="Skip files unchanged in manifest without checking "
+                   "dst or check dst anyway.")
+@click.option("--resume", is_flag=True, default=False,
+              help="Skip directories completed by an interrupted copy.")
+@store_options
+@delta_options
+@throttle_options
+@pass_cli
+def cli_mcopy(cli_class, src, group_dsts, jobs, manifest, trust_manifest,
+              resume, delta, store_dir, store_link):
+    """Archive copy of several groups
+    Copies files and directories of each group from src to its dst
+    in a single scan of src.
+    """
+    for dst in group_dsts.values():
+        if Path(src).resolve() == Path(dst).resolve():
+            raise click.ClickException(f"src: {src} and dst: {dst} are same?")
+    with ExitStack() as stack:
+        stack.enter_context(delta_size(delta))
+        for group in group_dsts:
+            stack.enter_context(SimpleFileLock(f"gar.{getgid(group)}.lock"))
+        manifests = {}
+        if manifest:
+            manifests = {group: stack.enter_context(Manifest(src, dst))
+                         for group, dst in group_dsts.items()}
+        journals = {group: stack.enter_context(Journal(src, dst, group=group,
+                                                       resume=resume))
+                    for group, dst in group_dsts.items()}
+        store = open_store(stack, store_dir, store_link,
+                           group_dsts.values())
+        mgcopy(group_dsts, src, logger=cli_class.logger, workers=jobs,
+               manifests=manifests, journals=journals, store=store,
+               rescan_dst=not trust_manifest)
     click.echo(f"See log file for errors {logfilepath/'gar.log'}")
 
+
+@cli.command(name='move', short_help="Move files and directories for a group",
+             epilog="Examples:\n\n"
+                    "gar move groupname /path/to/src /path/to/dest")
+@click.argument("group", type=isvalidgroup)
+@click.argument("src", type=click.Path(exists=True))
+@click.argument("dst", type=click.Path(exists=True))
+@click.option("--jobs", "-j", type=click.IntRange(min=1), default=1,
+              show_default=True,
+              help="Number of files copied in parallel when dst is "
+                   "on another device.")
+@throttle_options
+@pass_cli
+def cli_move(cli_class, group, src, dst, jobs):
+    """Archive move
+    Moves files and directories for a group from src to dst
+    retaining owner, permissions, and attributes. Directories
+    left empty in src are removed.
+    """
+    if Path(src).resolve() == Path(dst).resolve():
+        raise click.ClickException(f"src: {src} and dst: {dst} are same?")
+    with SimpleFileLock(f"gar.{getgid(group)}.lock"):
+        try:
+            gmove(group, src, dst, logger=cli_class.logger, workers=jobs)
+        except (ValueError, NotADirectoryError) as ex:
+            raise click.ClickException(str(ex))
+    click.echo(f"See log file for errors {logfilepath/'gar.log'}")
+
+
+@cli.command(name='plan', short_help="Plan a copy for a group without copying",
+             epilog="Examples:\n\n"
+                    "gar plan groupname /path/to/src /path/to/dest plan.jsonl")
+@click.argument("group", type=isvalidgroup)
+@click.argument("src", type=click.Path(exists=True))
+@click.argument("dst", type=click.Path())
+@click.argument("planfile", type=click.Path())
+@pass_cli
+def cli_plan(cli_class, group, src, dst, planfile):
+    """Dry run of copy
+    Compares src to dst as copy does and writes actions of the copy
+    with sizes and totals to PLANFILE (json lines), nothing is written
+    to dst. Run the plan with gar apply.
+    """
+    if Path(src).resolve() == Path(dst).resolve():
+        raise click.ClickException(f"src: {src} and dst: {dst} are same?")
+    with open(planfile, "w") as out:
+        try:
+            totals = plan(src, dst, out, logger=cli_class.logger, group=group,
+                          ignore=partial(ignore_not_group, group_index(group)))
+        except OSError as ex:
+            raise click.ClickException(str(ex))
+    for action, (files, size) in totals.items():
+        click.echo(f"{action}: {files} {hr_size(size)}")
+
+
+@cli.command(name='apply', short_help="Run a plan written by gar plan")
+@click.argument("planfile", type=click.Path(exists=True))
+@click.option("--jobs", "-j", type=click.IntRange(min=1), default=1,
+              show_default=True, help="Number of files copied in parallel.")
+@delta_options
+@throttle_options
+@pass_cli
+def cli_apply(cli_class, planfile, jobs, delta):
+    """Run a copy plan
+    Executes actions of PLANFILE without scanning src or dst again.
+    """
+    try:
+        header, _ = read_plan(planfile)
+    except ValueError as ex:
+        raise click.ClickException(str(ex))
+    group = header.get("group")
+    with ExitStack() as stack:
+        stack.enter_context(delta_size(delta))
+        if group is not None:
+            stack.enter_context(SimpleFileLock(f"gar.{getgid(group)}.lock"))
+        apply(planfile, logger=cli_class.logger, workers=jobs)
+    click.echo(f"See log file for errors {logfilepath/'gar.log'}")
+
+
+@cli.command(name='archive', short_help="Stream files of a group into a tar",
+             epilog="Examples:\n\n"
+                    "gar archive --zstd --level 3 groupname /path/to/src "
+                    "/path/to/group.tar.zst")
+@click.argument("group", type=isvalidgroup)
+@click.argument("src", type=click.Path(exists=True, file_okay=False))
+@click.argument("out", type=click.Path(dir_okay=False, allow_dash=True))
+@click.option("--zstd", is_flag=True, default=False,
+              help="Compress with zstd in independent frames, requires "
+                   "python package zstandard.")
+@click.option("--level", type=click.IntRange(1, 22), default=3,
+              show_default=True, help="Level of zstd compression.")
+@click.option("--frame-size", callback=_parser(_size),
+              default="4M", show_default=True,
+              help="Bytes of tar after which a zstd frame ends.")
+@click.option("--index", type=click.Path(dir_okay=False), default=None,
+              help="Index of members for restores [default: OUT.idx, "
+                   "none if OUT is -].")
+@throttle_options
+@pass_cli
+def cli_archive(cli_class, group, src, out, zstd, level, frame_size, index):
+    """Archive into a tar
+    Streams files and directories of a group in src into tar OUT
+    (- for stdout) keeping owner, permissions, times, xattrs, symlinks
+    and hardlinks, with an index of members (see gar extract).
+    """
+    if index is None and out != "-":
+        index = index_path(out)
+    with SimpleFileLock(f"gar.{getgid(group)}.lock"):
+        try:
+            totals = write_archive(
+                src, sys.stdout.buffer if out == "-" else out,
+                ignore=partial(ignore_not_group, group_index(group)),
+                index=index, level=level if zstd else None,
+                framesize=frame_size,
+                logger=cli_class.logger)
+        except ValueError as ex:
+            raise click.ClickException(str(ex))
+    click.echo(f"Archived {totals['members']} members "
+               f"{hr_size(totals['bytes'])} written "
+               f"{hr_size(totals['written'])}", err=True)
+
+
+@cli.command(name='extract', short_help="Restore a member of an archive")
+@click.argument("archive", type=click.Path(exists=True, dir_okay=False))
+@click.argument("member")
+@click.argument("dst", type=click.Path(exists=True, file_okay=False))
+@click.option("--index", type=click.Path(exists=True, dir_okay=False),
+              default=None, help="Index of archive [default: ARCHIVE.idx].")
+@pass_cli
+def cli_extract(cli_class, archive, member, dst, index):
+    """Restore from an archive
+    Restores MEMBER of ARCHIVE written by gar archive into DST, seeking
+    to it with the index instead of reading the archive from start.
+    """
+    try:
+        path = extract_member(archive, member, dst, index=index,
+                              logger=cli_class.logger)
+    except KeyError as ex:
+        raise click.ClickException(ex.args[0])
+    except (ValueError, FileNotFoundError) as ex:
+        raise click.ClickException(str(ex))
+    click.echo(path)
+
+
 @cli.command(name="verify")
 @click.argument("src", type=click.Path(exists=True))
 @click.argument("dst", type=click.Path(exists=True))
-def cli_verify(src, dst):
+@click.option("--checksum", is_flag=True, default=False,
+              help="Also compare contents of files using checksums.")
+@click.option("--algorithm", type=click.Choice(ALGORITHMS), default="sha256",
+              show_default=True, help="Checksum used with --checksum.")
+@click.option("--jobs", "-j", type=click.IntRange(min=1), default=None,
+              help="Number of threads comparing directories and "
+                   "processes computing checksums.")
+@click.option("--max-inflight", type=click.IntRange(min=1), default=1024,
+              show_default=True,
+              help="MiB of files being checksummed at a time.")
+@click.option("--skip-same", is_flag=True, default=False,
+              help="With --checksum, don't read files of subtrees with "
+                   "same digests (of attributes of entries) in src and "
+                   "dst.")
+@click.option("--dedup", is_flag=True, default=False,
+              help="dst was copied with --store, copies of different "
+                   "files can be hardlinks.")
+def cli_verify(src, dst, checksum, algorithm, jobs, max_inflight, skip_same,
+               dedup):
     """ Verifies integrity of an archive by comparing
     src to dst.
     """
     if Path(src).resolve() == Path(dst).resolve():
         raise click.ClickException(f"src: {src} and dst: {dst} are same?")
-    compare = verify(src, dst)
-    for k in compare:
-        for v in compare[k]:
-            print(k, v, sep=": ", file=sys.stdout)
+    # digests take a pass over both trees, only reads of files are saved
+    if skip_same and not checksum:
+        raise click.UsageError("--skip-same requires --checksum")
+    checksum = algorithm if checksum else None
+    sparse = []
+    try:
+        for r in iverify(src, dst, checksum=checksum, workers=jobs,
+                         max_inflight=max_inflight * 1024 * 1024,
+                         sparse=sparse, skip_same=skip_same, dedup=dedup):
+            print(r.status, r.astuple(), sep=": ", file=sys.stdout)
+    except ValueError as ex:
+        raise click.ClickException(str(ex))
+    # sizes on disk of sparse files
+    for s, d, size, salloc, dalloc in sparse:
+        print("Sparse", (s, d), f"size {hr_size(size)} "
+              f"src {hr_size(salloc)} dst {hr_size(dalloc)}", sep=": ")
 
 if __name__ == "__main__":
     cli()
@@ -1,70 +1,88 @@
 import os
+import errno
+import logging
 from os import DirEntry
 import shutil
-from shutil import copy2 as scopy
 from pathlib import Path
 from functools import partial
+from collections import namedtuple
 from shutil import SameFileError, SpecialFileError
-from .utils import cp_stat, cp_dirstat, user_in_group, dircmp, getgid
+from threading import BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from . import transfer
+from . import instrument
+from .walk import scantree, Entry, DIR, POST
+from .checksum import ChecksumPool, MAX_INFLIGHT
+from .utils import cp_stat, cp_dirstat, group_index, GroupIndex
+from .utils import idircmp, pdircmp, ilinkcmp, isparsecmp, collect_cmp
+from .utils import CmpResult
+from .utils import MATCH, MISMATCH, SKIP
+
+
+def _entry_stat(fdpath, follow_symlinks=False):
+    """ stat of a path or cached stat of a (os or walk) DirEntry """
+    if isinstance(fdpath, (DirEntry, Entry)):
+        return fdpath.stat(follow_symlinks=follow_symlinks)
+    try:
+        return os.stat(fdpath, follow_symlinks=follow_symlinks)
+    # this can raise file not found for .stat() when target to symlink
+    # doesn't exist, dangling links are handled as links
+    except FileNotFoundError:
+        if not follow_symlinks:
+            raise
+        return os.lstat(fdpath)
 
 
 def set_owner_mode_xattr(src, dst, follow_symlinks=False):
 
-    if isinstance(src, DirEntry):
-        src_stat = src.stat(follow_symlinks=follow_symlinks)
-    else:
-        src = Path(src)
-        if src.is_symlink():
-            src_stat = src.stat() if (follow_symlinks and src.exists()) else src.lstat()
-        else:
-            src_stat = src.stat()
-
-    if isinstance(dst, DirEntry):
-        dst_stat = dst.stat(follow_symlinks=follow_symlinks)
-    else:
-        dst = Path(dst)
-        # this can raise file not found for .stat() when target to symlink
-        # doesn't exist handle this by adding option ignore dangling links
-        if dst.is_symlink():
-            dst_stat = dst.stat() if (follow_symlinks and dst.exists()) else dst.lstat()
-        else:
-            dst_stat = dst.stat()
+    src_stat = _entry_stat(src, follow_symlinks=follow_symlinks)
+    dst_stat = _entry_stat(dst, follow_symlinks=follow_symlinks)
     # set mode and extra attributes
     if not (src_stat.st_mode == dst_stat.st_mode):
         # try except not necessary?
-        os.chmod(dst, mode=src_stat.st_mode)
-        shutil._copyxattr(src, dst, follow_symlinks=follow_symlinks)
+        with instrument.timer("chmod"):
+            os.chmod(dst, mode=src_stat.st_mode)
+        with instrument.timer("xattr"):
+            shutil._copyxattr(src, dst, follow_symlinks=follow_symlinks)
 
     # set time atime, mtime
     src_times = (src_stat.st_atime_ns, src_stat.st_mtime_ns)
     dst_times = (dst_stat.st_atime_ns, dst_stat.st_mtime_ns)
 
     if not src_times == dst_times:
-        os.utime(dst, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns),
-                 follow_symlinks=follow_symlinks)
+        with instrument.timer("utime"):
+            os.utime(dst, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns),
+                     follow_symlinks=follow_symlinks)
 
     # change ownership
-    isuser = (src_stat.st_uid == os.getuid())
-    isgroup = (src_stat.st_gid == os.getgid())
-    # if file is not owned by user running the program
+    isuser = (src_stat.st_uid == dst_stat.st_uid)
+    isgroup = (src_stat.st_gid == dst_stat.st_gid)
+    # if dst (created by user running the program) is not owned by owner of src
     if not (isuser and isgroup):
         try:
-            os.chown(dst, src_stat.st_uid, src_stat.st_gid,
-                     follow_symlinks=follow_symlinks)
+            with instrument.timer("chown"):
+                os.chown(dst, src_stat.st_uid, src_stat.st_gid,
+                         follow_symlinks=follow_symlinks)
         except PermissionError as ex:
             raise PermissionError(f"Mismatch: {ex.filename} "
                                   "ownership cannot be assigned.")
 
 
-def log_or_print(msg, logger=None):
-    """ print or log 
+def log_or_print(msg, logger=None, level=logging.INFO, aggregate=None,
+                 path=None):
+    """ log msg with level or print it if there is no logger
     only one is allowed if both is required ass stdout
     handler to logger
+    messages repeated for many files pass aggregate (a kind eg..
+    'unchanged') and path of the file, they are logged as summaries
+    (see gar.logger.AggregateFilter).
     """
-    if logger:
+    if logger is None:
         print(msg)
+    elif aggregate:
+        logger.log(level, msg, extra={"aggregate": aggregate, "path": path})
     else:
-        print(msg)
+        logger.log(level, msg)
 
 
 def handle_exception(ex, fi=None, fi_dst=None, logger=None):
@@ -78,34 +96,244 @@ def handle_exception(ex, fi=None, fi_dst=None, logger=None):
 
     if type(ex) == SameFileError:
         msg = f"Skipping: {str(fi.path)} and {str(fi_dst)} are same."
-        log_or_print(msg, logger=logger)
+        log_or_print(msg, logger=logger, level=logging.WARNING)
     elif type(ex) == SpecialFileError:
         msg = f"Skipping: {str(fi.path)} is a unsupported file."
-        log_or_print(msg, logger=logger)
+        log_or_print(msg, logger=logger, level=logging.WARNING)
     elif type(ex) == PermissionError:
         msg = f"{ex}\n"\
                "\tHint: Do you have enough permissions "\
                "to change file ownership?"
-        log_or_print(msg, logger=logger)
+        log_or_print(msg, logger=logger, level=logging.WARNING)
     elif type(ex) == FileNotFoundError:
         msg = f"Skipping: {ex}\n"\
                "\t Hint: Possible racing condition?"
-        log_or_print(msg, logger=logger)
+        log_or_print(msg, logger=logger, level=logging.WARNING)
     elif type(ex) == OSError:
         msg = f"{ex}"
-        log_or_print(ex, logger=logger)
+        log_or_print(msg, logger=logger, level=logging.WARNING)
     # handle any instance of IOError
     elif isinstance(ex, IOError):
         msg = f"{ex}\n\tHint: Disk out of space?"
-        log_or_print(msg, logger=logger)
+        log_or_print(msg, logger=logger, level=logging.WARNING)
     # all other exceptions are logged as 
     else:
         msg = f"{ex}\n CRITICAL: an unknown exception to the program, "\
                "please raise an issue with developers."
-        log_or_print(msg, logger=logger)
+        log_or_print(msg, logger=logger, level=logging.ERROR)
+
+
+def transfer_file(fi, fi_dst, logger=None):
+    """ Copies data and mode of fi to fi_dst and records
+    transfer method used for the file.
+    """
+    with instrument.timer("transfer"):
+        method = transfer.copy(fi, fi_dst, follow_symlinks=False)
+    instrument.count("files_copied")
+    instrument.count("bytes_copied", fi.stat().st_size)
+    if logger:
+        logger.debug(f"Copied: {fi.path} to {fi_dst} using {method}")
+    return method
+
+
+def stat_changes(sstat, dstat):
+    """ Classifies differences of a file with stat sstat to its copy
+    with stat dstat, returns (content, metadata) where content is True
+    if data has to be copied (size or modified time differ) and metadata
+    is True if owner, group or mode differ.
+    """
+    content = (sstat.st_size != dstat.st_size or
+               sstat.st_mtime_ns != dstat.st_mtime_ns)
+    metadata = (sstat.st_uid != dstat.st_uid or
+                sstat.st_gid != dstat.st_gid or
+                sstat.st_mode != dstat.st_mode)
+    return content, metadata
+
+
+def copy_file(fi, fi_dst, logger=None, manifest=None, rescan_dst=False,
+              progress=None, store=None):
+    """ Copies a regular file fi to fi_dst with its attributes,
+    recopies only if contents of file differ from an existing fi_dst
+    and only updates attributes if just they differ (see stat_changes).
+
+    with a manifest (see gar.manifest) files are skipped if stat of fi is
+    same as when it was last copied, without stat-ing fi_dst. rescan_dst
+    compares to fi_dst anyway and only updates the manifest.
+
+    progress (gar.progress.Progress) is updated when file is done.
+    with a store (gar.dedup.ObjectStore) fi_dst is linked to an object
+    with contents of fi instead of copied.
+    Returns 'copied', 'updated' (attributes) or 'skipped'.
+    """
+    action = _copy_file(fi, fi_dst, logger=logger, manifest=manifest,
+                        rescan_dst=rescan_dst, store=store)
+    if progress is not None:
+        size = fi.stat().st_size
+        progress.update(1, size, size if action == 'copied' else 0)
+    return action
+
+
+def file_action(fi, fi_dst, manifest=None, rescan_dst=False):
+    """ Decides how copy_file handles a regular file fi
+    returns (action, stat of fi_dst or None) where action is 'copied'
+    if data has to be copied, 'updated' if only attributes differ
+    (see stat_changes), 'skipped' if fi_dst is same or 'unchanged' if
+    stat of fi is same as recorded in manifest (fi_dst is not stat-ed).
+    """
+    if manifest is not None and not rescan_dst and \
+            manifest.unchanged(manifest.key(fi), fi.stat()):
+        return 'unchanged', None
+    try:
+        dstat = os.stat(fi_dst)
+    except FileNotFoundError:
+        return 'copied', None
+    # handle recopy
+    content, metadata = stat_changes(fi.stat(), dstat)
+    # copy and change attributes only if contents differ
+    action = 'copied' if content else 'updated' if metadata else 'skipped'
+    return action, dstat
+
+
+def _copy_file(fi, fi_dst, logger=None, manifest=None, rescan_dst=False,
+               store=None):
+    action, dstat = file_action(fi, fi_dst, manifest=manifest,
+                                rescan_dst=rescan_dst)
+    if action == 'unchanged':
+        instrument.count("files_skipped")
+        msg = f"Skipping: {str(fi_dst)} unchanged since last copy."
+        log_or_print(msg, logger=logger, aggregate="unchanged",
+                     path=fi_dst)
+        return 'skipped'
+    # attributes of hardlinked objects are shared, file is linked again
+    if action == 'updated' and store is not None and store.hardlink:
+        action = 'copied'
+    # a file with other links (eg.. to an object of a store) shares its
+    # contents and attributes, it is replaced instead of changed
+    shared = dstat is not None and dstat.st_nlink > 1
+    if action == 'updated' and shared:
+        action = 'copied'
+    if action == 'copied' and store is not None:
+        store.place(fi, fi_dst, logger=logger)
+    elif action == 'copied':
+        # handle files that have only read permissions
+        # copy function needs write access
+        # so remove the file and recopy
+        if shared or dstat is not None and not os.access(fi_dst, os.W_OK):
+            os.unlink(fi_dst)
+        transfer_file(fi, fi_dst, logger=logger)
+        set_owner_mode_xattr(fi, fi_dst)
+    # only change attributes in place
+    elif action == 'updated':
+        set_owner_mode_xattr(fi, fi_dst)
+        instrument.count("files_updated")
+        if logger:
+            logger.debug(f"Updated: attributes of {fi_dst}")
+    else:
+        instrument.count("files_skipped")
+        msg = f"Skipping: {str(fi_dst)} exists and unchanged "\
+               "to attempted copy."
+        log_or_print(msg, logger=logger, aggregate="unchanged",
+                     path=fi_dst)
+    if manifest is not None:
+        manifest.record(manifest.key(fi), fi.stat())
+    return action
+
+
+class InodeMap:
+    """ Maps (st_dev, st_ino) of files with several hardlinks to their
+    first copy, later links to the same inode are linked to it instead
+    of copied. the copy is a path and True or a Future of its copy.
+    """
+    def __init__(self):
+        self.inodes = {}
+
+    def first(self, fi):
+        """ returns path to copy of another link of fi or None """
+        if not self.inodes or fi.is_symlink():
+            return None
+        st = fi.stat(follow_symlinks=False)
+        key = (st.st_dev, st.st_ino)
+        # last link of inode (others can be moved already)
+        first = self.inodes.pop(key, None) if st.st_nlink < 2 \
+            else self.inodes.get(key)
+        if first is None:
+            return None
+        path, result = first
+        if isinstance(result, Future):
+            result = result.result()
+        if not result:
+            # copy failed, fi is copied instead
+            self.inodes.pop(key, None)
+            return None
+        return path
+
+    def add(self, fi, fi_dst, result=True):
+        st = fi.stat(follow_symlinks=False)
+        if st.st_nlink > 1 and not fi.is_symlink():
+            self.inodes[(st.st_dev, st.st_ino)] = (fi_dst, result)
+
+
+def link_file(fi, first, fi_dst, logger=None, progress=None):
+    """ Recreates fi_dst as a hardlink to first, the copy of another
+    link to the inode of fi.
+    Returns 'linked' or 'skipped' if already linked.
+    """
+    fstat = os.lstat(first)
+    try:
+        dstat = os.lstat(fi_dst)
+    except FileNotFoundError:
+        dstat = None
+    if dstat is not None and \
+            (dstat.st_dev, dstat.st_ino) == (fstat.st_dev, fstat.st_ino):
+        action = 'skipped'
+        instrument.count("files_skipped")
+    else:
+        if dstat is not None:
+            os.unlink(fi_dst)
+        with instrument.timer("link"):
+            os.link(first, fi_dst)
+        instrument.count("files_linked")
+        action = 'linked'
+        if logger:
+            logger.debug(f"Linked: {fi_dst} to {first}")
+    if progress is not None:
+        progress.update(1, fi.stat().st_size)
+    return action
+
+
+class CopyPool:
+    """ Bounded pool of worker threads for copying files
+    at most `queuesize` tasks are queued or running, submit
+    blocks directory scanning until a slot is free.
+    exceptions of tasks are handled with handle_exception.
+    """
+    def __init__(self, workers, queuesize=None, logger=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = BoundedSemaphore(queuesize or workers * 4)
+        self.logger = logger
+
+    def _run(self, fn, fi, fi_dst, **kwargs):
+        try:
+            return fn(fi, fi_dst, **kwargs)
+        except Exception as ex:
+            handle_exception(ex, fi, fi_dst, self.logger)
+        finally:
+            self.slots.release()
+
+    def submit(self, fn, fi, fi_dst, **kwargs):
+        self.slots.acquire()
+        return self.executor.submit(self._run, fn, fi, fi_dst, **kwargs)
+
+    def __enter__(self):
+        return self
 
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.executor.shutdown(wait=True)
 
-def copy(src, dst, ignore=None, logger=None, **kwargs):
+
+def copy(src, dst, ignore=None, logger=None, workers=None, manifest=None,
+         rescan_dst=False, progress=None, journal=None, store=None,
+         **kwargs):
     """
     Copies from files and directories from
     `source` to `destination` retaining directory
@@ -125,142 +353,227 @@ def copy(src, dst, ignore=None, logger=None, **kwargs):
 
     logger allows logging to a remote logger.
 
-    directories are scanned using scandir for efficiency reasons.
+    workers > 1 copies files in parallel with a pool of threads, attributes
+    of a directory are set only after all of its files are copied.
+
+    manifest (gar.manifest.Manifest) skips files unchanged since last
+    copy from stat of src alone, rescan_dst checks files in dst anyway.
+
+    progress (gar.progress.Progress) is updated as files are done.
+
+    journal (gar.journal.Journal) records directories when done and
+    directories it recorded before (when resumed) are skipped.
+
+    store (gar.dedup.ObjectStore) keeps contents of files once and
+    files in dst are hardlinks (or reflinks) to its objects.
+
+    directories are walked without recursion with walk.scantree, stat of
+    each entry is taken once and used for ignore, copy and attributes.
 
     Returns dst
     """
+    copy_targets(src, [Target(dst, ignore, manifest, journal, store)],
+                 logger=logger, workers=workers, rescan_dst=rescan_dst,
+                 progress=progress, **kwargs)
+    return Path(dst)
+
+
+class Target(namedtuple("Target", ["dst", "ignore", "manifest", "journal",
+                                   "store"])):
+    """ A destination of copy_targets with its own ignore, manifest,
+    journal and store
+    """
+    __slots__ = ()
+
+    def __new__(cls, dst, ignore=None, manifest=None, journal=None,
+                store=None):
+        return super().__new__(cls, Path(dst), ignore, manifest, journal,
+                               store)
+
+
+def copy_targets(src, targets, logger=None, workers=None, rescan_dst=False,
+                 progress=None, **kwargs):
+    """
+    Copies src to several destinations (list of Target) in a single walk
+    of src, each file is copied to every target that doesn't ignore it.
+    see copy for other arguments.
+
+    Returns list of dst of targets
+    """
     if logger:
         logger.__setattr__("name", "copy")
 
-    # To a identify not in reccursive call/ first call to function
-    # else src will be direntry
-    if 'scope' not in kwargs:
-        src = Path(src)
-        kwargs['scope'] = str(os.path.realpath(src))
+    src = Path(src)
+    scope = kwargs.get('scope', str(os.path.realpath(src)))
+    if workers and workers > 1 and 'pool' not in kwargs:
+        with CopyPool(workers, logger=logger) as pool:
+            return copy_targets(src, targets, logger=logger,
+                                rescan_dst=rescan_dst, progress=progress,
+                                pool=pool, scope=scope)
+    pool = kwargs.get('pool')
 
     # discard scanning directories and files that are not readable
     if not os.access(src, os.R_OK):
-        raise OSError(f"Skipping: directory {src.path} "
+        raise OSError(f"Skipping: directory {src} "
                       "cannot be read by current user.")
 
-    dst = Path(dst)
-
     # disable the function for src that is not a directory
     if src.is_file():
         raise NotADirectoryError(f"src {str(src)} is a file, "
                                  "pass a directory.")
 
-    if not dst.exists():
-        os.mkdir(dst)
-
-    # enquiring file stat on DirEntry of scandir is
-    # siginicantly faster then using scr.iterdir()
-    # or os.walk()
-    for fi in os.scandir(src):
-        # is contains enough space?
-        # filter for files
-        # ignore only files otherwise scanning dirs owned
-        # by root is not possible
-        try:
-            if ignore:
-                # temporary fix fi.is_file() doesnt work when not R_OK
-                if not os.access(fi, os.R_OK):
-                    continue
-                if fi.is_file() and ignore(fi):
+    for target in targets:
+        if not target.dst.exists():
+            os.mkdir(target.dst)
+
+    # of every target destination and files being copied by pool
+    # of directories being walked, None if target skips directory
+    frames = [[(target.dst, []) for target in targets]]
+    # of hardlinked files copied to each target
+    links = [InodeMap() for target in targets]
+
+    def enter(di):
+        frame = []
+        for target, parent in zip(targets, frames[-1]):
+            if parent is None:
+                frame.append(None)
+                continue
+            di_dst = parent[0] / di.name
+            # done before the job was resumed
+            if target.journal and target.journal.finished(di):
+                frame.append(None)
+                continue
+            try:
+                if not di.readable():
+                    if target.ignore:
+                        frame.append(None)
+                        continue
+                    raise OSError(f"Skipping: {di.path} file cannot be read.")
+                if not di_dst.exists():
+                    os.mkdir(di_dst)
+                frame.append((di_dst, []))
+            except Exception as ex:
+                handle_exception(ex, di, None, logger)
+                frame.append(None)
+        if not any(frame):
+            return False
+        frames.append(frame)
+        return True
+
+    def onerror(di, ex):
+        handle_exception(ex, di, None, logger)
+
+    for event, fi in scantree(src, enter=enter, onerror=onerror):
+        if event == DIR:
+            continue
+        if event == POST:
+            for target, current in zip(targets, frames.pop()):
+                if current is None:
                     continue
+                di_dst, pending = current
+                # wait for files before setting times of directory
+                wait(pending)
+                try:
+                    set_owner_mode_xattr(fi, di_dst)
+                    # remove empty directories that are ignored
+                    if target.ignore and target.ignore(fi):
+                        try:
+                            di_dst.rmdir()
+                        except OSError:
+                            pass
+                    if target.journal:
+                        target.journal.record(fi)
+                except Exception as ex:
+                    handle_exception(ex, fi, None, logger)
+            continue
 
-            fi_dst = dst / fi.name
-
-            if not os.access(fi, os.R_OK):
-                raise OSError(f"Skipping: {fi.path} file cannot be read.")
-            if fi.is_symlink():
-                # to check if the link in scope of original src
-                # use os.readlink(fi) instead?
-                commonpath = os.path.commonpath([os.path.realpath(fi),
-                                                 kwargs['scope']])
-                # check if target of link is within original src
-                # if so dont copy, just link
-                if commonpath == kwargs['scope']:
-                    newrelpath = os.path.relpath(os.path.realpath(fi), src)
-                    # handle below better for recopy, link could have changed
-                    if not fi_dst.exists():
-                        os.symlink(newrelpath, fi_dst)
-                    # times/ownership of source link are retained.
-                    set_owner_mode_xattr(fi, fi_dst)
-
-                # file outside the scope of original src
-                # copy and maintain the out-of-scope symlink
-                else:
-                    # TODO: new symlink with absolute path?
-                    shutil.copy2(fi, fi_dst, follow_symlinks=False)
-                    set_owner_mode_xattr(fi, fi_dst)
-            elif fi.is_dir():
-                # reccursive call to copy
-                copy(fi, fi_dst, ignore=ignore, logger=logger, **kwargs)
-                set_owner_mode_xattr(fi, fi_dst)
-            # all regular files
-            # if file type is not supported for coping
-            # raises error
-            elif fi.is_file():
-                # handle recopy
-                if fi_dst.exists():
-                    sstat = fi.stat()
-                    dstat = fi_dst.stat()
-
-                    sstatcmp = [sstat.st_uid, sstat.st_gid, sstat.st_mode,
-                                sstat.st_size,
-                                sstat.st_mtime_ns]
-                    dstatcmp = [dstat.st_uid, dstat.st_gid, dstat.st_mode,
-                                dstat.st_size,
-                                dstat.st_mtime_ns]
-
-                    # handle files that have only read permissions
-                    # copy function needs write access
-                    # so remove the file and recopy
-                    if not os.access(fi_dst, os.W_OK):
-                        os.unlink(fi_dst)
-                        shutil.copy(fi, fi_dst, follow_symlinks=False)
+        for target, current, inodes in zip(targets, frames[-1], links):
+            if current is None:
+                continue
+            ignore = target.ignore
+            fi_dst = current[0] / fi.name
+            # is contains enough space?
+            # filter for files
+            # ignore only files otherwise scanning dirs owned
+            # by root is not possible
+            try:
+                if ignore:
+                    if not fi.readable():
+                        continue
+                    if fi.is_file() and ignore(fi):
+                        continue
+
+                if not fi.readable():
+                    raise OSError(f"Skipping: {fi.path} file cannot be read.")
+                if fi.is_symlink():
+                    newrelpath = symlink_target(fi, scope)
+                    # check if target of link is within original src
+                    # if so dont copy, just link
+                    if newrelpath is not None:
+                        # handle below better for recopy, link could have changed
+                        if not os.path.lexists(fi_dst):
+                            os.symlink(newrelpath, fi_dst)
+                        # times/ownership of source link are retained.
                         set_owner_mode_xattr(fi, fi_dst)
-                    # copy and change attributes only if files differ
-                    if not sstatcmp == dstatcmp:
-                        shutil.copy(fi, fi_dst, follow_symlinks=False)
+
+                    # file outside the scope of original src
+                    # copy and maintain the out-of-scope symlink
+                    else:
+                        # TODO: new symlink with absolute path?
+                        shutil.copy2(fi, fi_dst, follow_symlinks=False)
                         set_owner_mode_xattr(fi, fi_dst)
+                # all regular files
+                # if file type is not supported for coping
+                # raises error
+                elif fi.is_file():
+                    first = inodes.first(fi)
+                    if first is not None:
+                        link_file(fi, first, fi_dst, logger=logger,
+                                  progress=progress)
+                    elif pool:
+                        future = pool.submit(
+                            copy_file, fi, fi_dst, logger=logger,
+                            manifest=target.manifest, rescan_dst=rescan_dst,
+                            progress=progress, store=target.store)
+                        current[1].append(future)
+                        inodes.add(fi, fi_dst, future)
                     else:
-                        msg = f"Skipping: {str(fi_dst)} exists and unchanged "\
-                               "to attempted copy."
-                        log_or_print(msg, logger=logger)
+                        copy_file(fi, fi_dst, logger=logger,
+                                  manifest=target.manifest,
+                                  rescan_dst=rescan_dst, progress=progress,
+                                  store=target.store)
+                        inodes.add(fi, fi_dst)
                 else:
-                    shutil.copy(fi, fi_dst, follow_symlinks=False)
-                    set_owner_mode_xattr(fi, fi_dst)
-            else:
-                msg = f"Skipping: {str(fi.path)} is a unsupported file."
-                log_or_print(msg, logger=logger)
-
-            if ignore:
-                # check if dir not ignored is empty is so remove
-                if fi.is_dir() and ignore(fi):
-                    try:
-                        fi_dst.rmdir()
-                    except OSError:
-                        pass
-        except Exception as ex:
-            handle_exception(ex, fi, None, logger)
-        # remove empty directories that are ignored
-    try:
-        if not os.path.realpath(src) == kwargs['scope']:
-            set_owner_mode_xattr(src, dst)
-    except Exception as ex:
-        handle_exception(ex, src, dst, logger)
-    return dst
+                    msg = f"Skipping: {str(fi.path)} is a unsupported file."
+                    log_or_print(msg, logger=logger, level=logging.WARNING)
+            except Exception as ex:
+                handle_exception(ex, fi, None, logger)
+    for _, pending in frames[0]:
+        wait(pending)
+    return [target.dst for target in targets]
+
+
+def symlink_target(fi, scope):
+    """ Returns target for copy of symlink fi, a path relative to fi of
+    its target if target is within scope (real path of src) or None if
+    it is out of scope and link is copied as it is.
+    """
+    # to check if the link in scope of original src
+    # use os.readlink(fi) instead?
+    realpath = os.path.realpath(fi)
+    if os.path.commonpath([realpath, scope]) == scope:
+        return os.path.relpath(realpath, os.path.dirname(fi.path))
+    return None
 
 
 def ignore_not_group(group, srcfile, ignorefilegroup=True):
     """ srcfile must be a pathlib.Path object
         default checks based on owner of file in group
         checkfilegroup chgrp
+        group can be a name, gid or a prebuilt utils.GroupIndex
         returns True to ignore and False if not
     """
-    if isinstance(srcfile, DirEntry):
+    if isinstance(srcfile, (DirEntry, Entry)):
         src_stat = srcfile.stat(follow_symlinks=False)
     else:
         srcfile = Path(srcfile)
@@ -268,104 +581,270 @@ def ignore_not_group(group, srcfile, ignorefilegroup=True):
             raise FileNotFoundError("File doesn't exist", srcfile)
         src_stat = srcfile.lstat() if srcfile.is_symlink() else srcfile.stat()
 
-    uig = user_in_group(src_stat.st_uid, group)
-    # return false owner in group
-    if ignorefilegroup:
-        return not uig
-    else:
-        gid = getgid(group)
-        return not (src_stat.st_gid == gid or uig)
-
+    with instrument.timer("group_filter"):
+        if not isinstance(group, GroupIndex):
+            group = group_index(group)
+        # return false owner in group
+        return not group.owns(src_stat, ignorefilegroup=ignorefilegroup)
 
-def gcopy(group, src, dst, logger=None):
-    """TODO:handle skip from cli"""
-    ignore_fn = partial(ignore_not_group, group)
-    copy(src, dst, ignore=ignore_fn, logger=logger)
 
-
-def verify(src, dst, ignore=None):
-    """ returns a dictionary
+def gcopy(group, src, dst, logger=None, **kwargs):
+    """TODO:handle skip from cli
+    kwargs are passed to copy
+    """
+    ignore_fn = partial(ignore_not_group, group_index(group))
+    copy(src, dst, ignore=ignore_fn, logger=logger, **kwargs)
+
+
+def mgcopy(group_dsts, src, logger=None, manifests=None, journals=None,
+           store=None, **kwargs):
+    """ Copies files of several groups from src in a single walk of src
+    group_dsts maps each group to its destination, an entry is copied to
+    destinations of groups its owner is a member of.
+    manifests can map groups to their manifest (gar.manifest.Manifest)
+    and journals to their journal (gar.journal.Journal).
+    store (gar.dedup.ObjectStore) is shared by all groups.
+    kwargs are passed to copy_targets
+    """
+    manifests = manifests or {}
+    journals = journals or {}
+    targets = [Target(dst, partial(ignore_not_group, group_index(group)),
+                      manifests.get(group), journals.get(group), store)
+               for group, dst in group_dsts.items()]
+    return copy_targets(src, targets, logger=logger, **kwargs)
+
+
+def iverify(src, dst, ignore=None, checksum=None, workers=None,
+            max_inflight=None, sparse=None, skip_same=False, dedup=False):
+    """ yields utils.CmpResult of files and directories as they are compared
+    workers > 1 compares directories in parallel (see utils.pdircmp).
+    checksum (one of gar.checksum.ALGORITHMS) also compares contents
+    of matching files in a pool of workers reading at most max_inflight
+    bytes at a time, files that differ in content are a Mismatch.
+    hardlinks of src not linked alike in dst are a Mismatch (see
+    utils.ilinkcmp).
+    sizes of files sparse in src or dst are appended to list sparse
+    (see utils.isparsecmp).
+    skip_same skips subtrees with same merkle digests in src and dst
+    (see utils.idircmp), it pays off with checksum as digests are
+    computed in a pass over both trees.
+    dedup allows copies of different files to be linked (gar.dedup).
     """
     src = Path(src)
     dst = Path(dst)
     if not (src.is_dir() and dst.is_dir()):
         raise NotADirectoryError(f"src: {src} and dst: {dst} must be directories")
-    match, mismatch, miss, skip = dircmp(src, dst, ignore=ignore)
+    if workers and workers > 1:
+        results = pdircmp(src, dst, ignore=ignore, workers=workers,
+                          skip_same=skip_same)
+    else:
+        results = idircmp(src, dst, ignore=ignore, skip_same=skip_same)
+    results = ilinkcmp(results, dedup=dedup)
+    if sparse is not None:
+        results = isparsecmp(results, sparse)
+    if not checksum:
+        yield from results
+        return
+
+    def content_results(compared):
+        for s, d, same in compared:
+            if same is None:
+                yield CmpResult(SKIP, 'content', s, d)
+            elif same:
+                yield CmpResult(MATCH, 'file', s, d)
+            else:
+                yield CmpResult(MISMATCH, 'content', s, d)
+
+    with ChecksumPool(checksum, workers,
+                      max_inflight or MAX_INFLIGHT) as pool:
+        for r in results:
+            if (r.status == MATCH and r.kind == 'file'
+                    and not os.path.islink(r.src)):
+                yield from content_results(pool.submit(r.src, r.dst))
+            else:
+                yield r
+        yield from content_results(pool.finish())
+
+
+def verify(src, dst, ignore=None, **kwargs):
+    """ returns a dictionary
+    Sparse lists (src, dst, logical size, allocated size of src,
+    allocated size of dst) of sparse files.
+    kwargs are passed to iverify
+    """
+    sparse = []
+    match, mismatch, miss, skip = collect_cmp(iverify(src, dst, ignore=ignore,
+                                                      sparse=sparse,
+                                                      **kwargs))
     compare = {'Match': match,
                'Mismatch': mismatch,
                'Miss': miss,
-               'Skipped': skip}
+               'Skipped': skip,
+               'Sparse': sparse}
     return compare
 
 
-def gverify(group, src, dst):
-    ignore_fn = partial(ignore_not_group, group)
-    return verify(src, dst, ignore=ignore_fn)
+def gverify(group, src, dst, **kwargs):
+    """ kwargs are passed to verify """
+    ignore_fn = partial(ignore_not_group, group_index(group))
+    return verify(src, dst, ignore=ignore_fn, **kwargs)
+
+
+def igverify(group, src, dst, **kwargs):
+    """ kwargs are passed to iverify """
+    ignore_fn = partial(ignore_not_group, group_index(group))
+    return iverify(src, dst, ignore=ignore_fn, **kwargs)
+
+
+def _move_file(fi, fi_dst, logger=None):
+    """ Copies fi to fi_dst on another device, returns True when
+    size, modified time, owner and mode of the copy match fi and so
+    fi can be unlinked.
+    """
+    sstat = fi.stat(follow_symlinks=False)
+    if os.path.lexists(fi_dst) and \
+            (fi.is_symlink() or not os.access(fi_dst, os.W_OK)):
+        os.unlink(fi_dst)
+    if fi.is_symlink():
+        transfer.copy(fi, fi_dst, follow_symlinks=False)
+    else:
+        transfer_file(fi, fi_dst, logger=logger)
+    set_owner_mode_xattr(fi, fi_dst)
+    content, metadata = stat_changes(sstat, os.lstat(fi_dst))
+    if content or metadata:
+        raise OSError(f"Mismatch: {fi_dst} differs from moved {fi.path}, "
+                      "source is kept.")
+    return True
+
+
+def _unlink_moved(pending, logger=None):
+    """ unlinks sources of files moved to another device, pending is
+    list of (Entry, result of _move_file or its Future)
+    """
+    for fi, result in pending:
+        try:
+            if isinstance(result, Future):
+                result = result.result()
+            if result:
+                os.unlink(fi)
+        except Exception as ex:
+            handle_exception(ex, fi, None, logger)
+    pending.clear()
 
 
-def move(src, dst, ignore=None, logger=None):
+def move(src, dst, ignore=None, logger=None, workers=None):
     """
-    dirs are created files are moved and directory is deleted if empty
-    symlinks are not copied
+    Moves contents of src to dst, src itself is kept.
+    device of each directory is compared to dst once, on the same device
+    a directory missing in dst is renamed as a whole (unless ignore is
+    given, then its entries are filtered) and files are renamed.
+    files on another device are copied by `workers` threads and their
+    sources are unlinked once the directory is done and the copy is
+    verified. directories left empty are deleted.
+    symlinks are moved as they are.
     """
+    if logger:
+        logger.__setattr__("name", "move")
 
     src = Path(src)
     dst = Path(dst)
-    print('src,dst',src.absolute(),dst.absolute())
     if not (src.is_dir() and dst.is_dir()):
         raise NotADirectoryError(f"src: {src} and dst: {dst} must be directories")
+    realsrc = os.path.realpath(src)
+    if os.path.commonpath([realsrc, os.path.realpath(dst)]) == realsrc:
+        raise ValueError(f"dst: {dst} is inside src: {src}")
 
-    # check if src and dst exist
-    # read errors are already skipped by os.walk
-    # and are directories
-    # add logger to handle_exception
-    for rpath, dirs, files in os.walk(src, topdown=False, onerror=handle_exception):
-        for fi in files:
-            # path to src 
-            fi_src = Path(rpath).absolute() / fi
-            #if not fi_src.exists():
-            #    raise Exception("HELLOOO", src, rpath, fi, fi_src)
-            dir_dst = (dst / Path(rpath).relative_to(src)).absolute()
-            fi_dst = dir_dst / fi
-            print("dir dst", dir_dst, dir_dst.exists())
-            print("fi_src, fi dst", fi_src, fi_dst)
-        
-            try:
-                dir_dst.mkdir(exist_ok=True)
-                os.rename(fi_src, fi_dst)
-            # if dst is different device then copy and remove
-            # TODO: use error code instead of broad OSError
-            # log this activity
-            except OSError:
+    if workers and workers > 1:
+        with CopyPool(workers, logger=logger) as pool:
+            return _move(src, dst, ignore, logger, pool)
+    return _move(src, dst, ignore, logger, None)
+
+
+def _move(src, dst, ignore, logger, pool):
+    # of directories being walked (dst, on same device, pending unlinks)
+    frames = [(dst, os.stat(src).st_dev == os.stat(dst).st_dev, [])]
+    # of hardlinked files copied to another device
+    inodes = InodeMap()
+
+    def enter(di):
+        di_dst = frames[-1][0] / di.name
+        try:
+            if frames[-1][1] and not ignore and not os.path.lexists(di_dst):
                 try:
-                    scopy(fi_src, fi_dst, follow_symlinks=False)
-                    set_owner_mode_xattr(fi_src, fi_dst)
-                    os.unlink(fi_src)
-                # catch all exceptions
-                except Exception as ex:
-                    handle_exception(ex, fi_src, fi_dst, logger=logger)
-            except Exception as ex:
-                handle_exception(ex, fi_src, fi_dst, logger)
-        # set dst dir properties and remove src
-        for di in dirs:
-            # source dir path
-            dir_src = Path(rpath).absolute() / di
-            # check if dir exists? it must when os.walk if not top down
-            dir_dst = dst / Path(rpath).relative_to(src) / di
-            # to ensure not deleteting directories when not ignored
-            if ignore and ignore(dir_dst):
-                continue
+                    with instrument.timer("rename"):
+                        os.rename(di, di_dst)
+                    instrument.count("dirs_renamed")
+                    if logger:
+                        logger.debug(f"Moved: {di.path} to {di_dst}")
+                    return False
+                # eg.. a mount point, its entries are moved
+                except OSError:
+                    pass
+            if not di_dst.exists():
+                os.mkdir(di_dst)
+            same = di.stat(follow_symlinks=False).st_dev == \
+                os.stat(di_dst).st_dev
+        except Exception as ex:
+            handle_exception(ex, di, di_dst, logger)
+            return False
+        frames.append((di_dst, same, []))
+        return True
+
+    def onerror(di, ex):
+        handle_exception(ex, di, None, logger)
+
+    for event, fi in scantree(src, enter=enter, onerror=onerror):
+        if event == DIR:
+            continue
+        if event == POST:
+            di_dst, _, pending = frames.pop()
+            _unlink_moved(pending, logger)
             try:
-                # handle if dst exists?
-                set_owner_mode_xattr(dir_src, dir_dst)
-                os.rmdir(dir_src)
-            # if dir is not empty and other exceptions
+                set_owner_mode_xattr(fi, di_dst)
+                if ignore and ignore(fi) and not os.listdir(di_dst):
+                    di_dst.rmdir()
+                os.rmdir(fi)
+            except OSError as ex:
+                # ignored entries remain in src
+                if not (ignore and ex.errno == errno.ENOTEMPTY):
+                    handle_exception(ex, fi, di_dst, logger)
             except Exception as ex:
-                handle_exception(ex)
-            # set permissions and delete
-            
-
-def gmove(group, src, dst, logger=None):
-    """TODO:handle skip from cli"""
-    ignore_fn = partial(ignore_not_group, group)
-    move(src, dst, ignore=ignore_fn, logger=logger)
\ No newline at end of file
+                handle_exception(ex, fi, di_dst, logger)
+            continue
+
+        di_dst, same, pending = frames[-1]
+        fi_dst = di_dst / fi.name
+        try:
+            if ignore and ignore(fi):
+                continue
+            if same:
+                try:
+                    with instrument.timer("rename"):
+                        os.rename(fi, fi_dst)
+                    instrument.count("files_renamed")
+                    continue
+                except OSError as ex:
+                    if ex.errno != errno.EXDEV:
+                        raise
+            first = inodes.first(fi)
+            if first is not None:
+                link_file(fi, first, fi_dst, logger=logger)
+                result = True
+            elif pool:
+                result = pool.submit(_move_file, fi, fi_dst, logger=logger)
+            else:
+                result = _move_file(fi, fi_dst, logger=logger)
+            inodes.add(fi, fi_dst, result)
+            pending.append((fi, result))
+        except Exception as ex:
+            handle_exception(ex, fi, fi_dst, logger)
+    _unlink_moved(frames[0][2], logger)
+    return dst
+
+
+def gmove(group, src, dst, logger=None, **kwargs):
+    """ moves files of group from src to dst
+    kwargs are passed to move
+    """
+    ignore_fn = partial(ignore_not_group, group_index(group))
+    return move(src, dst, ignore=ignore_fn, logger=logger, **kwargs)
@@ -0,0 +1,215 @@
+""" Content addressed store of files
+an ObjectStore keeps contents of files once as objects under their
+checksum in objects/ of its root, files copied with a store (see
+core.copy) are hardlinks or reflinks to its objects.
+
+hardlinks share owner, group, mode, times and xattrs, so an object to
+be hardlinked is keyed by checksum and these attributes (access time
+too, verify compares it; not xattrs, those of the first file stored are
+kept) and files share an object only if their attributes are same too. reflinks share only data, their
+objects are keyed by checksum alone. a file edited in place in a tree
+of hardlinks changes the object and so all trees linked to it.
+
+checksums of files are kept in an index (sqlite) in root keyed by
+device, inode, size and modified time, unchanged files are not read
+again on later copies.
+"""
+import os
+import stat
+import errno
+import sqlite3
+from pathlib import Path
+from threading import Lock, get_ident
+from .checksum import file_digest
+from .transfer import copyfile
+from .core import transfer_file, set_owner_mode_xattr
+from . import instrument
+
+LINKS = ("hardlink", "reflink")
+
+
+class HashIndex:
+    """ On disk (sqlite) index of checksums of files by device and
+    inode, valid while size and modified time are same.
+    """
+    # number of records after which changes are committed
+    batchsize = 1000
+
+    def __init__(self, path):
+        self.path = Path(path)
+        # used from copy worker threads
+        self.lock = Lock()
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS files "
+                          "(dev INTEGER, ino INTEGER, size INTEGER, "
+                          "mtime INTEGER, algorithm TEXT, digest TEXT, "
+                          "PRIMARY KEY (dev, ino))")
+        self.pending = 0
+
+    def get(self, st, algorithm):
+        """ Returns checksum of file with stat st or None if not known """
+        with self.lock:
+            row = self.conn.execute("SELECT size, mtime, algorithm, digest "
+                                    "FROM files WHERE dev=? AND ino=?",
+                                    (st.st_dev, st.st_ino)).fetchone()
+        if row and row[:3] == (st.st_size, st.st_mtime_ns, algorithm):
+            return row[3]
+        return None
+
+    def put(self, st, algorithm, digest):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO files VALUES "
+                              "(?, ?, ?, ?, ?, ?)",
+                              (st.st_dev, st.st_ino, st.st_size,
+                               st.st_mtime_ns, algorithm, digest))
+            self.pending += 1
+            if self.pending >= self.batchsize:
+                self.conn.commit()
+                self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+
+class ObjectStore:
+    """ Store of objects in directory root linked into trees with link
+    (one of LINKS), root has to be on the filesystem of the trees.
+    """
+    def __init__(self, root, link="hardlink", algorithm="sha256"):
+        if link not in LINKS:
+            raise ValueError(f"link {link} is not one of {LINKS}")
+        self.root = Path(root)
+        self.objects = self.root / "objects"
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.link = link
+        self.algorithm = algorithm
+        self.index = HashIndex(self.root / "index.sqlite")
+
+    @property
+    def hardlink(self):
+        """ True if objects and so attributes are shared by files """
+        return self.link == "hardlink"
+
+    def digest(self, fi):
+        """ checksum of file fi from index or its contents """
+        st = fi.stat()
+        digest = self.index.get(st, self.algorithm)
+        if digest is None:
+            with instrument.timer("hash"):
+                digest = file_digest(fi.path, self.algorithm)
+            instrument.count("files_hashed")
+            self.index.put(st, self.algorithm, digest)
+        return digest
+
+    def key(self, fi, digest):
+        if not self.hardlink:
+            return digest
+        st = fi.stat()
+        return f"{digest}-{st.st_uid}-{st.st_gid}-" \
+               f"{stat.S_IMODE(st.st_mode):o}-{st.st_mtime_ns}-" \
+               f"{st.st_atime_ns}"
+
+    def path(self, key):
+        return self.objects / key[:2] / key
+
+    def _store(self, fi, obj, logger=None, replace=False):
+        """ copies fi to object obj, an object stored meanwhile by
+        another thread is kept unless replace
+        """
+        obj.parent.mkdir(exist_ok=True)
+        tmp = obj.parent / f".{obj.name}.{get_ident()}"
+        try:
+            transfer_file(fi, tmp, logger=logger)
+            if self.hardlink:
+                set_owner_mode_xattr(fi, tmp)
+            # object has to have contents that were hashed
+            sst = fi.stat()
+            nst = os.stat(fi.path)
+            if (sst.st_size, sst.st_mtime_ns) != \
+                    (nst.st_size, nst.st_mtime_ns):
+                raise OSError(f"Skipping: {fi.path} changed while stored.")
+            if replace:
+                os.replace(tmp, obj)
+                return
+            try:
+                os.link(tmp, obj)
+            except FileExistsError:
+                pass
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+            raise
+        os.unlink(tmp)
+
+    def _link(self, obj, tmp):
+        if not self.hardlink:
+            copyfile(obj, tmp, methods=["reflink"])
+            return
+        try:
+            os.link(obj, tmp)
+        except FileExistsError:
+            # left by an interrupted copy
+            os.unlink(tmp)
+            os.link(obj, tmp)
+
+    def place(self, fi, fi_dst, logger=None):
+        """ Links fi_dst to object with contents of regular file fi,
+        fi is stored first if no such object exists. an existing fi_dst
+        is replaced.
+        """
+        obj = self.path(self.key(fi, self.digest(fi)))
+        if not obj.exists():
+            self._store(fi, obj, logger=logger)
+        else:
+            instrument.count("files_deduplicated")
+        fi_dst = Path(fi_dst)
+        tmp = fi_dst.parent / f".{fi_dst.name}.gar-tmp"
+        try:
+            try:
+                self._link(obj, tmp)
+            except OSError as ex:
+                if ex.errno != errno.EMLINK:
+                    raise
+                # object has as many links as filesystem allows, a new
+                # copy is linked from now on
+                self._store(fi, obj, logger=logger, replace=True)
+                self._link(obj, tmp)
+            if not self.hardlink:
+                set_owner_mode_xattr(fi, tmp)
+            os.replace(tmp, fi_dst)
+        except BaseException:
+            if os.path.lexists(tmp):
+                os.unlink(tmp)
+            raise
+        if logger:
+            logger.debug(f"Linked: {fi_dst} to {obj}")
+
+    def prune(self):
+        """ Removes hardlinked objects no longer linked from any tree
+        returns number and bytes of objects removed
+        """
+        if not self.hardlink:
+            raise ValueError("only objects of hardlinks can be pruned")
+        removed = [0, 0]
+        for entry in self.objects.glob("*/*"):
+            st = entry.lstat()
+            if st.st_nlink == 1 and not entry.name.startswith("."):
+                entry.unlink()
+                removed[0] += 1
+                removed[1] += st.st_size
+        return tuple(removed)
+
+    def close(self):
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
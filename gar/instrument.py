@@ -0,0 +1,104 @@
+""" Timers and counters of phases of gar operations
+off by default, when disabled timer() returns a shared no-op
+context manager and count() returns immediately.
+"""
+import time
+from threading import Lock
+from collections import defaultdict
+
+enabled = False
+
+_lock = Lock()
+_timings = defaultdict(float)
+_calls = defaultdict(int)
+_counts = defaultdict(int)
+
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_notimer = _NoTimer()
+
+
+class _Timer:
+    __slots__ = ("phase", "start")
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        elapsed = time.perf_counter() - self.start
+        with _lock:
+            _timings[self.phase] += elapsed
+            _calls[self.phase] += 1
+        return False
+
+
+def timer(phase):
+    """ context manager adding time spent in block to phase """
+    if not enabled:
+        return _notimer
+    return _Timer(phase)
+
+
+def count(name, n=1):
+    """ adds n to counter name """
+    if not enabled:
+        return
+    with _lock:
+        _counts[name] += n
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    with _lock:
+        _timings.clear()
+        _calls.clear()
+        _counts.clear()
+
+
+def report():
+    """ Returns dict of phases with seconds and calls and of counters
+    time of phases run by worker threads add up, so they can exceed
+    wall clock time of the run.
+    """
+    with _lock:
+        phases = {p: {"seconds": _timings[p], "calls": _calls[p]}
+                  for p in _timings}
+        return {"phases": phases, "counts": dict(_counts)}
+
+
+def format_report(wall=None):
+    """ Returns report as text table """
+    rep = report()
+    lines = [f"{'phase':<16}{'seconds':>12}{'calls':>12}{'%':>8}"]
+    total = wall or sum(p["seconds"] for p in rep["phases"].values()) or 1
+    for phase, p in sorted(rep["phases"].items(),
+                           key=lambda x: -x[1]["seconds"]):
+        lines.append(f"{phase:<16}{p['seconds']:>12.3f}{p['calls']:>12}"
+                     f"{100 * p['seconds'] / total:>8.1f}")
+    if wall is not None:
+        lines.append(f"{'wall':<16}{wall:>12.3f}")
+    for name, n in sorted(rep["counts"].items()):
+        lines.append(f"{name:<16}{n:>12}")
+    return "\n".join(lines)
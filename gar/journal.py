@@ -0,0 +1,101 @@
+import os
+import json
+from pathlib import Path
+from hashlib import sha1
+from threading import Lock
+
+
+journalpath = Path.home() / ".gar" / "journals"
+
+
+class Journal:
+    """ Append only record of directories completed by a copy job
+    a directory is recorded after its files are copied and its attributes
+    are set, so in post-order (a directory after its subdirectories).
+    with resume a copy skips recorded directories without scanning them,
+    otherwise the journal of an earlier job is discarded.
+    one journal exists for a pair of src and dst and the group copied
+    (copies filtered by other groups skip other files) unless path is
+    given, it is removed when the job is complete.
+
+    records are written in batches of batchsize and fsync-ed, so a crash
+    loses at most the last batch (those directories are copied again).
+    failed files are only logged, re-run without resume to retry them.
+    """
+    # number of records after which journal is synced to disk
+    batchsize = 100
+
+    def __init__(self, src, dst, path=None, resume=False, group=None):
+        self.src = str(Path(src))
+        if path is None:
+            pair = f"{os.path.realpath(src)}\0{os.path.realpath(dst)}"
+            if group is not None:
+                pair += f"\0{group}"
+            journalpath.mkdir(parents=True, exist_ok=True)
+            path = journalpath / f"{sha1(pair.encode()).hexdigest()}.journal"
+        self.path = Path(path)
+        self.done = set()
+        if resume:
+            self.done, end = self.load(self.path)
+            self.file = open(self.path, "a")
+            # drop a record torn by a crash before appending
+            self.file.truncate(end)
+        else:
+            self.file = open(self.path, "w")
+        # used from copy worker threads
+        self.lock = Lock()
+        self.pending = 0
+
+    @staticmethod
+    def load(path):
+        """ Returns set of directories recorded in journal at path
+        and size of its complete records
+        """
+        done = set()
+        end = 0
+        try:
+            with open(path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        done.add(json.loads(line))
+                    except ValueError:
+                        break
+                    end += len(line)
+        except FileNotFoundError:
+            pass
+        return done, end
+
+    def key(self, di):
+        """ path of directory di relative to src """
+        return os.path.relpath(os.fspath(di), self.src)
+
+    def finished(self, di):
+        """ True if directory di was completed by the job before """
+        return bool(self.done) and self.key(di) in self.done
+
+    def record(self, di):
+        with self.lock:
+            self.file.write(json.dumps(self.key(di)) + "\n")
+            self.pending += 1
+            if self.pending >= self.batchsize:
+                self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+
+    def close(self, complete=False):
+        with self.lock:
+            self.sync()
+            self.file.close()
+        if complete:
+            self.path.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(complete=exc_type is None)
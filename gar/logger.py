@@ -2,7 +2,11 @@ import logging
 from logging import handlers
 import os
 import gzip
+import time
+import queue
+import atexit
 from pathlib import Path
+from threading import Lock
 
 
 syslogpath = Path("/var/log/gar")
@@ -30,17 +34,119 @@ def rotator(src, dst):
     os.remove(dst)
 
 
-def setup_logger(name="gar.log"):
-    fh = handlers.TimedRotatingFileHandler((logfilepath / name),
-                                           when="s", backupCount=10,
-                                           delay=True)
+# size of log file after which it is rotated and compressed
+MAXBYTES = 10 * 1024 * 1024
+BACKUPCOUNT = 10
+
+
+def _gz_namer(name):
+    return f"{name}.gz"
+
+
+def _gz_rotator(src, dst):
+    # dst is named by _gz_namer, rotator appends .gz itself
+    rotator(src, dst[:-len(".gz")])
+
+
+class AggregateFilter(logging.Filter):
+    """ Aggregates repeated records eg.. of files skipped as unchanged
+    records logged with extra={"aggregate": kind, "path": path} are
+    counted by kind and at most one record of a kind passes in interval
+    seconds, as a summary of count of records since last one. others
+    of the kind are dropped.
+    """
+    def __init__(self, interval=10.0):
+        super().__init__()
+        self.interval = interval
+        self.lock = Lock()
+        # kind: (count, last record, time of last summary)
+        self.kinds = {}
+
+    def filter(self, record):
+        kind = getattr(record, "aggregate", None)
+        if kind is None:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            count, _, last = self.kinds.get(kind, (0, None, None))
+            if last is not None and now - last < self.interval:
+                self.kinds[kind] = (count + 1, record, last)
+                return False
+            self.kinds[kind] = (0, None, now)
+        self.summarize(record, count + 1)
+        return True
+
+    @staticmethod
+    def summarize(record, count):
+        if count > 1:
+            path = getattr(record, "path", None) or record.getMessage()
+            record.msg = f"Skipping: {count} files {record.aggregate}, " \
+                         f"last: {path}"
+            record.args = None
+        record.count = count
+        record.aggregate = None
+        return record
+
+    def flush(self):
+        """ Returns summaries of records dropped since last summary """
+        with self.lock:
+            pending = [(count, record) for count, record, _ in
+                       self.kinds.values() if count]
+            self.kinds.clear()
+        return [self.summarize(record, count) for count, record in pending]
+
+
+# of log files: (QueueHandler, QueueListener)
+_pipelines = {}
+
+
+def setup_logger(name="gar.log", maxbytes=MAXBYTES,
+                 backupcount=BACKUPCOUNT, interval=10.0):
+    """ Returns a QueueHandler for log file name in logfilepath
+    records are only queued by the handler, a background listener formats
+    and writes them to the file, it is rotated when larger than maxbytes
+    and rotated files are compressed. repeated records are aggregated
+    (see AggregateFilter). a handler is set up once for a name.
+    """
+    if name in _pipelines:
+        return _pipelines[name][0]
+    fh = handlers.RotatingFileHandler((logfilepath / name),
+                                      maxBytes=maxbytes,
+                                      backupCount=backupcount, delay=True)
     # use formatter with just message for now
     # formatter = logging.Formatter(' %(asctime)-12s - %(name)-5s \
     #                              - %(levelname)-6s - %(message)s')
     formatter = logging.Formatter('%(message)s')
     fh.setFormatter(formatter)
 
-    fh.rotator = rotator
+    fh.namer = _gz_namer
+    fh.rotator = _gz_rotator
+
+    qh = handlers.QueueHandler(queue.Queue())
+    qh.addFilter(AggregateFilter(interval))
+    listener = handlers.QueueListener(qh.queue, fh,
+                                      respect_handler_level=True)
+    listener.start()
+    _pipelines[name] = (qh, listener)
+
+    logger.addHandler(qh)
+    return qh
+
+
+def stop_logger(name=None):
+    """ Writes aggregated and queued records of log file name
+    (or of all) and stops its listener
+    """
+    for key in [name] if name else list(_pipelines):
+        qh, listener = _pipelines.pop(key)
+        for flt in qh.filters:
+            if isinstance(flt, AggregateFilter):
+                for record in flt.flush():
+                    qh.handle(record)
+        listener.stop()
+        for h in listener.handlers:
+            h.close()
+        logger.removeHandler(qh)
+
 
-    logger.addHandler(fh)
-    return fh
+atexit.register(stop_logger)
@@ -0,0 +1,79 @@
+import os
+import sqlite3
+from pathlib import Path
+from hashlib import sha1
+from threading import Lock
+
+
+manifestpath = Path.home() / ".gar" / "manifests"
+
+
+class Manifest:
+    """ On disk (sqlite) record of stat of files last copied from src to dst
+    used by copy to decide on a recopy from stat of src alone without
+    stat-ing files in dst.
+    one manifest exists for a pair of src and dst unless path is given.
+    """
+    # number of records after which changes are committed
+    batchsize = 1000
+
+    def __init__(self, src, dst, path=None):
+        self.src = str(Path(src))
+        if path is None:
+            pair = f"{os.path.realpath(src)}\0{os.path.realpath(dst)}"
+            manifestpath.mkdir(parents=True, exist_ok=True)
+            path = manifestpath / f"{sha1(pair.encode()).hexdigest()}.sqlite"
+        self.path = Path(path)
+        # used from copy worker threads
+        self.lock = Lock()
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS files "
+                          "(path TEXT PRIMARY KEY, uid INTEGER, gid INTEGER, "
+                          "mode INTEGER, size INTEGER, mtime INTEGER)")
+        self.pending = 0
+
+    @staticmethod
+    def stat_tuple(st):
+        return (st.st_uid, st.st_gid, st.st_mode, st.st_size, st.st_mtime_ns)
+
+    def key(self, fi):
+        """ path of file fi relative to src """
+        return os.path.relpath(os.fspath(fi), self.src)
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT uid, gid, mode, size, mtime "
+                                    "FROM files WHERE path=?",
+                                    (key,)).fetchone()
+        return row
+
+    def unchanged(self, key, st):
+        """ True if file was copied with same stat st before """
+        return self.get(key) == self.stat_tuple(st)
+
+    def record(self, key, st):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO files VALUES "
+                              "(?, ?, ?, ?, ?, ?)",
+                              (key, *self.stat_tuple(st)))
+            self.pending += 1
+            if self.pending >= self.batchsize:
+                self.conn.commit()
+                self.pending = 0
+
+    def discard(self, key):
+        with self.lock:
+            self.conn.execute("DELETE FROM files WHERE path=?", (key,))
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,190 @@
+""" Merkle tree digests of directory trees
+digest of a directory hashes its entries and digests of its
+subdirectories, so two trees (eg.. src and its copy) with the same
+digest have the same files, directories and attributes.
+
+entries of a directory can be cached on disk (DigestCache) and are
+only scanned again when modified or changed time of the directory
+differ. Caveat: times of a directory change when entries are created,
+removed or renamed but not when a file is edited in place or its
+attributes are changed, such changes are not seen while the cache is
+used. compute without a cache when that matters.
+"""
+import os
+import json
+import time
+import sqlite3
+from hashlib import sha1
+from pathlib import Path
+from threading import Lock
+from .walk import scandir
+
+digestpath = Path.home() / ".gar" / "digests.sqlite"
+
+# directories changed more recently are not cached, their times
+# can stay same over a change in the same tick of filesystem clock
+RACY_NS = 2 * 10**9
+
+
+class DigestCache:
+    """ On disk (sqlite) cache of digests of entries of directories
+    a directory is looked up by its absolute path and the cache is
+    valid while its modified and changed times are same.
+    """
+    # number of records after which changes are committed
+    batchsize = 1000
+
+    def __init__(self, path=None):
+        if path is None:
+            digestpath.parent.mkdir(parents=True, exist_ok=True)
+            path = digestpath
+        self.path = Path(path)
+        # used from threads comparing directories
+        self.lock = Lock()
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS dirs "
+                          "(path BLOB PRIMARY KEY, mtime INTEGER, "
+                          "ctime INTEGER, entries TEXT, subdirs TEXT)")
+        self.pending = 0
+
+    @staticmethod
+    def key(path):
+        return os.fsencode(os.path.abspath(path))
+
+    def get(self, path, st):
+        """ Returns (digest of entries, names of subdirectories) of
+        directory path with stat st or None if not cached or changed
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT mtime, ctime, entries, subdirs "
+                                    "FROM dirs WHERE path=?",
+                                    (self.key(path),)).fetchone()
+        if row and row[:2] == (st.st_mtime_ns, st.st_ctime_ns):
+            return row[2], json.loads(row[3])
+        return None
+
+    def put(self, path, st, entries, subdirs):
+        now = int(time.time() * 10**9)
+        if now - max(st.st_mtime_ns, st.st_ctime_ns) < RACY_NS:
+            return
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO dirs VALUES "
+                              "(?, ?, ?, ?, ?)",
+                              (self.key(path), st.st_mtime_ns,
+                               st.st_ctime_ns, entries, json.dumps(subdirs)))
+            self.pending += 1
+            if self.pending >= self.batchsize:
+                self.conn.commit()
+                self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _entry_record(entry):
+    """ bytes of name and attributes of a file or symlink entry """
+    st = entry.stat(follow_symlinks=False)
+    if entry.is_symlink():
+        try:
+            target = os.readlink(entry.path)
+        except OSError:
+            target = ""
+        fields = ("l", st.st_uid, st.st_gid, target)
+    else:
+        fields = ("f", st.st_mode, st.st_uid, st.st_gid, st.st_size,
+                  st.st_mtime_ns)
+    return b"\0".join([os.fsencode(entry.name)] +
+                      [os.fsencode(str(f)) for f in fields]) + b"\n"
+
+
+def _dir_record(st):
+    return f"d\0{st.st_mode}\0{st.st_uid}\0{st.st_gid}\0" \
+           f"{st.st_mtime_ns}\n".encode()
+
+
+def _scan_entries(path, ignore=None):
+    """ Returns digest of entries of directory path that are not
+    directories and sorted names of its subdirectories
+    """
+    digest = sha1()
+    subdirs = []
+    for entry in sorted(scandir(path), key=lambda e: e.name):
+        if entry.is_dir(follow_symlinks=False):
+            subdirs.append(entry.name)
+        elif not (ignore and ignore(entry)):
+            digest.update(_entry_record(entry))
+    return digest.hexdigest(), subdirs
+
+
+def tree_digests(top, cache=None, ignore=None):
+    """ Returns dict of digest of each directory of tree top by path
+    relative to top ('.' for top itself).
+    digest of a directory hashes its mode, owner, group and modified
+    time (except for top, so copies at other paths have same digest),
+    attributes of its files and symlinks and digests of subdirectories.
+    cache (DigestCache) is used for entries of directories that are not
+    changed, not with ignore (files ignored are not hashed).
+    not readable directories are hashed from their attributes only.
+    """
+    top = os.fspath(top)
+    if ignore:
+        cache = None
+    digests = {}
+
+    def visit(rel, path):
+        st = os.lstat(path)
+        cached = cache.get(path, st) if cache else None
+        if cached is not None:
+            entries, subdirs = cached
+        else:
+            try:
+                entries, subdirs = _scan_entries(path, ignore)
+            except OSError:
+                entries, subdirs = "", []
+            else:
+                if cache:
+                    cache.put(path, st, entries, subdirs)
+        return [rel, path, st, entries, subdirs, 0]
+
+    # post-order walk with a stack, digests of subdirectories first
+    stack = [visit(".", top)]
+    while stack:
+        frame = stack[-1]
+        rel, path, st, entries, subdirs, i = frame
+        if i < len(subdirs):
+            frame[5] += 1
+            name = subdirs[i]
+            try:
+                stack.append(visit(name if rel == "." else
+                                   os.path.join(rel, name),
+                                   os.path.join(path, name)))
+            # removed while walking
+            except FileNotFoundError:
+                pass
+            continue
+        stack.pop()
+        digest = sha1()
+        if rel != ".":
+            digest.update(_dir_record(st))
+        digest.update(entries.encode())
+        for name in subdirs:
+            sub = name if rel == "." else os.path.join(rel, name)
+            digest.update(os.fsencode(name) + b"\0" +
+                          digests.get(sub, "").encode() + b"\n")
+        digests[rel] = digest.hexdigest()
+    return digests
+
+
+def tree_digest(top, cache=None, ignore=None):
+    """ Returns digest of directory tree top (see tree_digests) """
+    return tree_digests(top, cache=cache, ignore=ignore)["."]
@@ -0,0 +1,280 @@
+""" Plans of copies
+plan walks src like core.copy and decides what a copy to dst would do
+without writing to dst, the plan is written as lines of json:
+a header with src and dst, one action per line and totals at the end.
+apply executes a plan without walking src or dst again.
+
+actions (path is relative to src and dst):
+    mkdir    directory missing in dst
+    copy     file missing in dst or its contents differ (size, mtime)
+    update   only owner, group or mode of file differ
+    link     hardlink to first, a copy of another link of the same inode
+    symlink  symlink to target
+    post     set attributes of directory after its entries, prune
+             removes it if left empty and ignored
+files that are same in dst (skip) are only counted in totals.
+"""
+import os
+import json
+import time
+import logging
+from pathlib import Path
+from concurrent.futures import wait
+from .walk import scantree, Entry, DIR, POST
+from .core import file_action, link_file, symlink_target, transfer_file
+from .core import set_owner_mode_xattr, handle_exception, log_or_print
+from .core import InodeMap, CopyPool
+from . import instrument
+
+VERSION = 1
+ACTIONS = ("mkdir", "copy", "update", "link", "symlink", "post")
+
+
+def _dir_changed(sstat, dstat):
+    return (sstat.st_mode, sstat.st_uid, sstat.st_gid, sstat.st_mtime_ns) != \
+        (dstat.st_mode, dstat.st_uid, dstat.st_gid, dstat.st_mtime_ns)
+
+
+def _link_changed(fi, fi_dst, target):
+    """ True if symlink fi_dst is missing or differs from copy of fi """
+    try:
+        dstat = os.lstat(fi_dst)
+    except FileNotFoundError:
+        return True
+    sstat = fi.stat(follow_symlinks=False)
+    if target is None:
+        target = os.readlink(fi)
+    return os.readlink(fi_dst) != target or \
+        (sstat.st_uid, sstat.st_gid, sstat.st_mtime_ns) != \
+        (dstat.st_uid, dstat.st_gid, dstat.st_mtime_ns)
+
+
+def _linked(first, fi_dst):
+    """ True if fi_dst is already a hardlink of first """
+    try:
+        fstat = os.lstat(first)
+        dstat = os.lstat(fi_dst)
+    except FileNotFoundError:
+        return False
+    return (fstat.st_dev, fstat.st_ino) == (dstat.st_dev, dstat.st_ino)
+
+
+def plan(src, dst, out, ignore=None, logger=None, **info):
+    """ Writes plan of copy of src to dst (see core.copy) to out, a
+    text file object. ignore filters files as in copy and info (eg..
+    group) is kept in header of the plan.
+    Returns totals, dict of [files, bytes] by action and 'skip'.
+    """
+    src = Path(src)
+    dst = Path(dst)
+    if not os.access(src, os.R_OK):
+        raise OSError(f"Skipping: directory {src} "
+                      "cannot be read by current user.")
+    if not src.is_dir():
+        raise NotADirectoryError(f"src {str(src)} is not a directory, "
+                                 "pass a directory.")
+    scope = str(os.path.realpath(src))
+    totals = {action: [0, 0] for action in ACTIONS + ("skip",)}
+
+    def emit(action, rel, size=0, **kwargs):
+        if action != "skip":
+            out.write(json.dumps(dict(action=action, path=rel, size=size,
+                                      **kwargs)) + "\n")
+        totals[action][0] += 1
+        totals[action][1] += size
+
+    out.write(json.dumps(dict(plan=VERSION, src=str(src.absolute()),
+                              dst=str(dst.absolute()), created=time.time(),
+                              **info)) + "\n")
+    if not dst.exists():
+        emit("mkdir", ".")
+    # of directories being walked [dst, path relative to src, changed]
+    frames = [[dst, ".", True]]
+    inodes = InodeMap()
+
+    def enter(di):
+        parent = frames[-1]
+        di_dst = parent[0] / di.name
+        rel = os.path.relpath(di.path, src)
+        try:
+            if not di.readable():
+                if ignore:
+                    return False
+                raise OSError(f"Skipping: {di.path} file cannot be read.")
+            try:
+                changed = _dir_changed(di.stat(follow_symlinks=False),
+                                       os.stat(di_dst))
+            except FileNotFoundError:
+                emit("mkdir", rel)
+                parent[2] = changed = True
+        except Exception as ex:
+            handle_exception(ex, di, None, logger)
+            return False
+        frames.append([di_dst, rel, changed])
+        return True
+
+    def onerror(di, ex):
+        handle_exception(ex, di, None, logger)
+
+    for event, fi in scantree(src, enter=enter, onerror=onerror):
+        if event == DIR:
+            continue
+        if event == POST:
+            _, rel, changed = frames.pop()
+            prune = bool(ignore and ignore(fi))
+            if changed or prune:
+                emit("post", rel, prune=prune)
+                # removing a directory changes its parent
+                frames[-1][2] |= prune
+            continue
+
+        current = frames[-1]
+        fi_dst = current[0] / fi.name
+        rel = os.path.relpath(fi.path, src)
+        try:
+            if ignore:
+                if not fi.readable():
+                    continue
+                if fi.is_file() and ignore(fi):
+                    continue
+            if not fi.readable():
+                raise OSError(f"Skipping: {fi.path} file cannot be read.")
+            if fi.is_symlink():
+                target = symlink_target(fi, scope)
+                if _link_changed(fi, fi_dst, target):
+                    emit("symlink", rel, target=target)
+                    current[2] = True
+                else:
+                    emit("skip", rel)
+            elif fi.is_file():
+                size = fi.stat().st_size
+                first = inodes.first(fi)
+                if first is not None:
+                    if _linked(dst / first, fi_dst):
+                        emit("skip", rel, size)
+                    else:
+                        emit("link", rel, size, first=first)
+                        current[2] = True
+                    continue
+                action, _ = file_action(fi, fi_dst)
+                if action == 'copied':
+                    emit("copy", rel, size)
+                    current[2] = True
+                elif action == 'updated':
+                    emit("update", rel, size)
+                else:
+                    emit("skip", rel, size)
+                inodes.add(fi, rel)
+            else:
+                msg = f"Skipping: {str(fi.path)} is a unsupported file."
+                log_or_print(msg, logger=logger, level=logging.WARNING)
+        except Exception as ex:
+            handle_exception(ex, fi, None, logger)
+    out.write(json.dumps(dict(totals=totals)) + "\n")
+    return totals
+
+
+def read_plan(path):
+    """ Returns header of plan at path and a generator of its actions,
+    (totals are not yielded)
+    """
+    with open(path) as f:
+        header = json.loads(f.readline())
+    if header.get("plan") != VERSION:
+        raise ValueError(f"{path} is not a plan of version {VERSION}")
+
+    def actions():
+        with open(path) as f:
+            f.readline()
+            for line in f:
+                item = json.loads(line)
+                if "totals" in item:
+                    return
+                yield item
+    return header, actions()
+
+
+def _apply_file(fi, fi_dst, action="copy", logger=None):
+    try:
+        shared = os.lstat(fi_dst).st_nlink > 1
+    except FileNotFoundError:
+        shared = False
+    # files with other links are replaced, their contents are shared
+    if action == "copy" or shared:
+        # copy function needs write access, remove read only files
+        if shared or os.path.lexists(fi_dst) and \
+                not os.access(fi_dst, os.W_OK):
+            os.unlink(fi_dst)
+        transfer_file(fi, fi_dst, logger=logger)
+    else:
+        instrument.count("files_updated")
+    set_owner_mode_xattr(fi, fi_dst)
+    return True
+
+
+def apply(path, logger=None, workers=None):
+    """ Executes plan at path (see plan) with files copied by `workers`
+    threads. entries are taken as they are now, a file changed after it
+    was planned is copied with its current contents.
+    Returns dst of the plan
+    """
+    if logger:
+        logger.__setattr__("name", "apply")
+    header, actions = read_plan(path)
+    if workers and workers > 1:
+        with CopyPool(workers, logger=logger) as pool:
+            return _apply(header, actions, logger, pool)
+    return _apply(header, actions, logger, None)
+
+
+def _apply(header, actions, logger, pool):
+    src = Path(header["src"])
+    dst = Path(header["dst"])
+    # files being copied by pool in each directory
+    pending = {}
+    for item in actions:
+        action = item["action"]
+        rel = item["path"]
+        fi_dst = dst / rel
+        fi = None
+        try:
+            if action == "mkdir":
+                if not fi_dst.exists():
+                    os.mkdir(fi_dst)
+                continue
+            fi = Entry(src / rel)
+            if action in ("copy", "update"):
+                if pool:
+                    future = pool.submit(_apply_file, fi, fi_dst,
+                                         action=action, logger=logger)
+                    pending.setdefault(os.path.dirname(rel), []).append(future)
+                else:
+                    _apply_file(fi, fi_dst, action=action, logger=logger)
+            elif action == "link":
+                wait(pending.get(os.path.dirname(item["first"]), []))
+                link_file(fi, dst / item["first"], fi_dst, logger=logger)
+            elif action == "symlink":
+                target = item["target"]
+                if target is None:
+                    target = os.readlink(fi)
+                if os.path.lexists(fi_dst) and os.readlink(fi_dst) != target:
+                    os.unlink(fi_dst)
+                if not os.path.lexists(fi_dst):
+                    os.symlink(target, fi_dst)
+                set_owner_mode_xattr(fi, fi_dst)
+            elif action == "post":
+                # wait for files before setting times of directory
+                wait(pending.pop(rel, []))
+                set_owner_mode_xattr(fi, fi_dst)
+                if item.get("prune"):
+                    try:
+                        fi_dst.rmdir()
+                    except OSError:
+                        pass
+            else:
+                raise ValueError(f"unknown action {action} of {rel}")
+        except Exception as ex:
+            handle_exception(ex, fi, fi_dst, logger)
+    for futures in pending.values():
+        wait(futures)
+    return dst
@@ -0,0 +1,151 @@
+import os
+import sys
+import json
+import time
+from threading import Lock, Thread
+from .walk import scantree, FILE
+from .utils import hr_size
+
+
+class Progress:
+    """ Progress of a copy with throughput and ETA
+    totals of files and bytes come from prescan() which can run alongside
+    the copy, until it is done ETA is not known.
+    update() is called for every file done (copied or skipped), the
+    progress line on stream and status_file (json) are written at most
+    once every interval seconds.
+    """
+    def __init__(self, stream=sys.stderr, status_file=None, interval=1.0,
+                 **info):
+        self.stream = stream
+        self.status_file = status_file
+        self.interval = interval
+        # extra information for status file eg.. src, dst
+        self.info = info
+        self.lock = Lock()
+        self.files = 0
+        self.bytes = 0
+        self.transferred = 0
+        self.total_files = None
+        self.total_bytes = None
+        self.scanned_files = 0
+        self.scanned_bytes = 0
+        self.start = time.monotonic()
+        self.last = (self.start, 0)
+        self.rate = 0.0
+        self.state = "running"
+        self.scanner = None
+
+    def prescan(self, src, ignore=None, skip=None, background=True):
+        """ totals regular files (not ignored) and their bytes in src
+        directories for which skip(entry) is True are not counted (eg..
+        finished by a resumed copy, see Journal.finished).
+        """
+        def scan():
+            enter = (lambda di: not skip(di)) if skip else None
+            for event, fi in scantree(src, enter=enter):
+                if event != FILE:
+                    continue
+                try:
+                    if not fi.is_file(follow_symlinks=False):
+                        continue
+                    if ignore and ignore(fi):
+                        continue
+                except OSError:
+                    continue
+                self.scanned_files += 1
+                self.scanned_bytes += fi.stat().st_size
+            with self.lock:
+                self.total_files = self.scanned_files
+                self.total_bytes = self.scanned_bytes
+        if background:
+            self.scanner = Thread(target=scan, daemon=True)
+            self.scanner.start()
+        else:
+            scan()
+
+    def update(self, files=1, nbytes=0, transferred=0):
+        """ files done with nbytes of which transferred were copied """
+        with self.lock:
+            self.files += files
+            self.bytes += nbytes
+            self.transferred += transferred
+            now = time.monotonic()
+            if now - self.last[0] < self.interval:
+                return
+            self._tick(now)
+        self.render()
+
+    def _tick(self, now):
+        last_time, last_bytes = self.last
+        if now > last_time:
+            self.rate = (self.transferred - last_bytes) / (now - last_time)
+        self.last = (now, self.transferred)
+
+    def eta(self):
+        """ seconds left from average rate of files done or None """
+        if self.total_bytes is None or not self.bytes:
+            return None
+        elapsed = time.monotonic() - self.start
+        return max(self.total_bytes - self.bytes, 0) * elapsed / self.bytes
+
+    def status(self):
+        eta = self.eta()
+        status = {"state": self.state,
+                  "files_done": self.files,
+                  "files_total": self.total_files,
+                  "bytes_done": self.bytes,
+                  "bytes_total": self.total_bytes,
+                  "bytes_transferred": self.transferred,
+                  "bytes_per_s": self.rate,
+                  "elapsed": time.monotonic() - self.start,
+                  "eta": eta,
+                  "updated": time.time()}
+        status.update(self.info)
+        return status
+
+    def line(self):
+        status = self.status()
+        files = f"{status['files_done']}"
+        size = hr_size(status["bytes_done"])
+        if status["files_total"] is not None:
+            files += f"/{status['files_total']}"
+            size += f"/{hr_size(status['bytes_total'])}"
+        else:
+            files += f"/{self.scanned_files}+"
+        eta = status["eta"]
+        eta = time.strftime("%H:%M:%S", time.gmtime(eta)) \
+            if eta is not None else "--:--:--"
+        return (f"files {files} {size} "
+                f"{status['bytes_per_s'] / 1e6:.1f} MB/s ETA {eta}")
+
+    def render(self):
+        if self.stream:
+            end = "\r" if self.stream.isatty() else "\n"
+            self.stream.write(self.line() + end)
+            self.stream.flush()
+        if self.status_file:
+            self.write_status()
+
+    def write_status(self):
+        # replace file atomically for readers of status
+        tmp = f"{self.status_file}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.status(), f)
+        os.replace(tmp, self.status_file)
+
+    def close(self, state="done"):
+        with self.lock:
+            self.state = state
+            self._tick(time.monotonic())
+            if self.total_files is None and self.scanner is None:
+                self.total_files, self.total_bytes = self.files, self.bytes
+        self.render()
+        if self.stream and self.stream.isatty():
+            self.stream.write("\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close("failed" if exc_type else "done")
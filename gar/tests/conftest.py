@@ -37,6 +37,31 @@ def tempdir():
     yield td
     shutil.rmtree(td) if td.exists() else None
 
+def _stop_logs():
+    import logging
+    from gar import logger
+    for qh, _ in list(logger._pipelines.values()):
+        logging.getLogger("gar").removeHandler(qh)
+    logger.stop_logger()
+
+
+@pytest.fixture(scope="function")
+def garhome(tmp_path, monkeypatch):
+    """ Redirect files gar keeps in ~/.gar (logs, manifests, journals
+    and digests) to tmp_path/.gar
+    """
+    from gar import logger, manifest, journal, merkle
+    home = tmp_path / ".gar"
+    home.mkdir()
+    # log files opened before are reopened in home
+    _stop_logs()
+    monkeypatch.setattr(logger, "logfilepath", home)
+    monkeypatch.setattr(manifest, "manifestpath", home / "manifests")
+    monkeypatch.setattr(journal, "journalpath", home / "journals")
+    monkeypatch.setattr(merkle, "digestpath", home / "digests.sqlite")
+    yield home
+    _stop_logs()
+
 @pytest.fixture(scope="function")
 def tempdirwithfiles(tempdir, create_users):
     """ tempdir
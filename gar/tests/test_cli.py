@@ -1,9 +1,13 @@
+import pytest
 import os
 from pathlib import Path
 import shutil
 import grp
 from click.testing import CliRunner
 from gar.command_line import cli
+
+# logs, manifests, journals and digests are kept in a temporary ~/.gar
+pytestmark = pytest.mark.usefixtures("garhome")
 # from gar.logger import logfilepath
 # from gar.utils import hash_cp_stat
 
@@ -29,6 +33,27 @@ def test_command_line_invoke():
     result = runner.invoke(cli, ["verify", "--help"])
     assert result.exit_code == 0
 
+    result = runner.invoke(cli, ["mcopy", "--help"])
+    assert result.exit_code == 0
+
+    result = runner.invoke(cli, ["move", "--help"])
+    assert result.exit_code == 0
+
+
+def test_command_line_profile(tempdirwithfiles, tmp_path):
+    runner = CliRunner()
+    group = grp.getgrgid(os.getegid()).gr_name
+    (tempdirwithfiles / "pf").write_bytes(b"tempo")
+    td = tmp_path / "copy"
+    td.mkdir()
+    stats = tmp_path / "gar.prof"
+    result = runner.invoke(cli, ["--profile", "--profile-output", str(stats),
+                                 "copy", group, str(tempdirwithfiles),
+                                 str(td)])
+    assert result.exit_code == 0
+    assert "transfer" in result.output
+    assert stats.exists()
+
 
 def test_command_line_copy(tempdirwithfiles):
     runner = CliRunner()
@@ -39,9 +64,184 @@ def test_command_line_copy(tempdirwithfiles):
                                  str(tempdirwithfiles), str(td)])
     assert result.exit_code == 0
 
+    # recopy in parallel
+    result = runner.invoke(cli, ["copy", "--jobs", "4", group,
+                                 str(tempdirwithfiles), str(td)])
+    assert result.exit_code == 0
+
+    # recopy as one of several groups
+    result = runner.invoke(cli, ["mcopy", str(tempdirwithfiles),
+                                 f"{group}:{td}"])
+    assert result.exit_code == 0
+    result = runner.invoke(cli, ["mcopy", str(tempdirwithfiles), str(td)])
+    assert result.exit_code != 0
+
+    # recopy with a manifest
+    for opt in ["--trust-manifest", "--rescan-dst"]:
+        result = runner.invoke(cli, ["copy", "--manifest", opt, group,
+                                     str(tempdirwithfiles), str(td)])
+        assert result.exit_code == 0
+
+    # resume without an interrupted copy copies all
+    result = runner.invoke(cli, ["copy", "--resume", group,
+                                 str(tempdirwithfiles), str(td)])
+    assert result.exit_code == 0
+
     # check if verify works
     result = runner.invoke(cli, ["verify", str(tempdirwithfiles), str(td)])
     print(result.output)
     assert result.exit_code == 0
 
-    shutil.rmtree(td)
\ No newline at end of file
+    result = runner.invoke(cli, ["verify", "--skip-same",
+                                 str(tempdirwithfiles), str(td)])
+    assert result.exit_code == 2
+
+    result = runner.invoke(cli, ["verify", "--checksum", "--jobs", "2",
+                                 str(tempdirwithfiles), str(td)])
+    assert result.exit_code == 0
+    assert "Mismatch" not in result.output
+
+    # src right after the flag is not taken as its value
+    result = runner.invoke(cli, ["verify", "--checksum",
+                                 str(tempdirwithfiles), str(td)])
+    assert result.exit_code == 0
+    assert "Mismatch" not in result.output
+
+    result = runner.invoke(cli, ["verify", "--checksum", "--algorithm",
+                                 "blake2b", str(tempdirwithfiles), str(td)])
+    assert result.exit_code == 0
+    assert "Mismatch" not in result.output
+
+    shutil.rmtree(td)
+
+
+def test_command_line_move(tempdirwithfiles, tmp_path):
+    runner = CliRunner()
+    group = grp.getgrgid(os.getegid()).gr_name
+    (tempdirwithfiles / "mv").write_bytes(b"tempo")
+    td = tmp_path / "moved"
+    td.mkdir()
+    result = runner.invoke(cli, ["move", "--jobs", "2", group,
+                                 str(tempdirwithfiles), str(td)])
+    assert result.exit_code == 0
+    assert (td / "mv").read_bytes() == b"tempo"
+    assert not (tempdirwithfiles / "mv").exists()
+
+
+def test_command_line_plan(tmp_path):
+    runner = CliRunner()
+    group = grp.getgrgid(os.getegid()).gr_name
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "f").write_bytes(b"tempo")
+    dst = tmp_path / "dst"
+    planfile = tmp_path / "plan.jsonl"
+    result = runner.invoke(cli, ["plan", group, str(src), str(dst),
+                                 str(planfile)])
+    assert result.exit_code == 0
+    assert "copy: 1" in result.output
+    assert not dst.exists()
+    result = runner.invoke(cli, ["apply", "--jobs", "2", str(planfile)])
+    assert result.exit_code == 0
+    assert (dst / "f").read_bytes() == b"tempo"
+
+
+def test_command_line_throttle(tmp_path):
+    runner = CliRunner()
+    group = grp.getgrgid(os.getegid()).gr_name
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "f").write_bytes(b"tempo")
+    dst = tmp_path / "dst"
+    dst.mkdir()
+    result = runner.invoke(cli, ["copy", "--bwlimit", "1x", group,
+                                 str(src), str(dst)])
+    assert result.exit_code == 2
+    result = runner.invoke(cli, ["copy", "--bwlimit", "10M", "--schedule",
+                                 "00:00-24:00=20M/100", group,
+                                 str(src), str(dst)])
+    assert result.exit_code == 0
+    assert (dst / "f").read_bytes() == b"tempo"
+
+
+def test_command_line_delta(tmp_path):
+    runner = CliRunner()
+    group = grp.getgrgid(os.getegid()).gr_name
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "f").write_bytes(b"tempo")
+    dst = tmp_path / "dst"
+    dst.mkdir()
+    # group right after the flag is not taken as its value
+    result = runner.invoke(cli, ["copy", "--delta", group, str(src),
+                                 str(dst)])
+    assert result.exit_code == 0
+    assert (dst / "f").read_bytes() == b"tempo"
+    result = runner.invoke(cli, ["copy", "--delta", "--delta-size", "0x",
+                                 group, str(src), str(dst)])
+    assert result.exit_code == 2
+
+
+def test_command_line_archive(tmp_path):
+    runner = CliRunner()
+    group = grp.getgrgid(os.getegid()).gr_name
+    src = tmp_path / "src"
+    (src / "sub").mkdir(parents=True)
+    (src / "sub" / "f").write_bytes(b"tempo")
+    out = tmp_path / "out.tar"
+    result = runner.invoke(cli, ["archive", "--frame-size", "0", group,
+                                 str(src), str(out)])
+    assert result.exit_code == 2
+    result = runner.invoke(cli, ["archive", group, str(src), str(out)])
+    assert result.exit_code == 0
+    assert (tmp_path / "out.tar.idx").exists()
+    result = runner.invoke(cli, ["extract", str(out), "sub/f",
+                                 str(tmp_path)])
+    assert result.exit_code == 0
+    assert (tmp_path / "sub" / "f").read_bytes() == b"tempo"
+
+
+def test_command_line_store(tmp_path):
+    runner = CliRunner()
+    group = grp.getgrgid(os.getegid()).gr_name
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "f").write_bytes(b"tempo")
+    (src / "g").write_bytes(b"tempo")
+    (src / "h").write_bytes(b"tempo")
+    for f in ["f", "g"]:
+        os.utime(src / f, ns=(10**18, 10**18))
+    # differs only in access time
+    os.utime(src / "h", ns=(2 * 10**18, 10**18))
+    dst = tmp_path / "dst"
+    dst.mkdir()
+    result = runner.invoke(cli, ["copy", "--store", str(tmp_path / "store"),
+                                 group, str(src), str(dst)])
+    assert result.exit_code == 0
+    assert os.stat(dst / "f").st_ino == os.stat(dst / "g").st_ino
+    assert os.stat(dst / "f").st_ino != os.stat(dst / "h").st_ino
+    result = runner.invoke(cli, ["verify", "--dedup", str(src), str(dst)])
+    assert result.exit_code == 0
+    assert "Mismatch" not in result.output
+
+
+def test_command_line_verify_skip_same(tmp_path):
+    runner = CliRunner()
+    group = grp.getgrgid(os.getegid()).gr_name
+    src = tmp_path / "src"
+    (src / "sub").mkdir(parents=True)
+    (src / "sub" / "f").write_bytes(b"tempo")
+    dst = tmp_path / "dst"
+    dst.mkdir()
+    result = runner.invoke(cli, ["copy", group, str(src), str(dst)])
+    assert result.exit_code == 0
+    args = ["verify", "--checksum", "--skip-same", str(src), str(dst)]
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0
+    assert "Mismatch" not in result.output
+    # a file edited in place is seen in a later run
+    with open(src / "sub" / "f", "ab") as f:
+        f.write(b"o")
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0
+    assert f"Mismatch: ('file', '{src / 'sub' / 'f'}'" in result.output
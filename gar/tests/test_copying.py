@@ -1,9 +1,11 @@
 import pytest
+import sys
 import os
 import pwd
 import grp
 from pathlib import Path
 import shutil
+import tempfile
 from gar.core import copy, gcopy, verify, move, gmove, gverify
 from gar.utils import hash_cp_stat, hash_walk, dircmp, cp_stat
 def test_copy(tempf, tempdir, tempdirwithfiles):
@@ -122,4 +124,397 @@ def test_gmove(tempdirwithfiles):
     # check if dir contents are same as before
     print(ls_dir, os.listdir(tempdircopy))
     assert sorted(ls_dir) == sorted(os.listdir(tempdircopy))
-    shutil.rmtree(tempdircopy)
\ No newline at end of file
+    shutil.rmtree(tempdircopy)
+
+@pytest.mark.skipif(not os.path.isdir("/dev/shm") or
+                    os.stat("/dev/shm").st_dev == os.stat(".").st_dev,
+                    reason="needs a directory on another device")
+@pytest.mark.parametrize("workers", [None, 4])
+def test_move_cross_device(tmp_path, workers):
+    src = tmp_path / "src"
+    (src / "sub" / "deeper").mkdir(parents=True)
+    (src / "a").write_bytes(b"tempo")
+    (src / "sub" / "b").write_bytes(b"tempo" * 1000)
+    (src / "sub" / "deeper" / "c").write_bytes(b"")
+    os.symlink("../a", src / "sub" / "link")
+    os.link(src / "a", src / "sub" / "deeper" / "hard")
+    os.chmod(src / "a", 0o640)
+    mtime = os.stat(src / "sub" / "b").st_mtime_ns
+    dst = Path(tempfile.mkdtemp(dir="/dev/shm"))
+    try:
+        move(src, dst, workers=workers)
+        assert os.listdir(src) == []
+        assert (dst / "a").read_bytes() == b"tempo"
+        assert os.stat(dst / "a").st_mode & 0o777 == 0o640
+        assert os.stat(dst / "sub" / "b").st_mtime_ns == mtime
+        assert os.readlink(dst / "sub" / "link") == "../a"
+        assert (dst / "sub" / "deeper" / "c").exists()
+        assert os.stat(dst / "sub" / "deeper" / "hard").st_ino == \
+            os.stat(dst / "a").st_ino
+    finally:
+        shutil.rmtree(dst)
+
+
+@pytest.mark.parametrize("workers", [None, 4])
+def test_copy_hardlinks(tmp_path, workers):
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    (src / "sub").mkdir(parents=True)
+    dst.mkdir()
+    (src / "a").write_bytes(b"tempo")
+    os.link(src / "a", src / "sub" / "a1")
+    os.link(src / "a", src / "sub" / "a2")
+    (src / "b").write_bytes(b"tempo")
+    copy(src, dst, workers=workers)
+    ino = os.stat(dst / "a").st_ino
+    assert os.stat(dst / "sub" / "a1").st_ino == ino
+    assert os.stat(dst / "sub" / "a2").st_ino == ino
+    assert os.stat(dst / "a").st_nlink == 3
+    assert verify(src, dst)['Mismatch'] == []
+
+    # a broken link is relinked on recopy
+    os.unlink(dst / "sub" / "a2")
+    (dst / "sub" / "a2").write_bytes(b"tempo")
+    shutil.copystat(src / "a", dst / "sub" / "a2")
+    compare = verify(src, dst)
+    assert ('hardlink', str(src / "sub" / "a2"),
+            str(dst / "sub" / "a2")) in compare['Mismatch']
+    copy(src, dst, workers=workers)
+    assert os.stat(dst / "sub" / "a2").st_ino == ino
+    assert verify(src, dst)['Mismatch'] == []
+
+
+def test_copy_sparse(tmp_path):
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    src.mkdir()
+    dst.mkdir()
+    with open(src / "sparse", "wb") as f:
+        f.write(b"tempo")
+        f.truncate(8 * 1024 * 1024)
+    (src / "dense").write_bytes(b"tempo")
+    copy(src, dst)
+    compare = verify(src, dst)
+    assert compare['Mismatch'] == []
+    sparse = {s: sizes for s, d, *sizes in compare['Sparse']}
+    if (src / "sparse").stat().st_blocks * 512 < 8 * 1024 * 1024:
+        size, salloc, dalloc = sparse[str(src / "sparse")]
+        assert size == 8 * 1024 * 1024
+        assert dalloc < size
+    assert str(src / "dense") not in sparse
+
+
+def test_copy_journal(tmp_path, garhome):
+    from gar.journal import Journal
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    for d in ["a", "b", "a/sub"]:
+        (src / d).mkdir(parents=True)
+        (src / d / "f").write_bytes(b"tempo")
+    dst.mkdir()
+    path = tmp_path / "journal"
+    journal = Journal(src, dst, path=path)
+    copy(src, dst, journal=journal)
+    # interrupted job, journal is kept
+    journal.close()
+    assert Journal.load(path)[0] == {"a", "b", os.path.join("a", "sub")}
+
+    (src / "a" / "new").write_bytes(b"tempo")
+    (src / "c").mkdir()
+    (src / "c" / "f").write_bytes(b"tempo")
+    with Journal(src, dst, path=path, resume=True) as journal:
+        copy(src, dst, journal=journal)
+    # finished subtree skipped
+    assert not (dst / "a" / "new").exists()
+    assert (dst / "c" / "f").exists()
+    assert not path.exists()
+
+    # a torn record is dropped
+    path.write_text('"a"\n"b')
+    assert Journal.load(path) == ({"a"}, 4)
+    journal = Journal(src, dst, path=path, resume=True)
+    assert journal.finished(src / "a")
+    assert not journal.finished(src / "b")
+    journal.record(src / "c")
+    journal.close()
+    assert Journal.load(path)[0] == {"a", "c"}
+
+    # copies filtered by different groups have their own journals
+    paths = set()
+    for group in [None, "a", "b"]:
+        journal = Journal(src, dst, group=group)
+        paths.add(journal.path)
+        journal.close(complete=True)
+    assert len(paths) == 3
+
+
+def test_move_dirs(tmp_path):
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    (src / "new").mkdir(parents=True)
+    (src / "old").mkdir()
+    (dst / "old").mkdir(parents=True)
+    (src / "new" / "f").write_bytes(b"tempo")
+    (src / "old" / "g").write_bytes(b"tempo")
+    (dst / "old" / "h").write_bytes(b"tempo")
+    ino = os.stat(src / "new").st_ino
+    move(src, dst)
+    # missing directory renamed, existing one merged
+    assert os.stat(dst / "new").st_ino == ino
+    assert sorted(os.listdir(dst / "old")) == ["g", "h"]
+    assert os.listdir(src) == []
+    with pytest.raises(ValueError):
+        move(tmp_path, dst)
+
+
+def test_copy_parallel(tempdirwithfiles):
+    testcopydir = Path() / tempdirwithfiles.name
+    testcopydir.mkdir()
+    copy(tempdirwithfiles, testcopydir, workers=4)
+    _, mismatch, miss, _ = dircmp(tempdirwithfiles, testcopydir)
+    assert mismatch == []
+    assert miss == []
+    assert hash_walk(tempdirwithfiles) == hash_walk(testcopydir)
+    shutil.rmtree(testcopydir)
+
+
+def test_copy_manifest(tempdirwithfiles, tmp_path):
+    from gar.manifest import Manifest
+    (tempdirwithfiles / "mf").write_bytes(b"tempo")
+    testcopydir = Path() / tempdirwithfiles.name
+    testcopydir.mkdir()
+    mfpath = tmp_path / "manifest.sqlite"
+    with Manifest(tempdirwithfiles, testcopydir, path=mfpath) as mf:
+        copy(tempdirwithfiles, testcopydir, manifest=mf)
+    _, mismatch, miss, _ = dircmp(tempdirwithfiles, testcopydir)
+    assert mismatch == []
+    assert miss == []
+
+    # files unchanged in manifest are not checked in dst
+    removed = testcopydir / "mf"
+    removed.unlink()
+    with Manifest(tempdirwithfiles, testcopydir, path=mfpath) as mf:
+        copy(tempdirwithfiles, testcopydir, manifest=mf)
+    assert not removed.exists()
+    # unless dst is rescanned
+    with Manifest(tempdirwithfiles, testcopydir, path=mfpath) as mf:
+        copy(tempdirwithfiles, testcopydir, manifest=mf, rescan_dst=True)
+    assert removed.exists()
+    shutil.rmtree(testcopydir)
+
+
+def test_verify_checksum(tempdirwithfiles):
+    (tempdirwithfiles / "cs").write_bytes(b"tempo")
+    tempdircopy = Path() / tempdirwithfiles.name
+    tempdircopy.mkdir()
+    copy(tempdirwithfiles, tempdircopy)
+    compare = verify(tempdirwithfiles, tempdircopy, checksum="sha256")
+    assert compare['Mismatch'] == []
+    assert (str(tempdirwithfiles / "cs"),
+            str(tempdircopy / "cs")) in compare['Match']
+
+    # corrupt content keeping size and times
+    cs = tempdircopy / "cs"
+    cstat = cs.stat()
+    cs.write_bytes(b"tampo")
+    os.utime(cs, ns=(cstat.st_atime_ns, cstat.st_mtime_ns))
+    assert verify(tempdirwithfiles, tempdircopy)['Mismatch'] == []
+    compare = verify(tempdirwithfiles, tempdircopy, checksum="blake2b")
+    assert compare['Mismatch'] == [('content', str(tempdirwithfiles / "cs"),
+                                    str(cs))]
+    shutil.rmtree(tempdircopy)
+
+
+def test_copy_deep(tempdir):
+    """ trees deeper than recursion limit of python """
+    src = tempdir / "src"
+    src.mkdir()
+    depth = sys.getrecursionlimit() + 10
+    cwd = os.getcwd()
+    os.chdir(src)
+    try:
+        for _ in range(depth):
+            os.mkdir("x")
+            os.chdir("x")
+        Path("f").write_bytes(b"tempo")
+    finally:
+        os.chdir(cwd)
+    dst = tempdir / "dst"
+    copy(src, dst)
+    assert (dst / ("x/" * depth) / "f").read_bytes() == b"tempo"
+    # shutil.rmtree can't remove deep trees either
+    for top in [src, dst]:
+        os.chdir(top / ("x/" * depth))
+        try:
+            os.unlink("f")
+            for _ in range(depth):
+                os.chdir("..")
+                os.rmdir("x")
+        finally:
+            os.chdir(cwd)
+
+
+def test_copy_metadata_only(tempdir):
+    src = tempdir / "src"
+    dst = tempdir / "dst"
+    src.mkdir()
+    (src / "f").write_bytes(b"tempo")
+    copy(src, dst)
+    # change contents of copy keeping size and times
+    fstat = (dst / "f").stat()
+    (dst / "f").write_bytes(b"tampo")
+    os.utime(dst / "f", ns=(fstat.st_atime_ns, fstat.st_mtime_ns))
+
+    # only mode differs, contents are not copied again
+    os.chmod(src / "f", 0o600)
+    copy(src, dst)
+    assert (dst / "f").stat().st_mode == (src / "f").stat().st_mode
+    assert (dst / "f").read_bytes() == b"tampo"
+
+    # modified time differs, contents are copied
+    os.utime(src / "f", ns=(fstat.st_atime_ns, fstat.st_mtime_ns + 1))
+    copy(src, dst)
+    assert (dst / "f").read_bytes() == b"tempo"
+    assert ((dst / "f").stat().st_mtime_ns ==
+            (src / "f").stat().st_mtime_ns)
+
+
+def test_mgcopy(tempdirwithfiles, tmp_path):
+    from gar.core import mgcopy
+    (tempdirwithfiles / "mg").write_bytes(b"tempo")
+    gid = os.getegid()
+    group = grp.getgrgid(gid).gr_name
+    dst1 = tmp_path / "dst1"
+    dst2 = tmp_path / "dst2"
+    gdst = tmp_path / "gdst"
+    gdst.mkdir()
+    gcopy(group, tempdirwithfiles, gdst)
+    # same group by name and gid to two destinations
+    mgcopy({group: dst1, gid: dst2}, tempdirwithfiles)
+    for dst in [dst1, dst2]:
+        assert (dst / "mg").exists()
+        assert (sorted(os.listdir(dst)) == sorted(os.listdir(gdst)))
+        _, mismatch, miss, _ = dircmp(gdst, dst)
+        assert mismatch == []
+        assert miss == []
+
+
+@pytest.mark.parametrize("workers", [None, 4])
+def test_plan_apply(tmp_path, workers):
+    import json
+    from gar.plan import plan, apply
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    (src / "sub").mkdir(parents=True)
+    (src / "a").write_bytes(b"tempo")
+    os.link(src / "a", src / "sub" / "a1")
+    (src / "sub" / "b").write_bytes(b"tempo" * 100)
+    os.symlink("b", src / "sub" / "l")
+    planfile = tmp_path / "plan.jsonl"
+    with open(planfile, "w") as f:
+        totals = plan(src, dst, f)
+    # nothing is written by plan
+    assert not dst.exists()
+    assert totals["copy"] == [2, 505]
+    assert totals["link"] == [1, 5]
+    lines = [json.loads(line) for line in open(planfile)]
+    assert lines[0]["src"] == str(src) and lines[-1]["totals"] == totals
+    assert sorted(a["action"] for a in lines[1:-1]) == \
+        ["copy", "copy", "link", "mkdir", "mkdir", "post", "symlink"]
+    apply(planfile, workers=workers)
+    assert os.stat(dst / "sub" / "a1").st_ino == os.stat(dst / "a").st_ino
+    assert os.readlink(dst / "sub" / "l") == "b"
+    assert verify(src, dst)['Mismatch'] == []
+
+    # only changes are planned again
+    (src / "sub" / "b").write_bytes(b"tempe")
+    with open(planfile, "w") as f:
+        totals = plan(src, dst, f)
+    assert totals["copy"] == [1, 5]
+    assert totals["skip"][0] == 3
+    apply(planfile, workers=workers)
+    assert verify(src, dst)['Mismatch'] == []
+
+
+@pytest.mark.parametrize("workers", [None, 4])
+def test_copy_dedup(tmp_path, workers):
+    from gar.dedup import ObjectStore
+    from gar import instrument
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    for d in ["x", "y", "z"]:
+        (src / d).mkdir(parents=True)
+        (src / d / "f").write_bytes(b"tempo" * 1000)
+        os.utime(src / d / "f", ns=(10**18, 10**18))
+    (src / "y" / "other").write_bytes(b"tempe")
+    # same but for access time
+    os.utime(src / "z" / "f", ns=(10**18 + 1, 10**18))
+    dst.mkdir()
+    with ObjectStore(tmp_path / "store") as store:
+        copy(src, dst, store=store, workers=workers)
+        assert os.stat(dst / "x" / "f").st_ino == \
+            os.stat(dst / "y" / "f").st_ino
+        assert os.stat(dst / "x" / "f").st_ino != \
+            os.stat(dst / "z" / "f").st_ino
+        # copies of different files are linked to same object
+        assert verify(src, dst)['Mismatch'] != []
+        assert verify(src, dst, dedup=True)['Mismatch'] == []
+
+        # unchanged files are not hashed again, attributes of an object
+        # are not changed in place
+        os.unlink(dst / "y" / "f")
+        os.chmod(src / "x" / "f", 0o600)
+        instrument.reset()
+        instrument.enable()
+        try:
+            copy(src, dst, store=store, workers=workers)
+            counts = instrument.report()["counts"]
+        finally:
+            instrument.disable()
+        assert "files_hashed" not in counts
+        assert counts["files_deduplicated"] == 1
+        assert os.stat(dst / "y" / "f").st_mode & 0o777 == 0o644
+        assert os.stat(dst / "x" / "f").st_mode & 0o777 == 0o600
+        assert verify(src, dst, dedup=True)['Mismatch'] == []
+        assert (dst / "y" / "other").read_bytes() == b"tempe"
+
+        shutil.rmtree(dst / "y")
+        assert store.prune() == (2, 5005)
+
+
+@pytest.mark.parametrize("workers", [None, 4])
+def test_recopy_dedup_without_store(tmp_path, workers):
+    from gar.dedup import ObjectStore
+    from gar.plan import plan, apply
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    src.mkdir()
+    dst.mkdir()
+    for name in ["a", "b", "c"]:
+        (src / name).write_bytes(b"same")
+        os.utime(src / name, ns=(10**18, 10**18))
+    with ObjectStore(tmp_path / "store") as store:
+        copy(src, dst, store=store, workers=workers)
+    obj = next((tmp_path / "store" / "objects").glob("*/*"))
+    assert obj.stat().st_nlink == 4
+
+    # linked files are replaced, not written or changed in place
+    (src / "a").write_bytes(b"changed!")
+    os.chmod(src / "c", 0o600)
+    copy(src, dst, workers=workers)
+    assert verify(src, dst, dedup=True)['Mismatch'] == []
+    assert obj.stat().st_mode & 0o777 == 0o644
+    assert (dst / "c").stat().st_mode & 0o777 == 0o600
+    assert obj.stat().st_nlink == 2
+
+    # as in a plan applied
+    with ObjectStore(tmp_path / "store") as store:
+        copy(src, dst, store=store, workers=workers)
+    (src / "b").write_bytes(b"changed!")
+    planfile = tmp_path / "plan.jsonl"
+    with open(planfile, "w") as out:
+        plan(src, dst, out)
+    apply(planfile, workers=workers)
+    assert verify(src, dst, dedup=True)['Mismatch'] == []
+    assert (dst / "b").read_bytes() == b"changed!"
+    assert obj.read_bytes() == b"same"
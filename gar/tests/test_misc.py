@@ -30,6 +30,18 @@ def test_gid_utils(tempf):
     assert utils.user_in_group(hr_fstat['Owner'], hr_fstat['Group'])
     # test passing ints
     assert utils.user_in_group(tempf.stat().st_uid, tempf.stat().st_gid)
+
+
+def test_group_index(tempf):
+    tstat = tempf.stat()
+    index = utils.group_index(tstat.st_gid)
+    # built once per process
+    assert utils.group_index(tstat.st_gid) is index
+    assert utils.group_index(tstat.st_gid, reload=True) is index
+    assert tstat.st_gid in index.gids
+    assert index.owns(tstat, ignorefilegroup=False)
+    assert index.owns(tstat) == utils.user_in_group(tstat.st_uid,
+                                                     tstat.st_gid)
     
    
 
@@ -74,6 +86,39 @@ def test_logger_rotator(temp_log):
     assert temp_log[1].exists()
 
 
+def test_logger_pipeline(garhome):
+    import gzip
+    import logging
+    from gar import logger as garlogger
+    name = "gartest.log"
+    qh = garlogger.setup_logger(name, maxbytes=256, backupcount=2,
+                                interval=60)
+    assert garlogger.setup_logger(name) is qh
+    log = logging.getLogger("gartest")
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    log.addHandler(qh)
+    try:
+        for i in range(100):
+            log.info(f"Skipping: f{i} unchanged",
+                     extra={"aggregate": "unchanged", "path": f"f{i}"})
+        for i in range(20):
+            log.info(f"line {i:04}")
+    finally:
+        garlogger.stop_logger(name)
+        log.removeHandler(qh)
+    path = garlogger.logfilepath / name
+    lines = path.read_text().splitlines()
+    rotated = Path(f"{path}.1.gz")
+    with gzip.open(rotated, "rt") as f:
+        lines = f.read().splitlines() + lines
+    # first one passes, others are summarized when stopped
+    assert "Skipping: f0 unchanged" in lines
+    assert "Skipping: 99 files unchanged, last: f99" in lines
+    assert "line 0019" in lines
+    assert not Path(f"{path}.3.gz").exists()
+
+
 # test file utils of gar.utils
 def test_filestat(tempf):
     """ checks utils.cp_filestat, utils.hr_size """
@@ -162,3 +207,446 @@ def test_hash_utils(tempf, tempsym, tempdirwithfiles):
     #assert [x[1] for x in h1] == [x[1] for x in h2]
     #assert h1 == h2
     shutil.rmtree(tempdcopy)
+
+
+# test data transfer of gar.transfer
+def test_transfer(tempf, tempdir):
+    from gar import transfer
+    data = os.urandom(3 * 1024 * 1024 + 7)
+    tempf.write_bytes(data)
+    os.chmod(tempf, 0o640)
+    names = [name for name, _ in transfer.METHODS]
+    # each method (reflink may not be supported by filesystem)
+    # with fall back to read/write and default fall back order
+    for methods in [[n, "readwrite"] for n in names] + [None]:
+        dst = tempdir / "transfered"
+        method = transfer.copy(tempf, dst, methods=methods)
+        assert method in (methods or names)
+        assert dst.read_bytes() == data
+        assert dst.stat().st_mode == tempf.stat().st_mode
+        dst.unlink()
+    # small buffers to check resuming from offsets
+    transfer.copyfile(tempf, dst, methods=["readwrite"], bufsize=4096)
+    assert dst.read_bytes() == data
+    with pytest.raises(shutil.SameFileError):
+        transfer.copyfile(tempf, tempf)
+
+
+def test_transfer_resumable(tempf, tempdir, monkeypatch):
+    from gar import transfer
+    data = os.urandom(10 * 4096 + 7)
+    tempf.write_bytes(data)
+    dst = tempdir / "resumed"
+    part, ckpt = transfer.partial_paths(dst)
+    write_checkpoint = transfer._write_checkpoint
+    copied = []
+
+    def interrupted(ckpt, sstat, chunksize, offset):
+        write_checkpoint(ckpt, sstat, chunksize, offset)
+        copied.append(offset)
+        if len(copied) == 4:
+            raise KeyboardInterrupt()
+    monkeypatch.setattr(transfer, "_write_checkpoint", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        transfer.resumable_copyfile(tempf, dst, chunksize=4096)
+    assert not dst.exists()
+    assert os.path.exists(part) and os.path.exists(ckpt)
+
+    # resumes after the last chunk
+    transfer.resumable_copyfile(tempf, dst, chunksize=4096)
+    assert copied[4] == 5 * 4096
+    assert dst.read_bytes() == data
+    assert not (os.path.exists(part) or os.path.exists(ckpt))
+
+    # a partial copy not same as src is copied again
+    copied.clear()
+    with pytest.raises(KeyboardInterrupt):
+        transfer.resumable_copyfile(tempf, dst, chunksize=4096)
+    with open(part, "r+b") as f:
+        f.write(b"x" * 4096 * 4)
+    transfer.resumable_copyfile(tempf, dst, chunksize=4096)
+    assert copied[4] == 4096
+    assert dst.read_bytes() == data
+
+
+def test_transfer_delta(tempdir, monkeypatch):
+    from gar import transfer, instrument
+    src = tempdir / "delta"
+    dst = tempdir / "delta_copy"
+    data = bytearray(os.urandom(8 * 4096))
+    src.write_bytes(data)
+    transfer.copy(src, dst)
+    monkeypatch.setattr(transfer, "DELTA_SIZE", 4096)
+    monkeypatch.setattr(transfer, "BLOCKSIZE", 4096)
+    # a block changed in place and appended data
+    data[4096 * 3 + 10] ^= 0xff
+    src.write_bytes(bytes(data) + b"tempo")
+    instrument.reset()
+    instrument.enable()
+    try:
+        assert transfer.copy(src, dst) == "delta"
+        assert instrument.report()["counts"]["bytes_delta_written"] == \
+            4096 + 5
+    finally:
+        instrument.disable()
+    assert dst.read_bytes() == src.read_bytes()
+    # truncated src
+    src.write_bytes(bytes(data[:5000]))
+    assert transfer.copy(src, dst) == "delta"
+    assert dst.read_bytes() == src.read_bytes()
+    # files with other links are copied again
+    os.link(dst, tempdir / "delta_link")
+    src.write_bytes(bytes(data[:6000]))
+    assert transfer.copy(src, dst) != "delta"
+    os.unlink(tempdir / "delta_link")
+    # small files are copied again
+    src.write_bytes(b"tempo")
+    assert transfer.copy(src, dst) != "delta"
+    assert dst.read_bytes() == b"tempo"
+
+
+def test_transfer_sparse(tempdir):
+    from gar import transfer
+    src = tempdir / "sparse"
+    data = os.urandom(4096)
+    with open(src, "wb") as f:
+        f.seek(4 * 1024 * 1024)
+        f.write(data)
+        f.truncate(16 * 1024 * 1024)
+    if not utils.is_sparse(src.stat()):
+        pytest.skip("filesystem doesn't support holes")
+    holes = tempdir / "holes"
+    with open(holes, "wb") as f:
+        f.truncate(1024 * 1024)
+    names = [name for name, _ in transfer.METHODS if name != "reflink"]
+    for methods in [[n] for n in names]:
+        for fi in (src, holes):
+            dst = tempdir / "sparsecopy"
+            transfer.copyfile(fi, dst, methods=methods, bufsize=1024)
+            assert dst.stat().st_size == fi.stat().st_size
+            assert dst.stat().st_blocks <= 2 * fi.stat().st_blocks
+            assert dst.read_bytes() == fi.read_bytes()
+            dst.unlink()
+
+
+# test content checksums of gar.checksum
+def test_checksum(tempf, tempdir):
+    from gar import checksum
+    copyf = tempdir / "copyf"
+    shutil.copy2(tempf, copyf)
+    emptyf = tempdir / "emptyf"
+    emptyf.touch()
+    assert (checksum.file_digest(tempf) ==
+            hashlib.sha256(tempf.read_bytes()).hexdigest())
+    assert (checksum.file_digest(emptyf, "blake2b") ==
+            hashlib.blake2b().hexdigest())
+    with pytest.raises(ValueError):
+        checksum.new_hash("md4")
+
+    pairs = [(str(tempf), str(copyf)), (str(tempf), str(emptyf))]
+    # tiny max_inflight hashes one pair at a time
+    compared = sorted(checksum.compare_pairs(pairs, workers=2,
+                                             max_inflight=1))
+    assert compared == [(str(tempf), str(copyf), True),
+                        (str(tempf), str(emptyf), False)]
+
+
+def test_idircmp(tempdir, tempf):
+    sdir = tempdir / "s"
+    ddir = tempdir / "d"
+    (sdir / "sub").mkdir(parents=True)
+    ddir.mkdir()
+    shutil.copy2(tempf, sdir / "f")
+    results = utils.idircmp(sdir, ddir)
+    # results are generated while walking
+    assert iter(results) is results
+    results = list(results)
+    assert {(r.status, r.kind) for r in results} == {(utils.MISS, 'file'),
+                                                     (utils.MISS, 'dir')}
+    shutil.copy2(sdir / "f", ddir / "f")
+    match, mismatch, miss, skip = utils.dircmp(sdir, ddir)
+    assert match == [(str(sdir / "f"), str(ddir / "f"))]
+    assert miss == [(str(sdir / "sub"), str(ddir / "sub"))]
+
+
+def test_merkle(tempdir, monkeypatch):
+    from gar import merkle
+    from gar.core import copy
+    src = tempdir / "s"
+    dst = tempdir / "d"
+    for d in ["a", "a/b", "c"]:
+        (src / d).mkdir(parents=True)
+        (src / d / "f").write_bytes(b"tempo")
+    os.symlink("f", src / "c" / "l")
+    dst.mkdir()
+    copy(src, dst)
+    digests = merkle.tree_digests(src)
+    assert set(digests) == {".", "a", os.path.join("a", "b"), "c"}
+    assert merkle.tree_digests(dst) == digests
+    assert utils.hash_walk(src) == utils.hash_walk(dst) == digests["."]
+
+    # a change in a subtree changes digests up to top
+    (dst / "a" / "b" / "f").write_bytes(b"tempe")
+    changed = merkle.tree_digests(dst)
+    assert {k for k in digests if digests[k] != changed[k]} == \
+        {".", "a", os.path.join("a", "b")}
+    match, mismatch, miss, _ = utils.dircmp(src, dst, skip_same=True)
+    assert (str(src / "c"), str(dst / "c")) in match
+    assert ('file', str(src / "a" / "b" / "f"),
+            str(dst / "a" / "b" / "f")) in mismatch
+    parallel = list(utils.pdircmp(src, dst, skip_same=True))
+    assert [r for r in parallel if r.kind == 'tree'] == \
+        [utils.CmpResult(utils.MATCH, 'tree', str(src / "c"),
+                         str(dst / "c"))]
+
+    # cache also directories just changed
+    monkeypatch.setattr(merkle, "RACY_NS", 0)
+    with merkle.DigestCache(tempdir / "cache") as cache:
+        cached = merkle.tree_digest(src, cache=cache)
+        # caveat: edit in place doesn't change time of directory
+        with open(src / "a" / "f", "ab") as f:
+            f.write(b"o")
+        assert merkle.tree_digest(src, cache=cache) == cached
+        assert merkle.tree_digest(src) != cached
+        (src / "a" / "new").write_bytes(b"")
+        assert merkle.tree_digest(src, cache=cache) == \
+            merkle.tree_digest(src)
+
+
+def test_pdircmp(tempdir, tempf):
+    sdir = tempdir / "s"
+    ddir = tempdir / "d"
+    for sub in ["a/b/c", "a/d", "e"]:
+        (sdir / sub).mkdir(parents=True)
+        shutil.copy2(tempf, sdir / sub / "f")
+    ddir.mkdir()
+    shutil.copytree(sdir / "a", ddir / "a")
+    serial = sorted(utils.idircmp(sdir, ddir))
+    parallel = list(utils.pdircmp(sdir, ddir, workers=4))
+    assert sorted(parallel) == serial
+    # deterministic order
+    for _ in range(3):
+        assert list(utils.pdircmp(sdir, ddir, workers=4)) == parallel
+    assert list(utils.pdircmp(sdir, ddir, workers=4, prefetch=1)) == \
+        parallel
+    # closing early stops walking
+    results = utils.pdircmp(sdir, ddir, workers=2)
+    next(results)
+    results.close()
+
+
+def test_pdircmp_prefetch(tempdir, monkeypatch):
+    import time
+    for i in range(50):
+        (tempdir / "s" / str(i)).mkdir(parents=True)
+    (tempdir / "d").mkdir()
+    compared = []
+    cmp_dir = utils._cmp_dir
+
+    def counted(sroot, *args):
+        compared.append(sroot)
+        return cmp_dir(sroot, *args)
+    monkeypatch.setattr(utils, "_cmp_dir", counted)
+    results = utils.pdircmp(tempdir / "s", tempdir / "d", workers=4,
+                            prefetch=3)
+    next(results)
+    time.sleep(0.2)
+    # directories are not compared far ahead of a slow consumer
+    assert len(compared) <= 4
+    assert len(list(results)) == 49
+    assert len(compared) == 51
+
+
+def test_scantree(tempdir, tempf):
+    from gar import walk
+    (tempdir / "a" / "b").mkdir(parents=True)
+    shutil.copy2(tempf, tempdir / "a" / "f")
+    os.symlink("a", tempdir / "lnk")
+    events = [(e, os.path.relpath(en.path, tempdir))
+              for e, en in walk.scantree(tempdir)]
+    # directories are entered before and left after their entries
+    assert events.index((walk.DIR, "a")) < events.index((walk.FILE, "a/f"))
+    assert events.index((walk.POST, "a/b")) < events.index((walk.POST, "a"))
+    assert events.index((walk.FILE, "a/f")) < events.index((walk.POST, "a"))
+    # links to directories are not followed
+    assert (walk.FILE, "lnk") in events
+    # pruning directories
+    events = [os.path.relpath(en.path, tempdir) for _, en in
+              walk.scantree(tempdir, enter=lambda en: en.name != "a")]
+    assert sorted(events) == ["lnk"]
+
+    entry = walk.Entry(tempdir / "lnk")
+    assert entry.is_symlink() and entry.is_dir()
+    assert not entry.is_dir(follow_symlinks=False)
+    assert entry.stat().st_ino == (tempdir / "a").stat().st_ino
+    assert entry.readable()
+
+
+def test_benchmark_tree(tempdir):
+    from gar.benchmarks import make_tree, run_benchmarks
+    from gar.benchmarks.run import compare_results
+    stats1 = make_tree(tempdir / "t1", files=20, depth=2, fanout=2, seed=3)
+    stats2 = make_tree(tempdir / "t2", files=20, depth=2, fanout=2, seed=3)
+    assert stats1 == stats2
+    assert stats1["files"] == 20
+    from gar.checksum import file_digest
+    for f in (tempdir / "t1").rglob("f*"):
+        f2 = tempdir / "t2" / f.relative_to(tempdir / "t1")
+        assert file_digest(f) == file_digest(f2)
+
+    tree = dict(files=10, depth=1, fanout=2)
+    results = run_benchmarks(tree, operations=["copy", "move"],
+                             workdir=tempdir)
+    runs = [(r["operation"], r["run"]) for r in results["results"]]
+    assert runs == [("copy", "cold"), ("copy", "warm"), ("move", "cold")]
+    assert compare_results(results, results) == []
+
+
+def test_instrument():
+    from gar import instrument
+    instrument.reset()
+    with instrument.timer("phase"):
+        instrument.count("counter")
+    assert instrument.report() == {"phases": {}, "counts": {}}
+    instrument.enable()
+    try:
+        with instrument.timer("phase"):
+            instrument.count("counter", 2)
+    finally:
+        instrument.disable()
+    rep = instrument.report()
+    assert rep["phases"]["phase"]["calls"] == 1
+    assert rep["counts"] == {"counter": 2}
+    assert "phase" in instrument.format_report(wall=1)
+    instrument.reset()
+
+
+def test_progress(tempdir, tempf):
+    from gar.progress import Progress
+    import json
+    shutil.copy2(tempf, tempdir / "f1")
+    shutil.copy2(tempf, tempdir / "f2")
+    status = tempdir / "status.json"
+    with Progress(stream=None, status_file=status, interval=0) as progress:
+        progress.prescan(tempdir, background=False)
+        assert (progress.total_files, progress.total_bytes) == (2, 10)
+        assert progress.eta() is None
+        progress.update(1, 5, 5)
+        assert json.loads(status.read_text())["files_done"] == 1
+        assert progress.eta() is not None
+        assert "1/2" in progress.line()
+    assert json.loads(status.read_text())["state"] == "done"
+    # subtrees finished by a resumed copy are not counted
+    (tempdir / "done").mkdir()
+    shutil.copy2(tempf, tempdir / "done" / "f3")
+    progress = Progress(stream=None)
+    progress.prescan(tempdir, background=False,
+                     skip=lambda di: di.name == "done",
+                     ignore=lambda fi: fi.name == "status.json")
+    assert (progress.total_files, progress.total_bytes) == (2, 10)
+
+
+def test_throttle(tempdir, monkeypatch):
+    import time
+    from gar import throttle, transfer
+    assert throttle.parse_limits("1.5M/20") == (1.5 * 1024 * 1024, 20.0)
+    assert throttle.parse_limits("-/10") == (None, 10.0)
+    assert throttle.parse_limits("0") == (None, None)
+    assert throttle.parse_schedule("22:00-06:00=100M") == \
+        [(22 * 60, 6 * 60, (100 * 1024 * 1024, None))]
+    with pytest.raises(ValueError):
+        throttle.parse_schedule("08:00=1M")
+
+    # schedule windows can span midnight
+    night = throttle.Throttle(bandwidth=1024, schedule=throttle.
+                              parse_schedule("22:00-06:00=-/5"))
+    monkeypatch.setattr(time, "localtime",
+                        lambda now=None: time.struct_time(
+                            (2024, 1, 1, 23, 30, 0, 0, 1, 0)))
+    assert night.current_limits() == (None, 5.0)
+    monkeypatch.undo()
+
+    # debt of a bucket is paid back by sleeping
+    bucket = throttle.TokenBucket(rate=1000, burst=0.1)
+    bucket.take(100)
+    assert bucket.take(100) == pytest.approx(0.1, abs=0.02)
+
+    src = tempdir / "throttled"
+    src.write_bytes(b"t" * 300 * 1024)
+    control = tempdir / "limits"
+    limits = throttle.Throttle(bandwidth=1024 * 1024, control_file=control)
+    previous = throttle.install(limits)
+    try:
+        start = time.monotonic()
+        transfer.copy(src, tempdir / "copy", methods=["readwrite"])
+        # burst of a second covers the file
+        assert time.monotonic() - start < 0.5
+        # control file overrides the limit
+        control.write_text("1M/2")
+        limits.reload = True
+        start = time.monotonic()
+        for i in range(4):
+            transfer.copy(src, tempdir / f"copy{i}", methods=["readwrite"])
+        assert limits.files.rate == 2.0
+        assert time.monotonic() - start > 0.5
+    finally:
+        throttle.install(previous)
+    assert (tempdir / "copy3").read_bytes() == src.read_bytes()
+
+    try:
+        throttle.set_ioprio("best-effort", 4)
+    except OSError:
+        pytest.skip("ioprio_set not permitted")
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_archive(tempdir, compress, monkeypatch):
+    import tarfile
+    from gar import archive
+    if compress:
+        pytest.importorskip("zstandard")
+    src = tempdir / "src"
+    (src / "sub" / "empty").mkdir(parents=True)
+    (src / "a").write_bytes(b"tempo")
+    os.link(src / "a", src / "sub" / "a1")
+    (src / "sub" / "b").write_bytes(os.urandom(50000))
+    os.symlink("../a", src / "sub" / "l")
+    try:
+        os.setxattr(src / "a", "user.gar", b"\xfftempo")
+    except OSError:
+        pass
+    out = tempdir / "out.tar"
+    totals = archive.write_archive(src, out, index=archive.index_path(out),
+                                   level=3 if compress else None,
+                                   framesize=1024)
+    assert totals["members"] == 6
+    _, records = archive.load_index(archive.index_path(out))
+    assert records["sub/a1"]["type"] == "link" or \
+        records["a"]["type"] == "link"
+    if compress:
+        # small frames, each member starts a new one
+        assert len({r["frame"] for r in records.values()}) > 3
+    else:
+        with tarfile.open(out) as tar:
+            assert sorted(tar.getnames()) == sorted(records)
+
+    restored = tempdir / "restored"
+    restored.mkdir()
+    for name in ["sub/b", "sub/a1", "a", "sub/l"]:
+        archive.extract_member(out, name, restored)
+    assert (restored / "sub" / "b").read_bytes() == \
+        (src / "sub" / "b").read_bytes()
+    assert (restored / "sub" / "a1").read_bytes() == b"tempo"
+    assert os.readlink(restored / "sub" / "l") == "../a"
+    assert os.stat(restored / "a").st_mtime == os.stat(src / "a").st_mtime
+    assert os.listxattr(restored / "a") == os.listxattr(src / "a")
+    with pytest.raises(KeyError):
+        archive.extract_member(out, "missing", restored)
+
+    # xattrs that cannot be set don't fail the restore
+    def setxattr(*args, **kwargs):
+        raise PermissionError(1, "Operation not permitted")
+    monkeypatch.setattr(os, "setxattr", setxattr)
+    (restored / "a").unlink()
+    archive.extract_member(out, "a", restored)
+    assert (restored / "a").read_bytes() == b"tempo"
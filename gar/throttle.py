@@ -0,0 +1,267 @@
+""" Throttling of transfers
+a Throttle limits bytes and files per second of all copies of the
+process with token buckets shared by copy worker threads. limits can
+depend on time of day (schedule) and can be changed while running with
+a control file, which is read again when it changes or on SIGHUP.
+off by default, install() a Throttle to enable it, transfer methods
+call consume() after each chunk and start_file() before each file.
+
+limits are written as RATE[/FILES], eg.. 50M/200 is 50 MiB and 200
+files per second, 20M only limits bytes and -/100 only files. 0 or -
+is no limit. a schedule is a comma separated list of HH:MM-HH:MM=LIMITS
+eg.. 08:00-18:00=20M/100, outside of its windows default limits apply.
+"""
+import os
+import re
+import time
+import errno
+import signal
+import ctypes
+import platform
+from threading import Lock
+
+UNITS = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
+# seconds after which schedule and control file are checked again
+REFRESH = 1.0
+# smallest chunk of data transferred at a time while bytes are limited
+MINCHUNK = 64 * 1024
+
+
+def parse_rate(spec):
+    """ Returns bytes of a size like 50M, 1.5G or 512k, None for 0 """
+    m = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([kmgt]?)(?:i?b)?\s*", spec,
+                     re.IGNORECASE)
+    if not m:
+        raise ValueError(f"invalid rate {spec}")
+    return float(m.group(1)) * UNITS[m.group(2).lower()] or None
+
+
+def parse_limits(spec):
+    """ Returns (bytes per second, files per second) of RATE[/FILES]
+    None is no limit
+    """
+    rate, _, files = spec.strip().partition("/")
+    rate, files = rate.strip(), files.strip()
+    bps = None if rate in ("", "-") else parse_rate(rate)
+    try:
+        fps = None if files in ("", "-") else float(files) or None
+    except ValueError:
+        raise ValueError(f"invalid files per second {files}")
+    return bps, fps
+
+
+def _minutes(hhmm):
+    hours, _, minutes = hhmm.strip().partition(":")
+    value = int(hours) * 60 + int(minutes or 0)
+    if not 0 <= value <= 24 * 60:
+        raise ValueError(f"invalid time {hhmm}")
+    return value
+
+
+def parse_schedule(spec):
+    """ Returns list of (start, end, limits) of a schedule
+    start and end are minutes of day
+    """
+    schedule = []
+    for window in filter(None, (w.strip() for w in spec.split(","))):
+        times, sep, limits = window.partition("=")
+        start, dash, end = times.partition("-")
+        if not (sep and dash):
+            raise ValueError(f"invalid schedule {window}, "
+                             "expected HH:MM-HH:MM=LIMITS")
+        try:
+            schedule.append((_minutes(start), _minutes(end),
+                             parse_limits(limits)))
+        except ValueError:
+            raise ValueError(f"invalid schedule {window}")
+    return schedule
+
+
+class TokenBucket:
+    """ Thread safe token bucket of rate tokens per second holding
+    at most burst seconds of tokens, rate None is no limit.
+    take() goes into debt and sleeps until it is paid back, so
+    threads taking tokens together share the rate.
+    """
+    def __init__(self, rate=None, burst=1.0):
+        self.lock = Lock()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = (rate or 0) * burst
+        self.last = time.monotonic()
+
+    def _refill(self, now):
+        if self.rate:
+            self.tokens = min(self.tokens + (now - self.last) * self.rate,
+                              self.rate * self.burst)
+        self.last = now
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill(time.monotonic())
+            # a bucket that was not limited starts full
+            if not self.rate:
+                self.tokens = (rate or 0) * self.burst
+            self.rate = rate
+
+    def take(self, n):
+        """ takes n tokens, returns seconds slept for them """
+        with self.lock:
+            if not self.rate:
+                return 0.0
+            self._refill(time.monotonic())
+            self.tokens -= n
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
+class Throttle:
+    """ Limits of bytes (bandwidth) and files per second of transfers
+    schedule (see parse_schedule) sets other limits in windows of time
+    of day. limits in control_file (RATE[/FILES]) override both while
+    it exists.
+    """
+    def __init__(self, bandwidth=None, files=None, schedule=None,
+                 control_file=None):
+        self.limits = (bandwidth, files)
+        self.schedule = schedule or []
+        self.control_file = control_file
+        # (modified time, limits) of control file
+        self.control = (None, None)
+        self.data = TokenBucket()
+        self.files = TokenBucket()
+        self.lock = Lock()
+        self.checked = None
+        self.reload = False
+        self.refresh(force=True)
+
+    def current_limits(self, now=None):
+        """ limits of control file, schedule or default limits """
+        if self.control[1] is not None:
+            return self.control[1]
+        t = time.localtime(now)
+        minute = t.tm_hour * 60 + t.tm_min
+        for start, end, limits in self.schedule:
+            # windows can span midnight
+            if start <= minute < end if start <= end else \
+                    (minute >= start or minute < end):
+                return limits
+        return self.limits
+
+    def _read_control(self):
+        try:
+            mtime = os.stat(self.control_file).st_mtime_ns
+        except FileNotFoundError:
+            self.control = (None, None)
+            return
+        if mtime == self.control[0] and not self.reload:
+            return
+        limits = self.control[1]
+        try:
+            with open(self.control_file) as f:
+                limits = parse_limits(f.read())
+        # keep limits while control file is invalid
+        except (OSError, ValueError):
+            pass
+        self.control = (mtime, limits)
+
+    def refresh(self, force=False):
+        """ applies current limits, at most once every REFRESH seconds
+        unless forced or reload is requested (eg.. by signal)
+        """
+        now = time.monotonic()
+        if not (force or self.reload) and now - self.checked < REFRESH:
+            return
+        # one thread refreshes at a time, others go on with old limits
+        if not self.lock.acquire(blocking=force):
+            return
+        try:
+            self.checked = now
+            if self.control_file:
+                self._read_control()
+            self.reload = False
+            bandwidth, files = self.current_limits()
+            if bandwidth != self.data.rate:
+                self.data.set_rate(bandwidth)
+            if files != self.files.rate:
+                self.files.set_rate(files)
+        finally:
+            self.lock.release()
+
+    def start_file(self):
+        self.refresh()
+        return self.files.take(1)
+
+    def consume(self, n):
+        self.refresh()
+        return self.data.take(n)
+
+    def chunksize(self, bufsize):
+        """ bufsize limited to a tenth of a second of bandwidth """
+        rate = self.data.rate
+        if not rate:
+            return bufsize
+        return max(min(bufsize, int(rate / 10)), MINCHUNK)
+
+    def handle_signal(self, signum=signal.SIGHUP):
+        """ limits are read again on signal signum
+        returns previous handler of signum
+        """
+        def handler(signum, frame):
+            self.reload = True
+        return signal.signal(signum, handler)
+
+
+_throttle = None
+
+
+def install(throttle):
+    """ throttles transfers of the process with throttle (a Throttle or
+    None to disable), returns throttle installed before
+    """
+    global _throttle
+    previous, _throttle = _throttle, throttle
+    return previous
+
+
+def start_file():
+    if _throttle is not None:
+        _throttle.start_file()
+
+
+def consume(n):
+    if _throttle is not None:
+        _throttle.consume(n)
+
+
+def chunksize(bufsize):
+    if _throttle is None:
+        return bufsize
+    return _throttle.chunksize(bufsize)
+
+
+IOPRIO_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+IOPRIO_WHO_PROCESS = 1
+# numbers of ioprio_set system call
+_IOPRIO_SET = {"x86_64": 251, "aarch64": 30, "riscv64": 30, "i386": 289,
+               "i686": 289, "ppc64le": 273, "ppc64": 273, "s390x": 282}
+
+
+def set_ioprio(ioclass, level=4):
+    """ Sets io scheduling class (see ionice) and level (0-7) of calling
+    thread, threads it starts later (eg.. copy workers) inherit it.
+    """
+    nr = _IOPRIO_SET.get(platform.machine())
+    if nr is None:
+        raise OSError(errno.ENOSYS, "ioprio_set is not known for "
+                      f"{platform.machine()}")
+    if ioclass not in IOPRIO_CLASSES:
+        raise ValueError(f"unknown io class {ioclass}")
+    value = IOPRIO_CLASSES[ioclass] << 13 | (0 if ioclass == "idle"
+                                             else level)
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(nr, IOPRIO_WHO_PROCESS, 0, value) < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
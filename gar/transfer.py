@@ -0,0 +1,397 @@
+import os
+import json
+import stat
+import errno
+import fcntl
+from shutil import SameFileError, SpecialFileError
+from .utils import open_noatime, is_sparse
+from . import throttle
+from . import instrument
+
+# ioctl request of linux to clone a file (reflink) on btrfs, xfs ..
+FICLONE = 0x40049409
+# buffer size of read/write loop and chunks of kernel copies
+BUFSIZE = 8 * 1024 * 1024
+# files of at least this size are copied in chunks that can be resumed
+RESUMABLE_SIZE = 1024 * 1024 * 1024
+CHUNKSIZE = 64 * 1024 * 1024
+# files of at least this size already in dst are updated in place with
+# delta_copyfile, None copies them again (see gar copy --delta)
+DELTA_SIZE = None
+# blocks compared by delta_copyfile
+BLOCKSIZE = 1024 * 1024
+
+# errors on which a method is not supported for src, dst pair
+# and next method should be tried
+_fallback_errnos = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.ENOTSUP,
+                    errno.EOPNOTSUPP, errno.EBADF, errno.ENOTTY,
+                    errno.ETXTBSY, errno.EPERM}
+
+
+class FallBack(Exception):
+    """ raised by a transfer method that can't handle a file """
+
+
+def _reflink(fsrc, fdst, offset, size, bufsize):
+    # reflink only works on entire file
+    if offset:
+        raise FallBack()
+    try:
+        fcntl.ioctl(fdst, FICLONE, fsrc)
+    except OSError as ex:
+        if ex.errno in _fallback_errnos:
+            raise FallBack()
+        raise
+    return size
+
+
+def _copy_file_range(fsrc, fdst, offset, size, bufsize):
+    if not hasattr(os, "copy_file_range"):
+        raise FallBack()
+    while offset < size:
+        try:
+            n = os.copy_file_range(fsrc, fdst, min(bufsize, size - offset),
+                                   offset, offset)
+        except OSError as ex:
+            if ex.errno in _fallback_errnos:
+                raise FallBack(offset)
+            raise
+        # file shrunk while copying
+        if n == 0:
+            break
+        offset += n
+        throttle.consume(n)
+    return offset
+
+
+def _sendfile(fsrc, fdst, offset, size, bufsize):
+    os.lseek(fdst, offset, os.SEEK_SET)
+    while offset < size:
+        try:
+            n = os.sendfile(fdst, fsrc, offset, min(bufsize, size - offset))
+        except OSError as ex:
+            if ex.errno in _fallback_errnos:
+                raise FallBack(offset)
+            raise
+        if n == 0:
+            break
+        offset += n
+        throttle.consume(n)
+    return offset
+
+
+def _readwrite(fsrc, fdst, offset, size, bufsize):
+    os.lseek(fsrc, offset, os.SEEK_SET)
+    os.lseek(fdst, offset, os.SEEK_SET)
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    with open(fsrc, "rb", buffering=0, closefd=False) as fi:
+        while offset < size:
+            n = fi.readinto(view[:min(bufsize, size - offset)])
+            if not n:
+                break
+            written = 0
+            while written < n:
+                written += os.write(fdst, view[written:n])
+            offset += n
+            throttle.consume(n)
+    return offset
+
+
+# order in which transfer methods are tried
+METHODS = (("reflink", _reflink),
+           ("copy_file_range", _copy_file_range),
+           ("sendfile", _sendfile),
+           ("readwrite", _readwrite))
+
+
+def data_extents(fd, size, start=0):
+    """ yields (start, end) of data in file fd from start to size
+    skipping holes, it is one extent if SEEK_DATA/SEEK_HOLE are not
+    supported.
+    """
+    offset = start
+    while offset < size:
+        try:
+            begin = os.lseek(fd, offset, os.SEEK_DATA)
+        except (OSError, AttributeError) as ex:
+            # only a hole till end of file
+            if getattr(ex, "errno", None) == errno.ENXIO:
+                return
+            if offset != start:
+                raise
+            yield start, size
+            return
+        if begin >= size:
+            return
+        end = min(os.lseek(fd, begin, os.SEEK_HOLE), size)
+        yield begin, end
+        offset = end
+
+
+def _candidates(methods=None):
+    candidates = [(name, method) for name, method in METHODS
+                  if not methods or name in methods]
+    if not candidates:
+        raise ValueError(f"unknown transfer methods {methods}")
+    return candidates
+
+
+def _try_reflink(fsrc, fdst, size, candidates):
+    """ clones fsrc to fdst if reflink is first of candidates, reflink
+    is removed from candidates when it is not supported.
+    """
+    if candidates and candidates[0][0] == "reflink":
+        try:
+            _reflink(fsrc, fdst, 0, size, BUFSIZE)
+            return True
+        except FallBack:
+            candidates.pop(0)
+    return False
+
+
+def _copy_range(fsrc, fdst, start, end, candidates, sparse, bufsize):
+    """ Copies data of fsrc from start to end to the same offsets of fdst
+    with first method of candidates, a method that falls back is removed
+    from candidates. holes are skipped if sparse.
+    Returns False if no method could copy the data.
+    """
+    # smaller chunks while throttled, so waits are short and even
+    bufsize = throttle.chunksize(bufsize)
+    extents = data_extents(fsrc, end, start) if sparse else [(start, end)]
+    for offset, stop in extents:
+        while candidates:
+            name, method = candidates[0]
+            try:
+                method(fsrc, fdst, offset, stop, bufsize)
+                break
+            except FallBack as fb:
+                offset = fb.args[0] if fb.args else offset
+                candidates.pop(0)
+        else:
+            return False
+    return bool(candidates)
+
+
+def _check_copyable(src, dst):
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        raise SameFileError(f"{src} and {dst} are the same file")
+
+    # opening fifo etc.. would block
+    if not stat.S_ISREG(os.stat(src).st_mode):
+        raise SpecialFileError(f"`{src}` is not a regular file")
+
+
+def copyfile(src, dst, methods=None, bufsize=BUFSIZE):
+    """ Copies data of src to dst trying reflink, copy_file_range, sendfile
+    and read/write loop in that order, a method that is not supported by
+    filesystems (or python) falls back to next method from where it stopped.
+    methods can be a list of method names to restrict the ones tried.
+    of sparse files (see utils.is_sparse) only data extents are copied
+    and holes remain holes in dst.
+
+    Returns name of the method that completed the copy.
+    """
+    _check_copyable(src, dst)
+    with open(open_noatime(src), "rb") as fsrc:
+        sstat = os.fstat(fsrc.fileno())
+        with open(dst, "wb") as fdst:
+            size = sstat.st_size
+            candidates = _candidates(methods)
+            # a clone keeps holes, extents are only needed otherwise
+            if _try_reflink(fsrc.fileno(), fdst.fileno(), size, candidates):
+                return "reflink"
+            sparse = is_sparse(sstat)
+            if _copy_range(fsrc.fileno(), fdst.fileno(), 0, size,
+                           candidates, sparse, bufsize):
+                if sparse:
+                    # trailing hole
+                    os.ftruncate(fdst.fileno(), size)
+                return candidates[0][0]
+    raise OSError(f"No transfer method could copy {src} to {dst}")
+
+
+def partial_paths(dst):
+    """ Returns paths of temporary copy to dst and of its checkpoint
+    used by resumable_copyfile
+    """
+    head, tail = os.path.split(os.fspath(dst))
+    part = os.path.join(head, f".{tail}.gar-part")
+    return part, part + ".ckpt"
+
+
+def _checkpoint_key(sstat, chunksize):
+    # a checkpoint is only valid for the same version of src
+    return [sstat.st_size, sstat.st_mtime_ns, sstat.st_ino, chunksize]
+
+
+def _read_checkpoint(ckpt, sstat, chunksize):
+    """ offset up to which copy of src is done or 0 """
+    try:
+        with open(ckpt) as f:
+            checkpoint = json.load(f)
+        if checkpoint["src"] == _checkpoint_key(sstat, chunksize):
+            return int(checkpoint["offset"])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return 0
+
+
+def _write_checkpoint(ckpt, sstat, chunksize, offset):
+    tmp = ckpt + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"src": _checkpoint_key(sstat, chunksize),
+                   "offset": offset}, f)
+    os.replace(tmp, ckpt)
+
+
+def _same_range(fsrc, fdst, start, end, bufsize):
+    """ True if data of fsrc and fdst from start to end are same """
+    offset = start
+    while offset < end:
+        n = min(bufsize, end - offset)
+        data = os.pread(fsrc, n, offset)
+        if not data or data != os.pread(fdst, n, offset):
+            return False
+        offset += len(data)
+    return True
+
+
+def resumable_copyfile(src, dst, methods=None, bufsize=BUFSIZE,
+                       chunksize=CHUNKSIZE):
+    """ Copies data of src to dst like copyfile but in chunks to a
+    temporary file next to dst (see partial_paths), that is renamed
+    to dst when done. after each chunk is synced to disk its end is
+    recorded in a checkpoint file, a later copy of the same src (size,
+    modified time and inode) resumes after the last chunk that is
+    still same as in src.
+
+    Returns name of the method that copied the data.
+    """
+    _check_copyable(src, dst)
+    part, ckpt = partial_paths(dst)
+    with open(open_noatime(src), "rb") as fsrc:
+        sstat = os.fstat(fsrc.fileno())
+        size = sstat.st_size
+        offset = _read_checkpoint(ckpt, sstat, chunksize)
+        fdst = None
+        if offset:
+            try:
+                fdst = open(part, "r+b")
+            except FileNotFoundError:
+                offset = 0
+        if fdst is None:
+            fdst = open(part, "wb")
+        with fdst:
+            candidates = _candidates(methods)
+            if offset:
+                # check last chunk before resuming after it
+                last = max(offset - chunksize, 0)
+                if os.fstat(fdst.fileno()).st_size < offset or \
+                        not _same_range(fsrc.fileno(), fdst.fileno(),
+                                        last, offset, bufsize):
+                    offset = 0
+            if not offset and _try_reflink(fsrc.fileno(), fdst.fileno(),
+                                           size, candidates):
+                offset = size
+            sparse = is_sparse(sstat)
+            while offset < size:
+                end = min(offset + chunksize, size)
+                if not _copy_range(fsrc.fileno(), fdst.fileno(), offset, end,
+                                   candidates, sparse, bufsize):
+                    raise OSError(f"No transfer method could copy {src} "
+                                  f"to {dst}")
+                os.fdatasync(fdst.fileno())
+                _write_checkpoint(ckpt, sstat, chunksize, end)
+                offset = end
+            # holes at end or a longer partial copy
+            os.ftruncate(fdst.fileno(), size)
+    os.replace(part, dst)
+    try:
+        os.unlink(ckpt)
+    except FileNotFoundError:
+        pass
+    return candidates[0][0]
+
+
+def delta_copyfile(src, dst, methods=None, blocksize=BLOCKSIZE,
+                   bufsize=BUFSIZE):
+    """ Updates an existing copy dst of src in place, blocks of
+    blocksize at same offsets of both are compared and only blocks that
+    differ are written, data after end of dst (eg.. appended) is copied
+    and dst is truncated to size of src.
+    suits files changed in place or appended to, data inserted or
+    removed shifts all blocks after it and they are all written.
+    an interrupted update leaves dst with a different modified time, so
+    it is updated again by the next copy.
+
+    Returns "delta"
+    """
+    _check_copyable(src, dst)
+    with open(open_noatime(src), "rb") as fsrc, open(dst, "r+b") as fdst:
+        sfd, dfd = fsrc.fileno(), fdst.fileno()
+        size = os.fstat(sfd).st_size
+        common = min(size, os.fstat(dfd).st_size)
+        written = 0
+        offset = 0
+        while offset < common:
+            data = os.pread(sfd, min(blocksize, common - offset), offset)
+            # src shrunk while comparing
+            if not data:
+                break
+            if data != os.pread(dfd, len(data), offset):
+                view = memoryview(data)
+                done = 0
+                while done < len(data):
+                    done += os.pwrite(dfd, view[done:], offset + done)
+                written += len(data)
+            offset += len(data)
+            throttle.consume(len(data))
+        if offset < size:
+            if not _copy_range(sfd, dfd, offset, size, _candidates(methods),
+                               False, bufsize):
+                raise OSError(f"No transfer method could copy {src} "
+                              f"to {dst}")
+            written += size - offset
+        os.ftruncate(dfd, size)
+    instrument.count("bytes_delta_written", written)
+    return "delta"
+
+
+def _delta_target(dst, size):
+    """ True if dst is a regular file to update with delta_copyfile
+    files with other links are not, their contents are shared
+    """
+    if DELTA_SIZE is None or size < DELTA_SIZE:
+        return False
+    try:
+        dstat = os.lstat(dst)
+    except FileNotFoundError:
+        return False
+    return stat.S_ISREG(dstat.st_mode) and dstat.st_nlink == 1 and \
+        os.access(dst, os.W_OK)
+
+
+def copy(src, dst, follow_symlinks=True, methods=None):
+    """ Copies data and mode bits of src to dst like shutil.copy
+    symlinks are recreated if follow_symlinks is False, files of at
+    least RESUMABLE_SIZE are copied with resumable_copyfile and an
+    existing dst of at least DELTA_SIZE is updated with delta_copyfile.
+    copies are limited by the throttle installed (see gar.throttle).
+
+    Returns name of the method used for transfer.
+    """
+    throttle.start_file()
+    if not follow_symlinks and os.path.islink(src):
+        os.symlink(os.readlink(src), dst)
+        return "symlink"
+    sstat = os.stat(src)
+    if _delta_target(dst, sstat.st_size):
+        method = delta_copyfile(src, dst, methods=methods,
+                                blocksize=BLOCKSIZE)
+    elif sstat.st_size >= RESUMABLE_SIZE:
+        method = resumable_copyfile(src, dst, methods=methods)
+    else:
+        method = copyfile(src, dst, methods=methods)
+    os.chmod(dst, stat.S_IMODE(sstat.st_mode))
+    return method
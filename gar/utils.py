@@ -1,12 +1,16 @@
 import os
 import grp
+from stat import S_ISREG
 import pwd
 import time
 import json
 import time
 from pathlib import Path
-from collections import OrderedDict
-from hashlib import sha1
+from collections import OrderedDict, namedtuple
+from threading import Event
+from concurrent.futures import ThreadPoolExecutor
+from . import instrument
+from .merkle import tree_digest, tree_digests
 
 passwdfi = Path("/etc/passwd")
 passwdfi = passwdfi if passwdfi.exists() and os.access(passwdfi, os.R_OK) else None
@@ -139,89 +143,327 @@ def hr_filestat(filepath):
              'Changed': time.ctime(fstat.st_ctime)}
     return OrderedDict(finfo)
 
-def hash_walk(fdpath, follow_symlinks=False, ignore=None):
-    """ Returns hash for entire directory tree using default hash.
-        function only scans for files, directories and symlinks:
-        special files are ignored by the has function
+def hash_walk(fdpath, ignore=None, cache=None):
+    """ Returns hash for entire directory tree
+        a merkle tree digest (see gar.merkle.tree_digest) of files,
+        directories and symlinks (not followed), special files are
+        hashed like files.
+        cache (gar.merkle.DigestCache) rescans only directories that
+        changed since they were hashed, mind the caveat in gar.merkle.
     """
     if not isinstance(fdpath, Path):
         fdpath = Path(fdpath)
     if not fdpath.exists():
         return None
-    files_hash = sha1()
-    # use walk and sorted to ensure the listing order is same every run
-    # files without read permissions will be ignored
-    for root, dirs, files in os.walk(fdpath):
-        root = Path(root)
-        # functions called ignore all other kinds of files (eg.., device files)
-        # ignore read errors
-        for fi in sorted(files):
-            # skip files that are not readable
-            if not os.access(fi, os.R_OK):
-                continue
-            fip = root / fi
-            files_hash.update(hash_cp_stat(fip, hash_function=sha1).hexdigest().encode())
-        for d in sorted(dirs):
-            # remove directory that are not readable from traversing further
-            if not os.access(d, os.R_OK):
-                dirs.remove(d)
-                continue
-            dp = root / d
-            files_hash.update(hash_cp_stat(dp, hash_function=sha1).hexdigest().encode())
-    return files_hash.hexdigest()
+    return tree_digest(fdpath, cache=cache, ignore=ignore)
 
-def dircmp(src, dst, ignore=None):
-    """ Compares files in src to dst for integrity
-    returns list of match, missmatch, skip and misses
-    use of os.walk makes it skip files and directories
-    not readable.
+# status of compared files and directories
+MATCH, MISMATCH, MISS, SKIP = "Match", "Mismatch", "Miss", "Skipped"
+
+
+class CmpResult(namedtuple("CmpResult", ["status", "kind", "src", "dst"])):
+    """ Result of comparing a file or directory src to dst
+    status is one of MATCH, MISMATCH, MISS, SKIP and
+    kind is 'file', 'dir', 'content' (for contents of a file),
+    'hardlink' (see ilinkcmp) or 'tree' (a subtree skipped as same).
+    """
+    __slots__ = ()
+
+    def astuple(self):
+        """ representation used by lists of dircmp """
+        if self.status == MISMATCH:
+            return (self.kind, self.src, self.dst)
+        if self.status == SKIP:
+            return self.src
+        return (self.src, self.dst)
+
+
+def _cmp_entry(fdsp, kind, src, dst, ignore=None):
+    """ Returns CmpResult of a file or directory fdsp of src or None
+    if ignored
     """
+    fddp = os.path.relpath(os.path.abspath(fdsp), src)
+    fddp = dst / fddp
+    if kind == 'file':
+        # ignore files if ignore is True
+        if ignore and ignore(fdsp):
+            return None
+        # skips any unsupported file and
+        # read errors (eg.., permissions, linkerrors)
+        if not os.access(fdsp, os.R_OK):
+            return CmpResult(SKIP, kind, str(fdsp), str(fddp))
+    # not necessary to check os.R_OK of symlink dir
+    # because dir links are not resolved by os.walk
+    if not fddp.exists():
+        return CmpResult(MISS, kind, str(fdsp), str(fddp))
+    if cp_stat(fdsp) == cp_stat(fddp):
+        return CmpResult(MATCH, kind, str(fdsp), str(fddp))
+    return CmpResult(MISMATCH, kind, str(fdsp), str(fddp))
+
+
+def _cmp_entries(sroot, sdirs, sfiles, src, dst, ignore=None):
+    """ yields CmpResult of files and directories in sroot of src """
+    sroot = Path(sroot)
+    for kind, names in (('file', sfiles), ('dir', sdirs)):
+        for name in names:
+            with instrument.timer("compare"):
+                result = _cmp_entry(sroot / name, kind, src, dst, ignore)
+            if result is not None:
+                yield result
+
+
+def _check_dirs(src, dst):
     if not (isinstance(src, Path) and isinstance(dst, Path)):
         src = Path(src)
         dst = Path(dst)
     if not (src.is_dir() and dst.is_dir()):
         raise NotADirectoryError(f"src: {src} and dst: {dst} must be directories")
-    match = []
-    mismatch = []
-    miss = []
-    skip = []
+    return src, dst
+
+
+def _tree_digests(src, dst, ignore=None, skip_same=False):
+    """ digests of directories of src and dst to skip same subtrees
+    computed without a DigestCache, it doesn't see files edited in place
+    """
+    if not skip_same or ignore:
+        return None
+    return (tree_digests(src), tree_digests(dst))
+
+
+def _same_subtrees(sroot, sdirs, src, dst, digests):
+    """ Returns CmpResults (kind 'tree') of subdirectories of sroot with
+    same digests in src and dst and list of other subdirectories
+    """
+    if digests is None:
+        return [], sdirs
+    rel = os.path.relpath(sroot, src)
+    same, others = [], []
+    for d in sdirs:
+        key = d if rel == "." else os.path.join(rel, d)
+        digest = digests[0].get(key)
+        if digest is not None and digest == digests[1].get(key):
+            same.append(CmpResult(MATCH, 'tree', os.path.join(sroot, d),
+                                  str(dst / key)))
+        else:
+            others.append(d)
+    return same, others
+
+
+def idircmp(src, dst, ignore=None, skip_same=False):
+    """ Compares files in src to dst for integrity
+    yields CmpResult of each file and directory as src is walked
+    use of os.walk makes it skip files and directories
+    not readable.
+    skip_same compares merkle digests (see gar.merkle) of directories
+    first, subtrees with same digests in src and dst are not walked and
+    are a single MATCH of kind 'tree'. digests are computed in a pass
+    over both trees, so only comparisons of contents (see core.iverify)
+    are saved. skip_same has no effect with ignore.
+    """
+    src, dst = _check_dirs(src, dst)
+    digests = _tree_digests(src, dst, ignore, skip_same)
     for sroot, sdirs, sfiles in os.walk(src, followlinks=False):
-        sroot = Path(sroot)
-        for fi in sfiles:
-            fisp = sroot / fi
-            # ignore files if ignore is True
-            if ignore and ignore(fi):
-                continue
-            fidp = os.path.relpath(os.path.abspath(fisp), src)
-            fidp = dst / fidp
-            # skips any unsupported file and
-            # read errors (eg.., permissions, linkerrors)
-            if not os.access(fi, os.R_OK):
-                skip.append(fi)
+        same, sdirs[:] = _same_subtrees(sroot, sdirs, src, dst, digests)
+        yield from _cmp_entries(sroot, sdirs, sfiles, src, dst, ignore)
+        yield from same
+
+
+def _cmp_dir(sroot, src, dst, ignore=None, digests=None):
+    """ Compares entries of a directory sroot like a step of os.walk
+    returns list of CmpResult sorted by name and subdirectories to walk
+    """
+    sdirs, sfiles = [], []
+    try:
+        with instrument.timer("scan"), os.scandir(sroot) as it:
+            for entry in it:
+                try:
+                    isdir = entry.is_dir()
+                except OSError:
+                    isdir = False
+                (sdirs if isdir else sfiles).append(entry.name)
+    except OSError:
+        # not readable directories are skipped like os.walk
+        return [], []
+    sdirs.sort()
+    sfiles.sort()
+    same, sdirs = _same_subtrees(sroot, sdirs, src, dst, digests)
+    results = list(_cmp_entries(sroot, sdirs, sfiles, src, dst, ignore))
+    results.extend(same)
+    walkdirs = [os.path.join(sroot, d) for d in sdirs
+                if not os.path.islink(os.path.join(sroot, d))]
+    return results, walkdirs
+
+
+def pdircmp(src, dst, ignore=None, workers=4, skip_same=False,
+            prefetch=None):
+    """ Compares files in src to dst like idircmp with a pool of
+    threads, each directory is compared by a task of the pool and
+    idle workers take next directory of any subtree from the queue.
+    yields CmpResult in a deterministic order (sorted by name, directories
+    in pre-order) irrespective of which worker compared them.
+    at most prefetch (default 4 * workers) directories are compared
+    ahead of the results consumed, so memory is bounded for slow
+    consumers (eg.. checksums).
+    see idircmp for skip_same.
+    """
+    src, dst = _check_dirs(src, dst)
+    digests = _tree_digests(src, dst, ignore, skip_same)
+    prefetch = prefetch or 4 * workers
+    stop = Event()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        def task(sroot):
+            if stop.is_set():
+                return [], []
+            return _cmp_dir(sroot, src, dst, ignore, digests)
+
+        # directories to compare in pre-order from the end, submitted
+        # ones are futures of their tasks
+        stack = [str(src)]
+        inflight = 0
+        try:
+            while stack:
+                # submit directories next in order up to prefetch
+                i = len(stack) - 1
+                while i >= 0 and inflight < prefetch:
+                    if isinstance(stack[i], str):
+                        stack[i] = pool.submit(task, stack[i])
+                        inflight += 1
+                    i -= 1
+                results, subdirs = stack.pop().result()
+                inflight -= 1
+                yield from results
+                stack.extend(reversed(subdirs))
+        finally:
+            # stop walking when generator is closed early
+            stop.set()
+
+
+def ilinkcmp(results, dedup=False):
+    """ Checks that hardlinks in src are hardlinks in dst
+    passes on CmpResults of idircmp or pdircmp, a matching file is a
+    MISMATCH of kind 'hardlink' if its copy is not linked to copies of
+    other links to its inode in src, or if it is linked to a copy of
+    another file unless dst is deduplicated (see gar.dedup).
+    """
+    # inode in dst of inode in src and inverse
+    dst_inodes = {}
+    src_inodes = {}
+    for r in results:
+        if r.status == MATCH and r.kind == 'file':
+            try:
+                sst = os.lstat(r.src)
+                dst = os.lstat(r.dst)
+            except OSError:
+                yield r
                 continue
-            if not fidp.exists():
-                miss.append((str(fisp), str(fidp)))
+            if sst.st_nlink > 1 or dst.st_nlink > 1:
+                skey = (sst.st_dev, sst.st_ino)
+                dkey = (dst.st_dev, dst.st_ino)
+                if dst_inodes.setdefault(skey, dkey) != dkey or \
+                        (src_inodes.setdefault(dkey, skey) != skey and
+                         not dedup):
+                    r = r._replace(status=MISMATCH, kind='hardlink')
+        yield r
+
+
+def isparsecmp(results, sparse):
+    """ passes on CmpResults of idircmp or pdircmp and appends
+    (src, dst, logical size, allocated size of src, allocated size of dst)
+    of matching files that are sparse in src or dst to list sparse.
+    """
+    for r in results:
+        if r.status == MATCH and r.kind == 'file':
+            try:
+                sst = os.lstat(r.src)
+                dst = os.lstat(r.dst)
+            except OSError:
+                yield r
                 continue
-            if cp_stat(fisp) == cp_stat(fidp):
-                match.append((str(fisp), str(fidp)))
-            else:
-                mismatch.append(('file', str(fisp), str(fidp)))
-        for di in sdirs:
-            dsp = sroot / di
-            ddp = os.path.relpath(os.path.abspath(dsp), src)
-            ddp = dst / ddp
-            # not necessary to check os.R_OK of symlink dir 
-            # because dir links are not resolved by os.walk
-            if not ddp.exists():
-                miss.append((str(dsp), str(ddp)))
+            if S_ISREG(sst.st_mode) and (is_sparse(sst) or is_sparse(dst)):
+                sparse.append((r.src, r.dst, sst.st_size,
+                               allocated_size(sst), allocated_size(dst)))
+        yield r
+
+
+def collect_cmp(results):
+    """ Collects CmpResults to lists of match, missmatch, miss and skip """
+    lists = {MATCH: [], MISMATCH: [], MISS: [], SKIP: []}
+    for r in results:
+        lists[r.status].append(r.astuple())
+    return (lists[MATCH], lists[MISMATCH], lists[MISS], lists[SKIP])
+
+
+def dircmp(src, dst, ignore=None, **kwargs):
+    """ Compares files in src to dst for integrity
+    returns list of match, missmatch, skip and misses
+    see idircmp for comparing without collecting results and
+    for kwargs (eg.. skip_same).
+    """
+    return collect_cmp(idircmp(src, dst, ignore=ignore, **kwargs))
+
+
+class GroupIndex:
+    """ Precomputed membership of a group for fast ownership checks
+        uids of all members (primary and secondary, from passwd, group
+        and NSS databases) and gid of the group are held in frozensets,
+        so that a check on a file is a set lookup of st_uid/st_gid.
+        call reload() to pick up changes in long running processes.
+    """
+    def __init__(self, group):
+        self.group = group
+        self.reload()
+
+    def reload(self):
+        gid = getgid(self.group)
+        gr = grp.getgrgid(gid)
+        self.name = gr.gr_name
+        members = set(group_members(self.name))
+        uids = set()
+        # NSS users (eg.., ldap) with group as primary group
+        # are not in /etc/passwd
+        for pw in pwd.getpwall():
+            if pw.pw_gid == gid or pw.pw_name in members:
+                uids.add(pw.pw_uid)
+                members.discard(pw.pw_name)
+        # members not enumerated by getpwall
+        for m in members:
+            try:
+                uids.add(pwd.getpwnam(m).pw_uid)
+            except KeyError:
                 continue
-            if cp_stat(dsp) == cp_stat(ddp):
-                match.append((str(dsp), str(ddp)))
-            else:
-                mismatch.append(('dir', str(dsp), str(ddp)))
-    return (match, mismatch, miss, skip)
+        self.uids = frozenset(uids)
+        self.gids = frozenset([gid])
+        return self
+
+    def __contains__(self, uid):
+        return uid in self.uids
+
+    def owns(self, st, ignorefilegroup=True):
+        """ True if stat result st is owned by a member of group
+            or also by group if ignorefilegroup is False
+        """
+        if st.st_uid in self.uids:
+            return True
+        return (not ignorefilegroup) and st.st_gid in self.gids
+
+    def __repr__(self):
+        return f"GroupIndex({self.name!r}, uids={len(self.uids)})"
 
 
+_group_indexes = {}
+
+
+def group_index(group, reload=False):
+    """ Returns GroupIndex for group built once per process
+        reload=True rebuilds the index from databases.
+    """
+    index = _group_indexes.get(group)
+    if index is None:
+        index = _group_indexes[group] = GroupIndex(group)
+    elif reload:
+        index.reload()
+    return index
+
 
 def user_in_group(user, group):
     """ Check if user is in group
@@ -238,6 +480,29 @@ def user_in_group(user, group):
     return user in group_members(group)
 
 
+def open_noatime(path, flags=os.O_RDONLY):
+    """ Returns file descriptor of path opened without updating
+    access time of file (times are retained by copy and compared
+    by verify) if permitted (owner or root) else a normal open.
+    """
+    try:
+        return os.open(path, flags | getattr(os, "O_NOATIME", 0))
+    except PermissionError:
+        return os.open(path, flags)
+
+
+def allocated_size(st):
+    """ bytes allocated on disk to file of stat result st """
+    return st.st_blocks * 512
+
+
+def is_sparse(st):
+    """ True if file of stat result st has holes, less is
+    allocated than its logical size
+    """
+    return allocated_size(st) < st.st_size
+
+
 def hr_size(size):
     """Returns human readable size
        input size in bytes
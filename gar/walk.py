@@ -0,0 +1,133 @@
+import os
+import stat
+from . import instrument
+
+# events of scantree
+DIR = "dir"      # a directory before its entries
+FILE = "file"    # an entry that is not a directory (or a link to one)
+POST = "post"    # a directory after all its entries
+
+
+class Entry:
+    """ A file, directory or symlink found by scantree
+    behaves like os.DirEntry but the lstat of the entry is taken
+    once and cached, stat following symlinks is cached on first use.
+    """
+    __slots__ = ("path", "name", "_lstat", "_stat")
+
+    def __init__(self, path, name=None, lstat=None):
+        self.path = os.fspath(path)
+        self.name = name if name is not None else os.path.basename(self.path)
+        self._lstat = lstat if lstat is not None else os.lstat(self.path)
+        self._stat = None
+
+    @classmethod
+    def from_direntry(cls, direntry):
+        return cls(direntry.path, direntry.name,
+                   direntry.stat(follow_symlinks=False))
+
+    def stat(self, follow_symlinks=True):
+        if not (follow_symlinks and self.is_symlink()):
+            return self._lstat
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self._lstat.st_mode)
+
+    def _followed_mode(self, follow_symlinks):
+        try:
+            return self.stat(follow_symlinks=follow_symlinks).st_mode
+        except OSError:
+            # dangling link
+            return 0
+
+    def is_dir(self, follow_symlinks=True):
+        return stat.S_ISDIR(self._followed_mode(follow_symlinks))
+
+    def is_file(self, follow_symlinks=True):
+        return stat.S_ISREG(self._followed_mode(follow_symlinks))
+
+    def readable(self):
+        """ like os.access(path, os.R_OK) from cached stat
+        (file mode bits only, ACLs are not considered)
+        """
+        try:
+            st = self.stat()
+        except OSError:
+            return False
+        return stat_readable(st)
+
+    def __fspath__(self):
+        return self.path
+
+    def __repr__(self):
+        return f"<Entry {self.path!r}>"
+
+
+_euid = os.geteuid()
+_groups = frozenset(os.getgroups() + [os.getegid()])
+
+
+def stat_readable(st):
+    """ True if file of stat result st is readable by the process """
+    if _euid == 0:
+        return True
+    if st.st_uid == _euid:
+        return bool(st.st_mode & stat.S_IRUSR)
+    if st.st_gid in _groups:
+        return bool(st.st_mode & stat.S_IRGRP)
+    return bool(st.st_mode & stat.S_IROTH)
+
+
+def scandir(path):
+    """ Returns list of Entry of each entry in directory path
+    the listing is read at once so no directory is held open.
+    """
+    entries = []
+    with instrument.timer("scan"), os.scandir(path) as it:
+        for direntry in it:
+            try:
+                entries.append(Entry.from_direntry(direntry))
+            except FileNotFoundError:
+                # removed while scanning
+                continue
+    return entries
+
+
+def scantree(top, enter=None, onerror=None):
+    """ Walks directory tree top without recursion using a stack
+    of scandir listings, so depth of tree is not limited.
+    yields (event, Entry) for all entries below top:
+        (DIR, entry) for a directory before its entries,
+        (FILE, entry) for all other entries including symlinks,
+        (POST, entry) for a directory after all its entries.
+    enter(entry) is called for a directory before it is yielded, when it
+    returns False the directory is neither yielded nor scanned.
+    onerror(entry, ex) is called when a directory can't be scanned, its
+    POST is yielded anyway.
+    """
+    stack = [(None, iter(scandir(top)))]
+    while stack:
+        parent, it = stack[-1]
+        entry = next(it, None)
+        if entry is None:
+            stack.pop()
+            if parent is not None:
+                yield POST, parent
+            continue
+        if not stat.S_ISDIR(entry._lstat.st_mode):
+            yield FILE, entry
+            continue
+        if enter and not enter(entry):
+            continue
+        yield DIR, entry
+        try:
+            entries = scandir(entry.path)
+        except OSError as ex:
+            if onerror:
+                onerror(entry, ex)
+            yield POST, entry
+            continue
+        stack.append((entry, iter(entries)))